@@ -0,0 +1,899 @@
+#!/usr/bin/env python3
+# microbenchmarks for MacroPad's hot paths.
+#   ./benchmark.py            run everything
+#   ./benchmark.py dispatch   run a single benchmark
+#
+# options:
+#   --tree=<file>   replay a GET_TREE dump (`i3-msg -t get_tree > file`)
+#                   instead of a generated one
+#   --config=<file> time startup with this config instead of a generated one
+#   --events=<file> replay a recording (see replay.py) instead of generated
+#                   events, through --config or the example config
+
+import subprocess
+import threading
+import tempfile
+import random
+import socket
+import struct
+import json
+import time
+import sys
+import os
+
+sys.argv.append("--no-i3")
+
+import macropad
+import events
+import replay
+import timers
+import output
+import i3msg
+import evdev
+
+from evdev.events import InputEvent
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_CONFIG = os.path.join(BASE_DIR, "example.conf")
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace("bench", "", 1).lower()] = func
+
+    return func
+
+def report(name, count, seconds):
+    print("%-32s %12.0f events/s  (%.3f us/event)" % (name, count / seconds,
+        seconds / count * 1000000))
+
+def keyEvents(count, seed=1):
+    # a mix of bound keypad keys and unbound letters, with press, hold and
+    # release states
+    rng = random.Random(seed)
+    codes = [evdev.ecodes.ecodes[name] for name in ("KEY_KP0", "KEY_KP1",
+        "KEY_KP2", "KEY_KP5", "KEY_KP8", "KEY_KPPLUS", "KEY_A", "KEY_S",
+        "KEY_MUTE", "KEY_ENTER")]
+
+    return [InputEvent(0, 0, evdev.ecodes.EV_KEY, rng.choice(codes),
+        rng.choice((0, 1, 2))) for _ in range(count)]
+
+def loadExample():
+    if not macropad.CONFIG or macropad.CONFIG.path != EXAMPLE_CONFIG:
+        macropad.activateConfig(macropad.parseConfig(EXAMPLE_CONFIG))
+
+@benchmark
+def benchDispatch(count=200000):
+    loadExample()
+
+    events = keyEvents(count)
+    layers = ("default", "vim", "qutebrowser", "mindforger")
+
+    # before: categorize every event, then nested lookups by layer name,
+    # keycode string and key state
+    keyMap = {}
+    callbackMap = macropad.CONFIG.keyCallbackMap
+    hits = 0
+    start = time.perf_counter()
+
+    for i, event in enumerate(events):
+        layer = layers[i & 3]
+        keyEvent = evdev.categorize(event)
+        now = time.time()
+
+        if not keyEvent.keycode in keyMap:
+            keyMap[keyEvent.keycode] = {"state": keyEvent.keystate, "last_hit": now}
+        else:
+            keyMap[keyEvent.keycode]["state"] = keyEvent.keystate
+            keyMap[keyEvent.keycode]["last_hit"] = now
+
+        if keyEvent.keycode in callbackMap[layer]:
+            if keyEvent.keystate in callbackMap[layer][keyEvent.keycode]:
+                hits += 1
+
+    report("dispatch (nested dicts)", count, time.perf_counter() - start)
+
+    # after: one flat lookup keyed on integers
+    layerIds = [macropad.internLayer(layer) for layer in layers]
+    dispatch = macropad.DISPATCH
+    keyMap = {}
+    compiledHits = 0
+    start = time.perf_counter()
+
+    for i, event in enumerate(events):
+        layerId = layerIds[i & 3]
+        keyMap[event.code] = (event.value, time.time())
+
+        if dispatch.get(layerId << 18 | event.code << 3 | event.value):
+            compiledHits += 1
+
+    report("dispatch (compiled)", count, time.perf_counter() - start)
+
+    assert hits == compiledHits
+
+
+class NullUInput:
+    def __init__(self):
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+
+    def close(self):
+        os.close(self.fd)
+
+def timeCalls(func, count):
+    start = time.perf_counter()
+
+    for _ in range(count):
+        func()
+
+    return time.perf_counter() - start
+
+@benchmark
+def benchOutput(count=100000):
+    # a chord press and release, and an autorepeat frame from a passthrough
+    # device, written to /dev/null one event at a time like evdev's UInput
+    # does, and packed into one write
+    from evdev import _uinput
+
+    ec = evdev.ecodes
+    ui = NullUInput()
+    names = ("KEY_LEFTCTRL", "KEY_LEFTSHIFT", "KEY_T")
+    codes = output.resolve("+".join(names))
+    packedChord = output.chord(codes, 1) + output.chord(codes, 0)
+
+    def oldChord():
+        for state in (1, 0):
+            for keycode in names:
+                _uinput.write(ui.fd, ec.EV_KEY, ec.ecodes[keycode], state)
+
+            _uinput.write(ui.fd, ec.EV_SYN, ec.SYN_REPORT, 0)
+
+    def newChord():
+        output.write(ui, packedChord)
+
+    def oldRepeat():
+        _uinput.write(ui.fd, ec.EV_KEY, ec.KEY_J, 2)
+        _uinput.write(ui.fd, ec.EV_SYN, ec.SYN_REPORT, 0)
+
+    def newRepeat():
+        output.write(ui, b"".join([output.packKey(ec.KEY_J, 2), output.SYN]))
+
+    for name, old, new in (("chord", oldChord, newChord),
+            ("autorepeat", oldRepeat, newRepeat)):
+        oldTime = timeCalls(old, count)
+        newTime = timeCalls(new, count)
+
+        print("%-32s %8.3f us -> %8.3f us  (%.1fx)" % ("output %s" % name,
+            oldTime / count * 1000000, newTime / count * 1000000,
+            oldTime / newTime))
+
+    ui.close()
+
+def getOption(name, default=None):
+    for arg in sys.argv:
+        if arg.startswith("--%s=" % name):
+            return arg.split('=', 1)[1]
+
+    return default
+
+def fakeTree(depth=5, width=7, prefix=""):
+    node = {"id": random.getrandbits(40), "type": "con", "layout": "splith",
+        "name": "window %s" % prefix, "rect": {"x": 0, "y": 0, "width": 1920,
+        "height": 1080}, "window_properties": {"class": "St", "instance": "st",
+        "title": "~/code/MacroPad" * 4}, "focused": False, "nodes": []}
+
+    if depth:
+        node["nodes"] = [fakeTree(depth - 1, width, "%s.%i" % (prefix, i))
+            for i in range(width)]
+
+    return node
+
+def focusEvent(i):
+    return {"change": "focus", "container": {"id": i, "type": "con",
+        "window_properties": {"class": "qutebrowser", "instance": "qutebrowser",
+        "title": "tab %i" % i}, "focused": True, "nodes": []}}
+
+def replayStream(blob, count, readAll, decode):
+    # write a recorded stream into one end of a socketpair in 64k chunks and
+    # time how long the other end takes to frame and decode it
+    a, b = socket.socketpair()
+
+    def writer():
+        view = memoryview(blob)
+
+        for offset in range(0, len(view), 65536):
+            a.sendall(view[offset:offset + 65536])
+
+    thread = threading.Thread(target=writer)
+    thread.daemon = True
+    start = time.perf_counter()
+    thread.start()
+
+    readAll(b, count, decode)
+
+    seconds = time.perf_counter() - start
+
+    thread.join()
+    a.close()
+    b.close()
+
+    return seconds
+
+def readOld(s, count, decode):
+    # i3msg.recvall before the framing layer, for comparison
+    for _ in range(count):
+        header = s.recv(14)
+
+        # the old code assumed the header always arrived in one piece
+        while len(header) < 14:
+            header += s.recv(14 - len(header))
+
+        size, = struct.unpack('I', header[6:10])
+        data = b''
+
+        while len(data) < size:
+            data += s.recv(size - len(data))
+
+        if decode:
+            json.loads(data)
+
+def readNew(s, count, decode):
+    reader = i3msg.Reader(s)
+
+    for _ in range(count):
+        data = reader.read()[1]
+
+        if decode:
+            i3msg.loads(data)
+
+@benchmark
+def benchI3(count=20000):
+    random.seed(1)
+
+    treePath = getOption("tree")
+
+    if treePath:
+        tree = open(treePath, 'rb').read()
+    else:
+        tree = json.dumps(fakeTree()).encode()
+
+    trees = i3msg.encode(i3msg.GET_TREE, tree) * 4
+    storm = b"".join(i3msg.encode(0x80000003, json.dumps(focusEvent(i)))
+        for i in range(count))
+
+    print("tree: %.1f MB x 4, storm: %i window events" % (len(tree) / 1e6, count))
+
+    for name, blob, messages in (("tree", trees, 4), ("focus storm", storm, count)):
+        for decode in (False, True):
+            old = replayStream(blob, messages, readOld, decode)
+            new = replayStream(blob, messages, readNew, decode)
+
+            print("%-32s %8.2f ms -> %8.2f ms  (%.1fx)" % ("i3 %s (%s)" % (name,
+                decode and "frame + json" or "frame"), old * 1000, new * 1000,
+                old / new))
+
+
+def fakeConfig(path, layers=300, keys=20, split=False):
+    # about 8 lines per key and layer. `split` puts every layer in its own
+    # file next to the config, pulled in with INCLUDE.
+    keyNames = [name for name in evdev.ecodes.ecodes if name.startswith("KEY_")
+        and not name in ("KEY_MAX", "KEY_CNT")][:keys]
+
+    with open(path, 'w') as mainFile:
+        mainFile.write("DEVICE {\n\tNAME Fake Keypad\n}\n\nBINDS {\n")
+
+        if split:
+            mainFile.write("\tINCLUDE layers/*.conf\n")
+            os.makedirs(os.path.join(os.path.dirname(path), "layers"),
+                exist_ok=True)
+
+        for layer in range(layers):
+            if split:
+                configFile = open(os.path.join(os.path.dirname(path), "layers",
+                    "layer%i.conf" % layer), 'w')
+            else:
+                configFile = mainFile
+
+            configFile.write("\tLAYER layer%i {\n" % layer)
+
+            for key in keyNames:
+                configFile.write("\t\t%s {\n\t\t\tCOMMENT %s on layer%i\n\n"
+                    "\t\t\tON_PRESS {\n\t\t\t\tKEY KEY_LEFTCTRL+%s\n"
+                    "\t\t\t\tTYPE hello from layer%i\n\t\t\t\tLAYER layer%i\n"
+                    "\t\t\t}\n\t\t}\n" % (key, key, layer, key, layer,
+                    (layer + 1) % layers))
+
+            configFile.write("\t}\n")
+
+            if split:
+                configFile.close()
+
+        mainFile.write("}\n")
+
+def startProcess(configPath, count):
+    # time a fresh interpreter importing macropad and loading the config
+    code = ("import sys; sys.argv.append('--no-i3'); import macropad; "
+        "macropad.loadConfig(%r)" % configPath)
+    start = time.perf_counter()
+
+    for _ in range(count):
+        subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR, check=True,
+            stdout=subprocess.DEVNULL)
+
+    return (time.perf_counter() - start) / count
+
+def removeCache(configPath):
+    try:
+        os.unlink(macropad.getCachePath(configPath))
+    except FileNotFoundError:
+        pass
+
+@benchmark
+def benchStartup(count=10):
+    directory = tempfile.TemporaryDirectory()
+    configPath = getOption("config")
+
+    if configPath:
+        # keep the user's own cache out of it
+        configPath = os.path.abspath(configPath)
+        copyPath = os.path.join(directory.name, os.path.basename(configPath))
+
+        with open(configPath, 'rb') as source, open(copyPath, 'wb') as copy:
+            copy.write(source.read())
+
+        configPath = copyPath
+    else:
+        configPath = os.path.join(directory.name, "large.conf")
+        fakeConfig(configPath)
+
+    with open(configPath) as configFile:
+        lines = sum(1 for _ in configFile)
+
+    print("config: %i lines" % lines)
+
+    # parsing alone, in this process
+    parse = 0
+    load = 0
+
+    for _ in range(count):
+        removeCache(configPath)
+
+        start = time.perf_counter()
+        macropad.loadConfig(configPath)
+        parse += time.perf_counter() - start
+
+        start = time.perf_counter()
+        config = macropad.loadConfig(configPath)
+        load += time.perf_counter() - start
+
+    assert config and config.bindCount
+    print("%-32s %8.2f ms -> %8.2f ms  (%.1fx)" % ("load config (cold -> warm)",
+        parse / count * 1000, load / count * 1000, parse / load))
+
+    # whole process, interpreter and imports included
+    cold = 0
+
+    for _ in range(count):
+        removeCache(configPath)
+        cold += startProcess(configPath, 1)
+
+    cold /= count
+    warm = startProcess(configPath, count)
+
+    print("%-32s %8.2f ms -> %8.2f ms  (%.1fx)" % ("startup (cold -> warm)",
+        cold * 1000, warm * 1000, cold / warm))
+
+    directory.cleanup()
+
+
+def countLines(paths):
+    lines = 0
+
+    for path in paths:
+        with open(path) as configFile:
+            lines += sum(1 for _ in configFile)
+
+    return lines
+
+@benchmark
+def benchParse(count=5):
+    import configfile
+
+    directory = tempfile.TemporaryDirectory()
+    configPath = os.path.join(directory.name, "large.conf")
+    fakeConfig(configPath)
+
+    with open(configPath) as configFile:
+        text = configFile.read()
+
+    lines = text.count("\n")
+    print("config: %i lines" % lines)
+
+    start = time.perf_counter()
+
+    for _ in range(count):
+        configfile.parse(text, configPath)
+
+    seconds = (time.perf_counter() - start) / count
+    print("%-32s %12.0f lines/s  (%.2f ms)" % ("tokenize + tree", lines / seconds,
+        seconds * 1000))
+
+    start = time.perf_counter()
+
+    for _ in range(count):
+        configfile.CACHE.clear()
+        config = macropad.parseConfig(configPath)
+
+    seconds = (time.perf_counter() - start) / count
+    assert not config.errors()
+    print("%-32s %12.0f lines/s  (%.2f ms)" % ("parseConfig", lines / seconds,
+        seconds * 1000))
+
+    # the same binds, one included file per layer. editing one of them only
+    # reparses that one, the rest of the time goes into building the Config.
+    splitPath = os.path.join(directory.name, "split.conf")
+    fakeConfig(splitPath, split=True)
+
+    configfile.CACHE.clear()
+    split = macropad.parseConfig(splitPath)
+    files = [path for path, _, _ in split.files[0]]
+
+    assert split.bindCount == config.bindCount and not split.errors()
+    print("split: %i lines in %i files" % (countLines(files), len(files)))
+
+    cold = 0
+    edited = 0
+
+    for i in range(count):
+        configfile.CACHE.clear()
+
+        start = time.perf_counter()
+        macropad.parseConfig(splitPath)
+        cold += time.perf_counter() - start
+
+        with open(files[1 + i % (len(files) - 1)], 'a') as layerFile:
+            layerFile.write("# edited\n")
+
+        before = dict(configfile.CACHE)
+
+        start = time.perf_counter()
+        macropad.parseConfig(splitPath)
+        edited += time.perf_counter() - start
+
+        reparsed = sum(1 for path, parsed in configfile.CACHE.items()
+            if before.get(path) is not parsed)
+        assert reparsed == 1
+
+    print("%-32s %8.2f ms -> %8.2f ms  (%.1fx)" % ("parse (cold -> one edited)",
+        cold / count * 1000, edited / count * 1000, cold / edited))
+
+    configfile.CACHE.clear()
+    directory.cleanup()
+
+
+REPLAY_CONFIG = """DEVICE {
+	PATH /dev/input/replay
+	PASSTHROUGH
+}
+
+BINDS {
+	KEY_KP1 {
+		BIND KEY_LEFTCTRL+KEY_C
+	}
+
+	KEY_KP2 {
+		ON_PRESS {
+			MODELAYER nav
+		}
+	}
+
+	LAYER nav {
+		KEY_KP1 {
+			BIND KEY_LEFTCTRL+KEY_V
+		}
+
+		KEY_KP2 {
+			ON_PRESS {
+				MODELAYER default
+			}
+		}
+	}
+}
+"""
+
+ORDER_CONFIG = """DEVICE {
+	PATH /dev/input/replay
+	PASSTHROUGH
+}
+
+BINDS {
+	KEY_CAPSLOCK {
+		BIND KEY_LEFTCTRL
+	}
+
+	KEY_F3 {
+		ON_PRESS {
+			KEY KEY_A
+			KEY KEY_B
+			WAIT 0.1
+			KEY KEY_D
+		}
+	}
+}
+"""
+
+FOCUS_EVERY = 500
+
+def replayEvents(count, seed=1):
+    # typing on the passthrough device, with the odd bound key in between.
+    # every key is released, and every event is its own frame.
+    rng = random.Random(seed)
+    ec = evdev.ecodes
+    letters = [ec.ecodes["KEY_%s" % letter] for letter in "ASDFJKLEIRU"]
+    events = []
+
+    while len(events) < count:
+        roll = rng.random()
+
+        if roll < .01:
+            code = ec.KEY_KP1
+        elif roll < .02:
+            code = ec.KEY_KP2
+        else:
+            code = rng.choice(letters)
+
+        for value in (1,) + (2,) * (rng.random() < .05) + (0,):
+            # keyboards send the scan code along with every key event
+            if value != 2:
+                events.append(InputEvent(0, 0, ec.EV_MSC, ec.MSC_SCAN, code))
+
+            events.append(InputEvent(0, 0, ec.EV_KEY, code, value))
+            events.append(InputEvent(0, 0, ec.EV_SYN, ec.SYN_REPORT, 0))
+
+    return events
+
+def expectedEvents(events, focusEvery):
+    # what REPLAY_CONFIG should turn `events` into, with focus changes to
+    # default, nav and another window in turn (every key is its own frame)
+    ec = evdev.ecodes
+    nav = False
+    frame = 0
+    expected = []
+
+    def emit(*codes):
+        for code in codes:
+            expected.append(InputEvent(0, 0, ec.EV_KEY, code, event.value))
+
+        expected.append(InputEvent(0, 0, ec.EV_SYN, ec.SYN_REPORT, 0))
+
+    for event in events:
+        if event.type == ec.EV_SYN:
+            frame += 1
+
+        if event.type != ec.EV_KEY:
+            continue
+
+        if frame % focusEvery == 0:
+            nav = frame // focusEvery % 3 == 1
+
+        if event.code == ec.KEY_KP2 and event.value == 1:
+            nav = not nav
+        elif event.code == ec.KEY_KP1:
+            emit(ec.KEY_LEFTCTRL, nav and ec.KEY_V or ec.KEY_C)
+        else:
+            emit(event.code)
+
+    return expected
+
+@benchmark
+def benchReplay(count=20000):
+    # the whole listener, through a fake device and a fake uinput device
+    recording = getOption("events")
+    directory = tempfile.TemporaryDirectory()
+
+    if recording:
+        streams = replay.load(recording)
+        configPath = getOption("config", EXAMPLE_CONFIG)
+    else:
+        events = replayEvents(count)
+        streams = [events]
+        configPath = os.path.join(directory.name, "replay.conf")
+
+        with open(configPath, 'w') as configFile:
+            configFile.write(REPLAY_CONFIG)
+
+    results = replay.run(configPath, streams, focusEvery=FOCUS_EVERY)
+    replay.printResults(results)
+
+    if not recording:
+        checkOrder("emitted events", results["emitted"],
+            expectedEvents(events, FOCUS_EVERY))
+
+    # a remap pressed while a macro types has to come out after what it
+    # types and before the key it modifies, but not wait for its WAIT
+    ec = evdev.ecodes
+    configPath = os.path.join(directory.name, "order.conf")
+
+    with open(configPath, 'w') as configFile:
+        configFile.write(ORDER_CONFIG)
+
+    events = []
+
+    for code, value in [(ec.KEY_F3, 1), (ec.KEY_F3, 0)] + [(ec.KEY_CAPSLOCK, 1),
+            (ec.KEY_C, 1), (ec.KEY_C, 0), (ec.KEY_CAPSLOCK, 0)] * 3:
+        events.append(InputEvent(0, 0, ec.EV_KEY, code, value))
+        events.append(InputEvent(0, 0, ec.EV_SYN, ec.SYN_REPORT, 0))
+
+    expected = []
+
+    for code, value in [(ec.KEY_A, 1), (ec.KEY_A, 0), (ec.KEY_B, 1),
+            (ec.KEY_B, 0), (ec.KEY_F3, 0)] + [(ec.KEY_LEFTCTRL, 1), (ec.KEY_C, 1),
+            (ec.KEY_C, 0), (ec.KEY_LEFTCTRL, 0)] * 3 + [(ec.KEY_D, 1),
+            (ec.KEY_D, 0)]:
+        expected.append(InputEvent(0, 0, ec.EV_KEY, code, value))
+        expected.append(InputEvent(0, 0, ec.EV_SYN, ec.SYN_REPORT, 0))
+
+    results = replay.run(configPath, [events])
+    checkOrder("macro and remap order", results["emitted"], expected)
+
+    directory.cleanup()
+
+def checkOrder(name, emitted, expected):
+    i = replay.compare(emitted, expected)
+
+    if i is None:
+        print("%s match" % name)
+
+        return
+
+    print("%s DIFFER from what the config should produce at event %i:" % (name,
+        i))
+    print("\temitted:  %s" % replay.describe(emitted, i))
+    print("\texpected: %s" % replay.describe(expected, i))
+
+    sys.exit(1)
+
+
+FOCUS_EVENTS = """
+EVENTS {
+	LAYER_CHANGED {
+		RUN echo "%LAYER%" > /tmp/navpad
+	}
+}
+"""
+
+def windowEvent(change, windowClass, i):
+    return i3msg.encode(0x80000003, json.dumps({"change": change,
+        "container": {"id": i, "type": "con", "focused": True,
+        "window_properties": {"class": windowClass, "instance": windowClass,
+        "title": "~/code/MacroPad %i" % i}, "nodes": []}}))
+
+def oldFocusHandler(event, data):
+    # focusHandler before the focus module and the event bus, for comparison.
+    # every window event, title changes included, forked its own commands.
+    if not "container" in data or not "window_properties" in data["container"]:
+        return
+
+    if not "class" in data["container"]["window_properties"]:
+        return
+
+    window = data["container"]["window_properties"]["class"].lower()
+
+    with macropad.STATE_LOCK:
+        if window in macropad.CONFIG.layers:
+            macropad.setLayer(window, lock=True)
+        else:
+            macropad.setLayer("default", lock=True)
+
+        for callback in macropad.EVENT_CALLBACKS.get(macropad.EVENT_LAYER_CHANGED, []):
+            macropad.runCommand(callback["value"].replace("%LAYER%",
+                macropad.CURRENT_LAYER))
+
+@benchmark
+def benchFocus(count=20000):
+    # a terminal retitling itself, with focus going back and forth between it
+    # and a window that has a layer
+    directory = tempfile.TemporaryDirectory()
+    configPath = os.path.join(directory.name, "focus.conf")
+    rng = random.Random(1)
+    messages = []
+
+    with open(configPath, 'w') as configFile:
+        configFile.write(REPLAY_CONFIG + FOCUS_EVENTS)
+
+    for i in range(count):
+        if rng.random() < .05:
+            messages.append(windowEvent("focus", rng.choice(("St", "nav")), i))
+        else:
+            messages.append(windowEvent("title", "St", i))
+
+    commands = []
+    changes = []
+    runCommand = macropad.runCommand
+    trigger = macropad.triggerEventCallback
+    macropad.runCommand = lambda command, event=None: commands.append(command)
+    macropad.TIMERS = timers.Timers()
+
+    def countingTrigger(event):
+        changes.append(event)
+
+        # the old handler ran its commands itself
+        if name == "new":
+            trigger(event)
+
+    macropad.triggerEventCallback = countingTrigger
+
+    for name in ("old", "new"):
+        macropad.activateConfig(macropad.parseConfig(configPath))
+
+        del commands[:]
+        del changes[:]
+        start = time.perf_counter()
+
+        for message in messages:
+            payload = i3msg.decode(message)[2]
+
+            if name == "old":
+                oldFocusHandler(None, i3msg.loads(payload))
+            elif macropad.focusFilter(payload):
+                macropad.focusHandler(None, i3msg.loads(payload))
+
+            macropad.TIMERS.run()
+
+        seconds = time.perf_counter() - start
+
+        macropad.EVENT_BUS.wait()
+
+        print("%-32s %8.2f ms, %i layer changes, %i commands" % (
+            "focus storm (%s)" % name, seconds * 1000, len(changes),
+            len(commands)))
+
+    macropad.TIMERS.close()
+    macropad.TIMERS = None
+    macropad.runCommand = runCommand
+    macropad.triggerEventCallback = trigger
+    macropad.DISPATCH = {}
+
+    directory.cleanup()
+
+
+@benchmark
+def benchEvents(count=2000):
+    # layers flipping faster than LAYER_CHANGED callbacks can keep up with
+    directory = tempfile.TemporaryDirectory()
+    configPath = os.path.join(directory.name, "events.conf")
+    writes = []
+    writeFile = events.writeFile
+    events.writeFile = lambda path, text: writes.append(text)
+
+    with open(configPath, 'w') as configFile:
+        configFile.write(REPLAY_CONFIG + FOCUS_EVENTS.replace("RUN echo "
+            "\"%LAYER%\" > /tmp/navpad", "WRITE /tmp/navpad"))
+
+    macropad.activateConfig(macropad.parseConfig(configPath))
+
+    start = time.perf_counter()
+
+    for i in range(count):
+        macropad.setLayer(("nav", "default")[i & 1])
+
+    published = time.perf_counter() - start
+
+    macropad.EVENT_BUS.wait()
+
+    print("%-32s %8.2f ms on the input path, %i writes" % ("layer flips (%i)"
+        % count, published * 1000, len(writes)))
+
+    events.writeFile = writeFile
+    macropad.DISPATCH = {}
+
+    directory.cleanup()
+
+
+GESTURE_BINDS = """
+BINDS {
+	KEY_KP3 {
+		ON_TAP {
+			I3 focus left
+		}
+
+		ON_LONG_PRESS {
+			I3 focus right
+		}
+	}
+
+	CHORD KEY_KP4+KEY_KP5 {
+		BIND KEY_ESC
+	}
+
+	SEQUENCE KEY_KP0 KEY_KP7 {
+		ON_PRESS {
+			I3 workspace next
+		}
+	}
+}
+"""
+
+@benchmark
+def benchProfiles(count=20000):
+    # --daemon profile switches, compared to loading the config from its
+    # cache like a restart would
+    directory = tempfile.TemporaryDirectory()
+    paths = []
+
+    for name, text in (("work", REPLAY_CONFIG), ("game", REPLAY_CONFIG +
+            GESTURE_BINDS)):
+        paths.append(os.path.join(directory.name, "%s.conf" % name))
+
+        with open(paths[-1], 'w') as configFile:
+            configFile.write(text)
+
+    config, _ = macropad.loadProfiles(paths)
+    macropad.activateConfig(config)
+
+    start = time.perf_counter()
+
+    for i in range(count):
+        macropad.switchProfile(("work", "game")[i & 1])
+
+    switch = (time.perf_counter() - start) / count
+    start = time.perf_counter()
+
+    for i in range(count // 100):
+        macropad.activateConfig(macropad.loadCachedConfig(paths[i & 1]))
+
+    load = (time.perf_counter() - start) / (count // 100)
+
+    print("%-32s %8.2f us -> %8.2f us  (%.0fx)" % ("profile switch (load -> "
+        "preloaded)", load * 1000000, switch * 1000000, load / switch))
+
+    macropad.PROFILES.clear()
+    macropad.PROFILE = None
+    macropad.DISPATCH = {}
+
+    directory.cleanup()
+
+@benchmark
+def benchGestures(count=200000):
+    # keys that can't start a gesture shouldn't pay for the ones that can
+    directory = tempfile.TemporaryDirectory()
+    ec = evdev.ecodes
+    rng = random.Random(1)
+    letters = [ec.ecodes["KEY_%s" % letter] for letter in "ASDFJKLEIRU"]
+    events = [InputEvent(0, 0, ec.EV_KEY, rng.choice(letters), value)
+        for _ in range(count // 2) for value in (1, 0)]
+
+    for name, text in (("plain", REPLAY_CONFIG),
+            ("gestures", REPLAY_CONFIG + GESTURE_BINDS)):
+        configPath = os.path.join(directory.name, "%s.conf" % name)
+
+        with open(configPath, 'w') as configFile:
+            configFile.write(text)
+
+        macropad.activateConfig(macropad.parseConfig(configPath))
+
+        handleKey = macropad.handleKey
+        start = time.perf_counter()
+
+        for event in events:
+            handleKey(event)
+
+        report("unbound keys (%s)" % name, len(events),
+            time.perf_counter() - start)
+
+    macropad.DISPATCH = {}
+
+    directory.cleanup()
+
+
+if __name__ == "__main__":
+    names = [name for name in sys.argv[1:] if not name.startswith("--")]
+
+    for name in names or BENCHMARKS:
+        if not name in BENCHMARKS:
+            print("Unknown benchmark: %s" % name)
+            print("Available: %s" % ", ".join(BENCHMARKS))
+
+            sys.exit(1)
+
+        BENCHMARKS[name]()
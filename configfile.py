@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# config file syntax for MacroPad.
+#   a config is a tree of blocks (`NAME {` ... `}`) and statements
+#   (`NAME value`), one per line. tokenize() and parse() turn a file into that
+#   tree in one pass without knowing what any name means, that's up to
+#   parseConfig() in macropad.py. `INCLUDE <path or glob>` pulls other files
+#   in where it appears, relative to the file it's in. every file is parsed
+#   once and kept until it changes on disk, so editing one included file
+#   only reparses that file.
+
+import glob
+import os
+
+# tokens
+OPEN = 0
+CLOSE = 1
+LINE = 2
+
+# nodes
+BLOCK = 0
+STATEMENT = 1
+INCLUDE = 2
+
+CACHE = {} # absolute path -> File
+
+
+class Diagnostic:
+    __slots__ = ("path", "line", "column", "message", "warning")
+
+    def __init__(self, path, line, column, message, warning=False):
+        self.path = path
+        self.line = line # 0 for the whole file
+        self.column = column
+        self.message = message
+        self.warning = warning
+
+    def __reduce__(self):
+        return (Diagnostic, (self.path, self.line, self.column, self.message,
+            self.warning))
+
+    def __str__(self):
+        where = self.path
+
+        if self.line:
+            where = "%s:%i:%i" % (where, self.line, self.column)
+
+        return "%s: %s: %s" % (where, "warning" if self.warning else "error",
+                self.message)
+
+
+class Node:
+    # a block has children, a statement has a value (None for a lone word),
+    # an include has the path or glob as its value
+    __slots__ = ("kind", "name", "value", "line", "column", "children")
+
+    def __init__(self, kind, name, value, line, column, children=None):
+        self.kind = kind
+        self.name = name
+        self.value = value
+        self.line = line
+        self.column = column
+        self.children = children
+
+    @property
+    def valueColumn(self):
+        return self.column + len(self.name) + 1
+
+    def __repr__(self):
+        if self.kind == BLOCK:
+            return "BLOCK(%s, %i children)" % (self.name, len(self.children))
+
+        return "%s(%s %r)" % ("INCLUDE" if self.kind == INCLUDE else "STATEMENT",
+                self.name, self.value)
+
+
+class File:
+    __slots__ = ("path", "mtime", "size", "nodes", "includes", "diagnostics")
+
+    def __init__(self, path, nodes, includes, diagnostics):
+        self.path = path
+        self.mtime = None
+        self.size = None
+        self.nodes = nodes
+        self.includes = includes # every INCLUDE node, however deep
+        self.diagnostics = diagnostics # syntax errors
+
+
+class Source:
+    # a config file and everything it includes
+    def __init__(self, path):
+        self.path = path
+        self.root = None # File, None if it couldn't be read
+        self.files = {} # path -> File, in the order they were first included
+        self.globs = {} # absolute INCLUDE glob -> what it matched
+        self.included = {} # INCLUDE node -> [File]
+        self.diagnostics = []
+
+    def stamps(self):
+        # what has to stay the same on disk for the result to still be valid
+        return [(file.path, file.mtime, file.size) for file in
+                self.files.values()], sorted(self.globs.items())
+
+
+def tokenize(text):
+    # -> (kind, line, column, text) for every line that isn't blank or a
+    # comment. a line ending in `{` opens a block, one ending in `}` closes one.
+    lineNum = 0
+
+    for raw in text.split('\n'):
+        lineNum += 1
+        line = raw.strip()
+
+        if not line or line[0] == '#':
+            continue
+
+        column = len(raw) - len(raw.lstrip()) + 1
+
+        if line[-1] == '{':
+            yield OPEN, lineNum, column, line.split('{', 1)[0].rstrip()
+        elif line[-1] == '}':
+            yield CLOSE, lineNum, column, line[:-1].rstrip()
+        else:
+            yield LINE, lineNum, column, line
+
+def parse(text, path):
+    nodes = []
+    children = nodes
+    blocks = [] # open blocks, innermost last
+    includes = []
+    diagnostics = []
+
+    for kind, line, column, value in tokenize(text):
+        if kind == OPEN:
+            node = Node(BLOCK, value, None, line, column, [])
+            children.append(node)
+            blocks.append(node)
+            children = node.children
+        elif kind == CLOSE:
+            if value:
+                diagnostics.append(Diagnostic(path, line, column,
+                    "ignoring `%s` before `}`" % value, True))
+
+            if not blocks:
+                diagnostics.append(Diagnostic(path, line, column + len(value),
+                    "`}` without a block to close"))
+
+                continue
+
+            blocks.pop()
+            children = blocks[-1].children if blocks else nodes
+        else:
+            name, space, value = value.partition(' ')
+
+            if name.lower() == "include":
+                node = Node(INCLUDE, name, value.strip(), line, column)
+
+                if not node.value:
+                    diagnostics.append(Diagnostic(path, line, column,
+                        "INCLUDE needs a path"))
+
+                    continue
+
+                includes.append(node)
+            else:
+                node = Node(STATEMENT, name, value if space else None, line,
+                        column)
+
+            children.append(node)
+
+    for node in blocks:
+        diagnostics.append(Diagnostic(path, node.line, node.column,
+            "`%s` is never closed" % node.name))
+
+    return File(path, nodes, includes, diagnostics)
+
+def parseFile(path):
+    # a file's tree, parsed again only when the file changes
+    info = os.stat(path)
+    cached = CACHE.get(path)
+
+    if cached and (cached.mtime, cached.size) == (info.st_mtime_ns, info.st_size):
+        return cached
+
+    with open(path, 'r') as configFile:
+        parsed = parse(configFile.read(), path)
+
+    parsed.mtime = info.st_mtime_ns
+    parsed.size = info.st_size
+    CACHE[path] = parsed
+
+    return parsed
+
+def resolve(base, pattern):
+    # INCLUDE paths are relative to the file they're in
+    return os.path.abspath(os.path.join(os.path.dirname(base),
+        os.path.expanduser(pattern)))
+
+def isGlob(pattern):
+    # what glob treats as a pattern
+    return any(c in pattern for c in "*?[")
+
+def expand(pattern):
+    return sorted(glob.glob(pattern))
+
+def load(path):
+    # -> Source. unreadable files, include loops and syntax errors end up in
+    # its diagnostics, whatever could be parsed is still there.
+    source = Source(os.path.abspath(path))
+    source.root = visit(source, source.path, [], None)
+
+    return source
+
+def visit(source, path, stack, include):
+    # `include` is (file, INCLUDE node) that led here, None for the config
+    def error(message):
+        if include:
+            source.diagnostics.append(Diagnostic(include[0], include[1].line,
+                include[1].valueColumn, message))
+        else:
+            source.diagnostics.append(Diagnostic(path, 0, 0, message))
+
+    if path in stack:
+        error("`%s` is already being included (loop)" % path)
+
+        return None
+
+    try:
+        parsed = parseFile(path)
+    except (OSError, UnicodeDecodeError) as e:
+        error("can't read `%s`: %s" % (path, e))
+
+        return None
+
+    if not path in source.files:
+        source.files[path] = parsed
+        source.diagnostics.extend(parsed.diagnostics)
+
+    stack.append(path)
+
+    for node in parsed.includes:
+        files = []
+        pattern = resolve(path, node.value)
+
+        if isGlob(pattern):
+            # files added or removed later change what it matches
+            targets = source.globs[pattern] = expand(pattern)
+        else:
+            targets = [pattern]
+
+        for target in targets:
+            included = visit(source, target, stack, (path, node))
+
+            if included:
+                files.append(included)
+
+        source.included[node] = files
+
+    stack.pop()
+
+    return parsed
+
+def unchanged(stamps):
+    # Source.stamps() still matches what's on disk
+    files, globs = stamps
+
+    for path, mtime, size in files:
+        try:
+            info = os.stat(path)
+        except OSError:
+            return False
+
+        if (info.st_mtime_ns, info.st_size) != (mtime, size):
+            return False
+
+    for pattern, matches in globs:
+        if expand(pattern) != matches:
+            return False
+
+    return True
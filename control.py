@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# control socket for `macropad.py --daemon`.
+#   a client sends one command per connection as a line of text and gets one
+#   JSON line back. `macropad.py --ctl <command>` is the client:
+#     --ctl state              current profile, layer, mode layer and hot layer
+#     --ctl profile <name>     switch profile
+#     --ctl layer <name>       switch layer, it times out as usual
+#     --ctl lock <name>        switch to a mode layer
+#     --ctl unlock             back to the default layer
+#     --ctl reload [profile]   reload a profile from disk
+
+import socket
+import json
+
+import unixserver
+
+SERVER = None
+
+MAX_COMMAND = 4096
+
+
+def defaultPath():
+    return unixserver.defaultPath("macropad-control")
+
+def readLine(connection):
+    data = b""
+
+    while not b"\n" in data and len(data) < MAX_COMMAND:
+        chunk = connection.recv(MAX_COMMAND)
+
+        if not chunk:
+            break
+
+        data += chunk
+
+    return data.split(b"\n", 1)[0].decode(errors="replace")
+
+def answer(connection, handler):
+    try:
+        connection.settimeout(2)
+
+        try:
+            reply = handler(readLine(connection))
+        except Exception as e:
+            reply = {"ok": False, "error": str(e)}
+
+        connection.sendall((json.dumps(reply) + "\n").encode())
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+def startServer(handler, path=None):
+    # `handler(command)` returns the reply, a dict with "ok" in it
+    global SERVER
+
+    if path is None:
+        path = defaultPath()
+
+    SERVER = unixserver.start(path,
+            lambda connection: answer(connection, handler),
+            "listen for commands")
+
+    return SERVER and path
+
+def stopServer():
+    global SERVER
+
+    if SERVER:
+        unixserver.stop(SERVER)
+
+        SERVER = None
+
+def request(command, path=None):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(5)
+
+    try:
+        s.connect(path or defaultPath())
+        s.sendall((command + "\n").encode())
+
+        return json.loads(readLine(s))
+    finally:
+        s.close()
+
+def client(args):
+    # returns the exit status
+    try:
+        reply = request(" ".join(args))
+    except (OSError, ValueError) as e:
+        print("Can't reach MacroPad: %s" % e)
+
+        return 1
+
+    if not reply.get("ok"):
+        print("Error: %s" % reply.get("error"))
+
+        return 1
+
+    del reply["ok"]
+
+    for key, value in sorted(reply.items()):
+        if isinstance(value, list):
+            value = " ".join(value)
+
+        print("%s: %s" % (key, value))
+
+    return 0
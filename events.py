@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# `EVENTS` callbacks for MacroPad.
+#   callbacks run on their own thread, never on the one reading keys. states
+#   published while they run (or within the coalescing window) are merged,
+#   only the latest one is passed on, and only if it differs from the last.
+#   besides `RUN`, callbacks can write to a file or FIFO, signal a process or
+#   send to a unix socket without going through a shell.
+
+import threading
+import signal
+import socket
+import errno
+import time
+import os
+
+SIGNALS = {name[3:]: value for name, value in vars(signal).items()
+        if name.startswith("SIG") and not name.startswith("SIG_") and
+        isinstance(value, int)}
+
+
+def expand(text, values):
+    # `%LAYER%` and friends
+    for name, value in values.items():
+        text = text.replace("%%%s%%" % name, value)
+
+    return text
+
+def parseSignal(value):
+    # `<pid or process name> [signal]` -> (target, signal number), None if
+    # the signal is unknown
+    target, _, name = value.partition(' ')
+    name = name.strip().upper() or "TERM"
+
+    if name.startswith("SIG"):
+        name = name[3:]
+
+    if name.isdigit():
+        return target, int(name)
+
+    if not name in SIGNALS:
+        return None
+
+    return target, SIGNALS[name]
+
+def findProcesses(name):
+    # like killall, by the kernel's process name
+    pids = []
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open("/proc/%s/comm" % entry) as comm:
+                if comm.read().rstrip('\n') == name:
+                    pids.append(int(entry))
+        except OSError:
+            pass
+
+    return pids
+
+def sendSignal(target, signum):
+    pids = [int(target)] if target.isdigit() else findProcesses(target)
+
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            print("SIGNAL %s: %s" % (target, e))
+
+def writeFile(path, text):
+    # a FIFO nobody is reading from is skipped instead of blocking
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NONBLOCK,
+                0o644)
+    except OSError as e:
+        if e.errno != errno.ENXIO: # no reader on the FIFO
+            print("WRITE %s: %s" % (path, e))
+
+        return
+
+    try:
+        os.write(fd, (text + "\n").encode())
+    except OSError as e:
+        print("WRITE %s: %s" % (path, e))
+    finally:
+        os.close(fd)
+
+def sendSocket(path, text):
+    data = (text + "\n").encode()
+
+    for kind in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+        s = socket.socket(socket.AF_UNIX, kind)
+        s.settimeout(.5)
+
+        try:
+            if kind == socket.SOCK_STREAM:
+                s.connect(path)
+                s.sendall(data)
+            else:
+                s.sendto(data, path)
+
+            return
+        except OSError as e:
+            # a datagram socket refuses stream connections with EPROTOTYPE
+            if kind == socket.SOCK_DGRAM or e.errno != errno.EPROTOTYPE:
+                print("SEND %s: %s" % (path, e))
+
+                return
+        finally:
+            s.close()
+
+
+class Bus:
+    # `run(command)` runs `RUN` callbacks
+    def __init__(self, run, window=0):
+        self.run = run
+        self.window = window
+        self.condition = threading.Condition()
+        self.pending = {} # event -> (callbacks, values)
+        self.last = {} # event -> values last passed on
+        self.lastRun = 0
+        self.busy = False
+        self.thread = None
+
+    def publish(self, event, callbacks, values):
+        with self.condition:
+            self.pending[event] = (callbacks, values)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop)
+                self.thread.daemon = True
+                self.thread.start()
+
+            self.condition.notify_all()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.busy = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+
+                # at most one round of callbacks per window
+                while True:
+                    wait = self.lastRun + self.window - time.monotonic()
+
+                    if wait <= 0:
+                        break
+
+                    self.condition.wait(wait)
+
+                pending = self.pending
+                self.pending = {}
+                self.busy = True
+                self.lastRun = time.monotonic()
+
+            for event, (callbacks, values) in pending.items():
+                # back where we were when the last callbacks ran
+                if self.last.get(event) == values:
+                    continue
+
+                self.last[event] = values
+
+                for callback in callbacks:
+                    try:
+                        self.call(callback, values)
+                    except Exception as e:
+                        print(e)
+
+    def call(self, callback, values):
+        command = callback["command"]
+        value = callback["value"]
+
+        if command == "run":
+            self.run(expand(value, values))
+        elif command == "write":
+            path, text = value
+            writeFile(path, expand(text, values))
+        elif command == "signal":
+            sendSignal(*value)
+        elif command == "send":
+            path, text = value
+            sendSocket(path, expand(text, values))
+
+    def wait(self, timeout=None):
+        # until everything published so far has been passed on
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and
+                    not self.busy, timeout)
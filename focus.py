@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# i3 focus handling for MacroPad.
+#   window events are filtered on their raw bytes before any json is decoded,
+#   bursts are coalesced to the latest window, and the window -> layer lookup
+#   goes through the `FOCUS` rules once per distinct window.
+
+import threading
+import fnmatch
+import time
+import re
+
+FIELDS = ("class", "instance", "title")
+
+CACHE_SIZE = 1024
+
+
+def compilePattern(pattern):
+    # `/regex/`, a glob if it has `*?[` in it, otherwise an exact name.
+    # all of them ignore case.
+    if len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/'):
+        return re.compile(pattern[1:-1], re.IGNORECASE)
+
+    if any(c in pattern for c in "*?["):
+        return re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+
+    return pattern.lower()
+
+
+class Index:
+    # the `FOCUS` section
+    def __init__(self):
+        self.rules = [] # (field, exact name or regex, layer), in config order
+        self.fields = set(("class",)) # what a window is told apart by
+        self.debounce = .05
+
+    def addRule(self, field, value):
+        # `CLASS <pattern> <layer>`, returns an error or None
+        pattern, _, layer = value.rpartition(' ')
+        pattern = pattern.strip()
+
+        if not pattern or not layer:
+            return "expected `%s <pattern> <layer>`" % field.upper()
+
+        try:
+            self.rules.append((field, compilePattern(pattern), layer))
+        except re.error as e:
+            return "bad pattern %s (%s)" % (pattern, e)
+
+        self.fields.add(field)
+
+        return None
+
+    def key(self, properties):
+        # only the fields some rule looks at, so e.g. title changes map to
+        # the same key when no rule matches titles
+        return tuple(properties.get(field) or "" if field in self.fields else ""
+                for field in FIELDS)
+
+    def resolve(self, key, layers):
+        values = dict(zip(FIELDS, key))
+
+        for field, pattern, layer in self.rules:
+            if isinstance(pattern, str):
+                if values[field].lower() == pattern:
+                    return layer
+            elif pattern.match(values[field]):
+                return layer
+
+        # a layer named after the window class
+        windowClass = values["class"].lower()
+
+        if windowClass in layers:
+            return windowClass
+
+        return "default"
+
+
+class Focus:
+    # setLayer(layer) is called with the layer for the newest focused window,
+    # callLater(delay, callback) runs the end of a debounce window, count(name)
+    # is metrics.count() with --metrics
+    def __init__(self, index, layers, setLayer, callLater, count=None):
+        self.index = index
+        self.layers = layers
+        self.setLayer = setLayer
+        self.callLater = callLater
+        self.count = count
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.latest = None
+        self.applied = None
+        self.lastApplied = 0
+        self.timer = None
+
+        self.changes = [b'"change":"focus"']
+
+        if "title" in index.fields:
+            self.changes.append(b'"change":"title"')
+
+    def accept(self, payload):
+        # called on the raw event from i3, `"change"` comes first
+        head = bytes(payload[:48]).replace(b' ', b'')
+
+        if any(change in head for change in self.changes):
+            return True
+
+        if self.count:
+            self.count("focus.filtered")
+
+        return False
+
+    def handle(self, data):
+        container = data.get("container")
+
+        if not container or not "window_properties" in container:
+            return
+
+        change = data.get("change")
+
+        # focus changes, and title changes of the focused window
+        if change == "title":
+            if not container.get("focused") or not "title" in self.index.fields:
+                return
+        elif change != "focus":
+            return
+
+        properties = container["window_properties"]
+
+        if not "class" in properties:
+            return
+
+        key = self.index.key(properties)
+        now = time.monotonic()
+
+        with self.lock:
+            self.latest = key
+
+            if self.timer is not None:
+                # the end of the window picks up the latest one
+                if self.count:
+                    self.count("focus.coalesced")
+
+                return
+
+            wait = self.lastApplied + self.index.debounce - now
+
+            if wait > 0:
+                self.timer = self.callLater(wait, self.flush)
+
+                if self.timer is not None:
+                    return
+
+            self.lastApplied = now
+
+            self.apply(key)
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            self.lastApplied = time.monotonic()
+
+            self.apply(self.latest)
+
+    def apply(self, key):
+        # with `lock` held, the i3 thread and the timers both get here
+        if key == self.applied:
+            if self.count:
+                self.count("focus.skipped")
+
+            return
+
+        self.applied = key
+        layer = self.cache.get(key)
+
+        if layer is None:
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+
+            layer = self.cache[key] = self.index.resolve(key, self.layers)
+
+        self.setLayer(layer)
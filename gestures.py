@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+# tap, long press, double tap, chord and sequence gestures for MacroPad.
+#   compileGesture() and addTapKey() work out, per device and layer, which keys
+#   can start a gesture. only those go through the Engine, every other key is
+#   dispatched the moment it arrives. gestures are decided from the key
+#   events' timestamps, timers only cover the cases where no further event
+#   will come (a tap that could still be a double tap, an unfinished chord).
+
+import output
+
+KEY_UP = 0
+KEY_DOWN = 1
+KEY_HOLD = 2
+
+# dispatched like key states, next to KEY_UP, KEY_DOWN and KEY_HOLD
+TAP = 3
+LONG_PRESS = 4
+DOUBLE_TAP = 5
+
+STATES = {"ON_TAP": TAP, "ON_LONG_PRESS": LONG_PRESS, "ON_DOUBLE_TAP": DOUBLE_TAP}
+
+# chords and sequences get keycodes past KEY_MAX, so they're dispatched like
+# any other key
+VIRTUAL_BASE = 0x300
+VIRTUAL_MAX = 0x3ff
+
+PREFIXES = ("CHORD ", "SEQUENCE ")
+
+# `DEVICE` options, in seconds
+TIMES = {
+    "tap_time": .2, # held longer than this is a long press, not a tap
+    "double_tap_time": .25, # from a tap's release to the next press
+    "chord_time": .05, # from the first key of a chord to the last
+    "sequence_time": 1 # between two keys of a sequence
+}
+
+
+class Layer:
+    # what one device and layer bind to gestures
+    def __init__(self):
+        self.keys = set() # every key the Engine has to see
+        self.taps = {} # keycode -> gesture states bound to it
+        self.chords = {} # keycode -> [(all keys of the chord, virtual code)]
+        self.sequences = {} # keycode -> [virtual code or None, {next keycode: ...}]
+
+NO_GESTURES = Layer()
+
+class DeviceState:
+    def __init__(self):
+        self.down = {} # tap keys -> press time
+        self.holdTimers = {}
+        self.longPressed = set()
+        self.pendingTaps = {} # keycode -> (timer, release time)
+        self.swallowed = set() # keys whose remaining events are eaten
+        self.chord = [] # presses held back until the chord is decided
+        self.chordLayer = None
+        self.chordTimer = None
+        self.chords = {} # fired chords -> their keys, until one is released
+        self.sequence = None # trie node, while a sequence is being typed
+        self.sequenceTimer = None
+        self.lastEvent = None
+
+    def idle(self):
+        return not (self.down or self.swallowed or self.chord or
+                self.sequence is not None)
+
+
+def keyName(keyword):
+    # `chord key_a + key_b` -> `CHORD KEY_A+KEY_B`
+    kind, _, keys = keyword.strip().partition(' ')
+
+    if kind.upper() == "CHORD":
+        return "CHORD %s" % "".join(keys.split()).upper()
+
+    return "SEQUENCE %s" % " ".join(keys.split()).upper()
+
+def parseName(name):
+    # -> (kind, keycodes), None if it's not a valid gesture
+    kind, _, keys = name.partition(' ')
+
+    if kind == "CHORD":
+        codes = output.resolve(keys)
+
+        if not codes or len(codes) < 2 or len(set(codes)) != len(codes):
+            return None
+    else:
+        codes = output.resolve("+".join(keys.split()))
+
+        if not codes or len(codes) < 2:
+            return None
+
+    return kind, codes
+
+def getLayer(config, key):
+    layer = config.gestures.get(key)
+
+    if layer is None:
+        layer = config.gestures[key] = Layer()
+
+    return layer
+
+def compileGesture(config, key, name):
+    # add a `CHORD` or `SEQUENCE` block to the gestures of `key` (device
+    # index << 18 | layer id), returns its virtual keycode
+    parsed = parseName(name)
+
+    if not parsed:
+        return None
+
+    if not name in config.virtualKeys:
+        if VIRTUAL_BASE + len(config.virtualKeys) > VIRTUAL_MAX:
+            return None
+
+        config.virtualKeys[name] = VIRTUAL_BASE + len(config.virtualKeys)
+
+    virtual = config.virtualKeys[name]
+    kind, codes = parsed
+    layer = getLayer(config, key)
+
+    if kind == "CHORD":
+        members = frozenset(codes)
+
+        for code in codes:
+            layer.chords.setdefault(code, []).append((members, virtual))
+    else:
+        children = layer.sequences
+
+        for code in codes:
+            node = children.setdefault(code, [None, {}])
+            children = node[1]
+
+        node[0] = virtual
+
+    layer.keys.add(codes[0])
+
+    if kind == "CHORD":
+        layer.keys.update(codes)
+
+    return virtual
+
+def addTapKey(config, key, code, states):
+    gestureStates = frozenset(state for state in states if state >= TAP)
+
+    if not gestureStates:
+        return
+
+    layer = getLayer(config, key)
+    layer.taps[code] = layer.taps.get(code, frozenset()) | gestureStates
+    layer.keys.add(code)
+
+
+class Engine:
+    # runs on the listener thread with STATE_LOCK held, timers included.
+    #   fire(device, keycode, state, event) dispatches a key state or gesture,
+    #   deliver(device, event) hands back a key a gesture held on to and then
+    #   didn't want.
+    def __init__(self, layers, times, fire, deliver, callLater):
+        self.layers = layers
+        self.times = times
+        self.fire = fire
+        self.deliver = deliver
+        self.callLater = callLater
+        self.devices = {}
+        self.active = False # some device is in the middle of a gesture
+        self.closed = False # replaced by a reloaded config, see close()
+
+    def close(self):
+        # the config was reloaded, nothing of this engine may fire anymore
+        self.closed = True
+
+        for state in self.devices.values():
+            for timer in state.holdTimers.values():
+                self.cancel(timer)
+
+            for timer, _ in state.pendingTaps.values():
+                self.cancel(timer)
+
+            self.cancel(state.chordTimer)
+            self.cancel(state.sequenceTimer)
+
+    def later(self, delay, callback, *args):
+        return self.callLater(delay, self.expire, callback, *args)
+
+    def expire(self, callback, *args):
+        # a timer that was already due when close() ran still gets here
+        if not self.closed:
+            callback(*args)
+
+    def update(self):
+        self.active = not all(state.idle() for state in self.devices.values())
+
+    def wants(self, device, layerId, code):
+        layer = self.layers.get(device << 18 | layerId)
+
+        return layer is not None and code in layer.keys
+
+    def handle(self, event, device, layerId):
+        # True if the event was used up by a gesture
+        state = self.devices.get(device)
+
+        if state is None:
+            state = self.devices[device] = DeviceState()
+
+        layer = self.layers.get(device << 18 | layerId, NO_GESTURES)
+        code = event.code
+
+        try:
+            if code in state.swallowed:
+                return self.swallow(state, device, event)
+
+            if state.sequence is not None:
+                return self.continueSequence(state, device, event)
+
+            if state.chord and self.continueChord(state, device, event):
+                return True
+
+            if event.value == KEY_DOWN:
+                if code in layer.sequences:
+                    return self.startSequence(state, device, layer, event)
+
+                if code in layer.chords:
+                    return self.startChord(state, device, layer, event)
+
+            if code in layer.taps:
+                return self.tap(state, device, layer, event)
+
+            return False
+        finally:
+            self.update()
+
+    def swallow(self, state, device, event):
+        code = event.code
+
+        for virtual, members in list(state.chords.items()):
+            if code in members:
+                if event.value == KEY_UP:
+                    # the chord is over as soon as one of its keys is let go
+                    del state.chords[virtual]
+
+                    self.fire(device, virtual, KEY_UP, event)
+                elif event.value == KEY_HOLD:
+                    self.fire(device, virtual, KEY_HOLD, event)
+
+        if event.value == KEY_UP:
+            state.swallowed.discard(code)
+
+        return True
+
+    # chords
+    def startChord(self, state, device, layer, event):
+        state.chord = [event]
+        state.chordLayer = layer
+        state.chordTimer = self.later(self.times["chord_time"],
+                self.chordTimeout, device)
+
+        return True
+
+    def continueChord(self, state, device, event):
+        layer = state.chordLayer
+        code = event.code
+        pressed = {buffered.code for buffered in state.chord}
+
+        if event.value == KEY_DOWN and code in layer.chords and not code in pressed \
+                and event.timestamp() - state.chord[0].timestamp() <= \
+                self.times["chord_time"]:
+            pressed.add(code)
+
+            for members, virtual in layer.chords[state.chord[0].code]:
+                if members == pressed:
+                    self.cancel(state.chordTimer)
+
+                    state.chord = []
+                    state.chordTimer = None
+                    state.chords[virtual] = members
+                    state.swallowed.update(members)
+
+                    self.fire(device, virtual, KEY_DOWN, event)
+
+                    return True
+
+            state.chord.append(event)
+
+            # no chord left that these keys could still become
+            if not any(pressed < members for members, _ in
+                    layer.chords[state.chord[0].code]):
+                self.flushChord(state, device)
+
+            return True
+
+        # anything else means it wasn't a chord, send what was held back first
+        self.flushChord(state, device)
+
+        return False
+
+    def flushChord(self, state, device):
+        self.cancel(state.chordTimer)
+
+        events = state.chord
+        layer = state.chordLayer
+        state.chord = []
+        state.chordTimer = None
+
+        # back through the usual path, so a key with a tap bind still taps
+        for event in events:
+            if event.code in layer.taps:
+                self.tap(state, device, layer, event)
+            else:
+                self.deliver(device, event)
+
+    def chordTimeout(self, device):
+        state = self.devices[device]
+        state.chordTimer = None
+
+        if state.chord:
+            self.flushChord(state, device)
+
+        self.update()
+
+    # sequences
+    def startSequence(self, state, device, layer, event):
+        state.swallowed.add(event.code)
+        state.sequence = layer.sequences[event.code]
+        state.lastEvent = event
+        state.sequenceTimer = self.later(self.times["sequence_time"],
+                self.sequenceTimeout, device)
+
+        return True
+
+    def continueSequence(self, state, device, event):
+        # releases of keys held from before the sequence go through as usual,
+        # keys pressed during it are eaten whether they match or not
+        if event.value != KEY_DOWN:
+            return False
+
+        self.cancel(state.sequenceTimer)
+
+        state.sequenceTimer = None
+        state.swallowed.add(event.code)
+
+        node = state.sequence[1].get(event.code)
+
+        if node is None:
+            state.sequence = None
+        elif node[1]:
+            # a longer sequence starts with this one, wait for the next key
+            state.sequence = node
+            state.lastEvent = event
+            state.sequenceTimer = self.later(self.times["sequence_time"],
+                    self.sequenceTimeout, device)
+        else:
+            state.sequence = None
+
+            self.fireSequence(device, node[0], event)
+
+        return True
+
+    def sequenceTimeout(self, device):
+        state = self.devices[device]
+        node = state.sequence
+        state.sequence = None
+        state.sequenceTimer = None
+
+        if node is not None and node[0] is not None:
+            self.fireSequence(device, node[0], state.lastEvent)
+
+        self.update()
+
+    def fireSequence(self, device, virtual, event):
+        self.fire(device, virtual, KEY_DOWN, event)
+        self.fire(device, virtual, KEY_UP, event)
+
+    # taps
+    def tap(self, state, device, layer, event):
+        code = event.code
+        states = layer.taps[code]
+
+        if event.value == KEY_DOWN:
+            state.down[code] = event.timestamp()
+            state.longPressed.discard(code)
+
+            if LONG_PRESS in states:
+                state.holdTimers[code] = self.later(self.times["tap_time"],
+                        self.longPress, device, code, event)
+
+            self.fire(device, code, KEY_DOWN, event)
+        elif event.value == KEY_HOLD:
+            self.fire(device, code, KEY_HOLD, event)
+        else:
+            self.fire(device, code, KEY_UP, event)
+            self.release(state, device, states, event)
+
+        return True
+
+    def release(self, state, device, states, event):
+        code = event.code
+        released = event.timestamp()
+        pressed = state.down.pop(code, None)
+
+        self.cancel(state.holdTimers.pop(code, None))
+
+        if code in state.longPressed:
+            state.longPressed.discard(code)
+
+            return
+
+        if pressed is None:
+            return
+
+        # the timer may not have run yet, the timestamps decide
+        if released - pressed >= self.times["tap_time"]:
+            if LONG_PRESS in states:
+                self.fire(device, code, LONG_PRESS, event)
+
+            return
+
+        if not DOUBLE_TAP in states:
+            self.fire(device, code, TAP, event)
+
+            return
+
+        pending = state.pendingTaps.pop(code, None)
+
+        if pending:
+            timer, lastRelease = pending
+
+            self.cancel(timer)
+
+            if pressed - lastRelease <= self.times["double_tap_time"]:
+                self.fire(device, code, DOUBLE_TAP, event)
+
+                return
+
+            # too slow for a double tap, that was two taps
+            self.fire(device, code, TAP, event)
+
+        state.pendingTaps[code] = (self.later(self.times["double_tap_time"],
+                self.tapTimeout, device, code, event), released)
+
+    def longPress(self, device, code, event):
+        state = self.devices[device]
+        state.holdTimers.pop(code, None)
+
+        if code in state.down:
+            state.longPressed.add(code)
+
+            self.fire(device, code, LONG_PRESS, event)
+
+    def tapTimeout(self, device, code, event):
+        if self.devices[device].pendingTaps.pop(code, None):
+            self.fire(device, code, TAP, event)
+
+    def cancel(self, timer):
+        if timer is not None:
+            timer.cancel()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# device hotplug for MacroPad.
+#   watches /dev/input with inotify and keeps a path -> name index of input
+#   devices, so devices configured by NAME are found without opening every
+#   node, and missing devices reconnect as soon as their node shows up.
+
+import ctypes.util
+import ctypes
+import struct
+import evdev
+import os
+
+INPUT_DIR = "/dev/input"
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# creation isn't enough, udev fixes up permissions right after (IN_ATTRIB)
+WATCH_MASK = IN_CREATE | IN_ATTRIB | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM
+
+EVENT = struct.Struct("iIII")
+
+NAMES = {} # path -> device name
+
+libc = None
+
+
+def getLibc():
+    global libc
+
+    if libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                use_errno=True)
+
+    return libc
+
+
+class Inotify:
+    def __init__(self):
+        self.fd = getLibc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def watch(self, path, mask):
+        wd = getLibc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+
+        if wd < 0:
+            error = ctypes.get_errno()
+
+            raise OSError(error, os.strerror(error), path)
+
+        self.watches[wd] = path
+
+        return wd
+
+    def read(self):
+        # returns (watched dir, mask, name) for every pending event
+        events = []
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                events.append((self.watches.get(wd), mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def probe(path):
+    # open just long enough to read the name
+    try:
+        device = evdev.InputDevice(path)
+    except OSError:
+        return None
+
+    try:
+        return device.name
+    finally:
+        device.close()
+
+def scan():
+    NAMES.clear()
+
+    for path in evdev.list_devices():
+        name = probe(path)
+
+        if name is not None:
+            NAMES[path] = name
+
+def findPath(name):
+    for path, deviceName in NAMES.items():
+        if deviceName == name:
+            return path
+
+    return None
+
+def isEventNode(name):
+    return name.startswith("event")
+
+
+class Watcher:
+    def __init__(self, paths=()):
+        self.inotify = Inotify()
+        self.pending = set()
+
+        self.inotify.watch(INPUT_DIR, WATCH_MASK | IN_ONLYDIR)
+
+        # also watch the directories of devices configured by PATH, like
+        # /dev/input/by-id, which udev may only create later
+        for path in paths:
+            directory = os.path.dirname(path)
+
+            if directory != INPUT_DIR:
+                self.watchDir(directory)
+
+        scan()
+
+    def watchDir(self, directory):
+        try:
+            self.inotify.watch(directory, WATCH_MASK | IN_ONLYDIR)
+        except FileNotFoundError:
+            self.pending.add(directory)
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def update(self):
+        # apply pending events to the index, returns True when something
+        # appeared that a missing device could be waiting for
+        changed = False
+
+        for directory, mask, name in self.inotify.read():
+            path = os.path.join(directory or "", name)
+
+            if mask & IN_ISDIR:
+                if path in self.pending and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.pending.discard(path)
+                    self.watchDir(path)
+
+                    changed = True
+
+                continue
+
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                NAMES.pop(path, None)
+            elif directory == INPUT_DIR and isEventNode(name):
+                deviceName = probe(path)
+
+                if deviceName is not None:
+                    NAMES[path] = deviceName
+
+                changed = True
+            else:
+                changed = True
+
+        return changed
+
+    def close(self):
+        self.inotify.close()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 #https://github.com/Ceryn/i3msg-python
-import socket, subprocess, struct, json, threading
+import socket, subprocess, struct, json, threading, os
 
 MSGS = ['RUN_COMMAND', 'GET_WORKSPACES', 'SUBSCRIBE', 'GET_OUTPUTS', 'GET_TREE', 'GET_MARKS', 'GET_BAR_CONFIG', 'GET_VERSION', 'GET_BINDING_MODES', 'GET_CONFIG']
 EVENTS = ['workspace', 'output', 'mode', 'window', 'barconfig_update', 'binding', 'shutdown']
@@ -13,47 +13,187 @@ i3sockpath = None
 def get_i3sockpath():
     global i3sockpath
     if i3sockpath is None:
+        i3sockpath = os.environ.get('I3SOCK')
+    if not i3sockpath:
         i3sockpath = subprocess.check_output(['i3', '--get-socketpath']).strip()
     return i3sockpath
 
+HEADER = struct.Struct('=6sII')
+MAGIC = b'i3-ipc'
+
 def encode(n, msg=''):
-    return b"".join([str.encode('i3-ipc'), 
-        struct.pack('I', len(msg)),
-        struct.pack('I', n), 
-        str.encode(msg)])
+    payload = msg if isinstance(msg, (bytes, bytearray)) else str.encode(msg)
+    return HEADER.pack(MAGIC, len(payload), n) + payload
 
 def decode(blob):
-    size = int(struct.unpack('I', blob[ 6:10])[0])
-    type = int(struct.unpack('I', blob[10:14])[0]) & 0x7fffffff
-    return size, type, blob[14:]
+    _, size, type = HEADER.unpack_from(blob)
+    return size, type & 0x7fffffff, blob[HEADER.size:]
+
+def loads(payload):
+    # decode straight out of the buffer, json only takes str/bytes
+    return json.loads(str(payload, 'utf-8'))
+
+def recv_exactly(s, view):
+    while len(view):
+        n = s.recv_into(view)
+        if not n:
+            raise ConnectionError('i3 closed the connection')
+        view = view[n:]
 
 def recvall(s):
-    size, event, data = decode(s.recv(14))
-    while len(data) < size:
-        data += s.recv(size - len(data))
+    header = bytearray(HEADER.size)
+    recv_exactly(s, memoryview(header))
+    size, event, _ = decode(header)
+    data = bytearray(size)
+    recv_exactly(s, memoryview(data))
     return event, data
 
+class Reader(object):
+    # buffered framing for a socket that carries a stream of messages.
+    #   reads land in one reusable buffer with recv_into, every message that
+    #   arrived in a read is handed out before the socket is touched again,
+    #   and payloads are memoryviews into the buffer that stay valid until
+    #   the next call to read().
+    def __init__(self, s, size=65536):
+        self.s = s
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def fill(self, need):
+        if self.start + need > len(self.buf):
+            pending = self.end - self.start
+            if need > len(self.buf):
+                buf = bytearray(max(need, len(self.buf) * 2))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                self.buf[:pending] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        while self.end - self.start < need:
+            n = self.s.recv_into(self.view[self.end:])
+            if not n:
+                raise ConnectionError('i3 closed the connection')
+            self.end += n
+
+    def read(self):
+        if self.end - self.start < HEADER.size:
+            self.fill(HEADER.size)
+        _, size, type = HEADER.unpack_from(self.buf, self.start)
+        need = HEADER.size + size
+        if self.end - self.start < need:
+            self.fill(need)
+        start = self.start + HEADER.size
+        self.start += need
+        if self.start == self.end:
+            self.start = self.end = 0
+        return type & 0x7fffffff, self.view[start:start + size]
+
 def send(n, msg=''):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     s.connect(get_i3sockpath())
-    s.send(encode(n, str(msg)))
+    s.sendall(encode(n, str(msg)))
     _, data = recvall(s)
     s.close()
     return json.loads(data)
 
-def handle_subscription(s, handler):
+# persistent command connection
+#   shared by every caller, guarded by a lock and reopened on the next call if
+#   i3 restarts or the socket breaks.
+command_socket = None
+command_reader = None
+command_lock = threading.Lock()
+
+def connect():
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(get_i3sockpath())
+    return s
+
+def send_many(messages):
+    # pipeline several (type, payload) messages in one write, then read the
+    # replies in order
+    global command_socket, command_reader
+    blob = b"".join([encode(n, str(msg)) for n, msg in messages])
+    with command_lock:
+        for attempt in range(2):
+            sent = False
+            try:
+                if command_socket is None:
+                    command_socket = connect()
+                    command_reader = Reader(command_socket, 4096)
+                command_socket.sendall(blob)
+                sent = True
+                return [loads(command_reader.read()[1]) for _ in messages]
+            except (OSError, struct.error):
+                global i3sockpath
+                if command_socket is not None:
+                    command_socket.close()
+                # i3 may have restarted with a new socket path
+                command_socket = None
+                i3sockpath = None
+                # once i3 has the commands they may have run, and `kill` or
+                # `move` must not run twice
+                if attempt or sent:
+                    raise
+
+def command(cmd):
+    return send_many([(RUN_COMMAND, cmd)])[0]
+
+def commands(cmds):
+    # pipelined, one reply per command
+    return send_many([(RUN_COMMAND, cmd) for cmd in cmds])
+
+def batch(cmds):
+    # a single RUN_COMMAND, i3 runs the commands in order and replies once
+    return command('; '.join(cmds))
+
+def handle_subscription(s, handler, accept=None):
+    # `accept` sees the raw payload first, events it turns down are never
+    # decoded
+    reader = Reader(s)
     while True:
-        event, data = recvall(s)
-        handler(event, json.loads(data))
+        event, data = reader.read()
+        if accept is None or accept(data):
+            handler(event, loads(data))
 
-def subscribe(events, handler):
+def subscribe(events, handler, accept=None):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     s.connect(get_i3sockpath())
-    s.send(encode(SUBSCRIBE, json.dumps(events)))
+    s.sendall(encode(SUBSCRIBE, json.dumps(events)))
     _, data = recvall(s)
     data = json.loads(data)
     if not 'success' in data or data['success'] != True:
         raise Exception('Subscription failed, got data: %s' % data)
-    t = threading.Thread(target=handle_subscription, args=(s, handler))
+    t = threading.Thread(target=handle_subscription, args=(s, handler, accept))
     t.daemon = True
     t.start()
+
+async def read_async(reader):
+    header = await reader.readexactly(HEADER.size)
+    _, size, type = HEADER.unpack(header)
+    return type & 0x7fffffff, await reader.readexactly(size)
+
+async def subscribe_async(events, handler, accept=None):
+    # asyncio version of subscribe(), runs the handler on the event loop
+    # instead of a thread. returns when i3 closes the connection.
+    import asyncio
+    reader, writer = await asyncio.open_unix_connection(get_i3sockpath())
+    try:
+        writer.write(encode(SUBSCRIBE, json.dumps(events)))
+        await writer.drain()
+        _, data = await read_async(reader)
+        data = loads(data)
+        if not 'success' in data or data['success'] != True:
+            raise Exception('Subscription failed, got data: %s' % data)
+        while True:
+            try:
+                event, data = await read_async(reader)
+            except asyncio.IncompleteReadError:
+                return
+            if accept is None or accept(data):
+                handler(event, loads(data))
+    finally:
+        writer.close()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# non-blocking process launcher for MacroPad.
+#   commands are started with posix_spawn (no copy of the interpreter, its
+#   evdev handles or the uinput device), and a background thread reaps them
+#   as they exit so the caller never waits.
+
+import threading
+import select
+import time
+import os
+
+# characters that mean a command needs a shell to run
+SHELL_CHARS = frozenset("|&;<>()$`\\\"'*?[]{}#~=!\n")
+
+# run commands without a shell when they contain no shell syntax
+DIRECT = False
+
+CHILDREN = {} # pid -> [command, startTime, pidfd]
+CHILDREN_LOCK = threading.Lock()
+STATS = {}
+STATS_LOCK = threading.Lock()
+WAKE_FDS = None
+
+FILE_ACTIONS = [
+    (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+    (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0)
+]
+
+if hasattr(os, "pidfd_open"):
+    USE_PIDFD = True
+else:
+    USE_PIDFD = False
+
+
+def getArgv(command, direct):
+    if not isinstance(command, str):
+        return list(command)
+
+    if direct and not SHELL_CHARS.intersection(command):
+        argv = command.split()
+
+        if argv:
+            return argv
+
+    return ["/bin/sh", "-c", command]
+
+def posixSpawn(argv):
+    try:
+        return os.posix_spawnp(argv[0], argv, os.environ,
+                file_actions=FILE_ACTIONS, setsid=True)
+    except NotImplementedError:
+        return os.posix_spawnp(argv[0], argv, os.environ,
+                file_actions=FILE_ACTIONS)
+
+def spawn(command, direct=None):
+    if direct is None:
+        direct = DIRECT
+
+    if isinstance(command, str):
+        name = command
+    else:
+        name = " ".join(command)
+
+    argv = getArgv(command, direct)
+    start = time.perf_counter()
+
+    try:
+        try:
+            pid = posixSpawn(argv)
+        except FileNotFoundError:
+            # probably a shell builtin like `cd`, let the shell sort it out
+            if not isinstance(command, str) or argv[0] == "/bin/sh":
+                raise
+
+            pid = posixSpawn(["/bin/sh", "-c", command])
+    except OSError as e:
+        print("Could not run `%s`: %s" % (name, e))
+
+        record(name, "failed", 1)
+
+        return 0
+
+    spawnTime = time.perf_counter() - start
+
+    record(name, "count", 1)
+    record(name, "spawn_total", spawnTime)
+    recordMax(name, "spawn_max", spawnTime)
+
+    track(pid, name, start)
+
+    return 1
+
+def record(name, key, value):
+    with STATS_LOCK:
+        stats = STATS.get(name)
+
+        if stats is None:
+            stats = STATS[name] = {"count": 0, "failed": 0, "running": 0,
+                    "spawn_total": 0.0, "spawn_max": 0.0,
+                    "run_total": 0.0, "run_max": 0.0}
+
+        stats[key] += value
+
+def recordMax(name, key, value):
+    with STATS_LOCK:
+        if value > STATS[name][key]:
+            STATS[name][key] = value
+
+def stats():
+    with STATS_LOCK:
+        return {name: dict(values) for name, values in STATS.items()}
+
+def printStats():
+    for name, values in sorted(stats().items()):
+        count = values["count"] or 1
+
+        print("%s\n\truns: %i (%i failed, %i running)" % (name,
+            values["count"], values["failed"], values["running"]))
+        print("\tspawn: avg %.3f ms, max %.3f ms" % (
+            values["spawn_total"] / count * 1000, values["spawn_max"] * 1000))
+        print("\truntime: avg %.3f ms, max %.3f ms" % (
+            values["run_total"] / count * 1000, values["run_max"] * 1000))
+
+def track(pid, name, start):
+    pidfd = None
+
+    if USE_PIDFD:
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pidfd = None
+
+    with CHILDREN_LOCK:
+        CHILDREN[pid] = [name, start, pidfd]
+        record(name, "running", 1)
+
+        if WAKE_FDS is None:
+            startReaper()
+
+    os.write(WAKE_FDS[1], b'\0')
+
+def finish(pid):
+    with CHILDREN_LOCK:
+        name, start, pidfd = CHILDREN.pop(pid)
+
+    runTime = time.perf_counter() - start
+
+    record(name, "running", -1)
+    record(name, "run_total", runTime)
+    recordMax(name, "run_max", runTime)
+
+    return pidfd
+
+def reapChildren():
+    poller = select.poll()
+    poller.register(WAKE_FDS[0], select.POLLIN)
+    registered = set()
+
+    while True:
+        # children without a pidfd (no pidfd_open, or it failed) give poll()
+        # nothing to wait on, so check back every 100ms while any is running
+        with CHILDREN_LOCK:
+            if any(child[2] is None for child in CHILDREN.values()):
+                timeout = 100
+            else:
+                timeout = None
+
+        for fd, _ in poller.poll(timeout):
+            if fd == WAKE_FDS[0]:
+                os.read(fd, 512)
+
+        with CHILDREN_LOCK:
+            children = list(CHILDREN.items())
+
+        for pid, (name, start, pidfd) in children:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+
+            if done:
+                pidfd = finish(pid)
+
+                if pidfd is not None:
+                    if pidfd in registered:
+                        poller.unregister(pidfd)
+                        registered.discard(pidfd)
+
+                    os.close(pidfd)
+            elif pidfd is not None and not pidfd in registered:
+                poller.register(pidfd, select.POLLIN)
+                registered.add(pidfd)
+
+def startReaper():
+    global WAKE_FDS
+
+    WAKE_FDS = os.pipe()
+
+    thread = threading.Thread(target=reapChildren)
+    thread.daemon = True
+    thread.start()
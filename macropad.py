@@ -2,12 +2,28 @@
 
 import subprocess
 import threading
+import selectors
+import fnmatch
+import asyncio
+import signal
+import select
+import queue
+import shlex
 import evdev
 import time
 import sys
-import grp
 import os
 
+import configfile
+import launcher
+import events
+import focus
+import gestures
+import output
+import hotplug
+import textinput
+import timers
+
 
 if "--no-i3" in sys.argv:
     I3_ENABLED = False
@@ -23,30 +39,57 @@ VERSION = 1.1
 DEBUG = False
 ASSIST_MODE = False
 NO_GROUP = False # for skipping `input` group checking
-PASSTHROUGH = False
-USING_DEVICE_NAME = False
+ASYNC_MODE = False
+WATCH_CONFIG = False # reload the config when it changes on disk
+DETECT_LIST = False # `--detect --list`, print what was found and exit
+DETECT_TIME = 1 # seconds to count key events for in --detect
+DAEMON_MODE = False # serve several configs as profiles, see control.py
+PROFILE_PATH = None # `--profile=<path>`, see profiler.py
+# optional subsystems, their modules are only imported when the flag is set
+METRICS_ENABLED = False # `--metrics`, see metrics.py
+STATUS_ENABLED = False # `--status`, see status.py
+PROFILER_ENABLED = False # `--profile`
 
 # enums
 KEY_UP = 0
 KEY_DOWN = 1
 KEY_HOLD = 2
+EV_KEY = evdev.ecodes.EV_KEY
+EV_SYN = evdev.ecodes.EV_SYN
 EVENT_LAYER_CHANGED = 1
 
-# reference list
-KEY_CODES = evdev.ecodes.keys.values()
-
 # maps
-KEY_MAP = {}
-KEY_CALLBACK_MAP = {}
 KEYEVENT_REMAP = {"ON_PRESS": KEY_DOWN,
         "ON_RELEASE": KEY_UP,
-        "ON_HOLD": KEY_HOLD}
+        "ON_HOLD": KEY_HOLD,
+        "ON_TAP": gestures.TAP,
+        "ON_LONG_PRESS": gestures.LONG_PRESS,
+        "ON_DOUBLE_TAP": gestures.DOUBLE_TAP}
 COMMENT_MAP = {}
 LAYER_OPTIONS = {}
 EVENT_CALLBACKS = {}
+EVENT_BUS = events.Bus(lambda command: runCommand(command))
+
+# compiled from config.keyCallbackMap, see compileDispatch()
+#   DISPATCH is keyed by
+#   `device index << 32 | layer id << 18 | keycode << 3 | key state`
+#   and holds (inline actions, macro actions)
+DISPATCH = {}
+
+# keys bound on a layer, see readPassthrough(). config.slowKeys is keyed by
+# `device index << 18 | layer id` and holds (any bind, ON_HOLD binds).
+# published together with the current layer id as one tuple, the fast path
+# reads it without STATE_LOCK
+SLOW_KEYS = ({}, 0)
+NO_KEYS = (frozenset(), frozenset())
+READ_SIZE = output.EVENT.size * 64
+
+# taps, chords and sequences, see gestures.py. replaced by activateConfig()
+GESTURES = gestures.Engine({}, gestures.TIMES, None, None, None)
 
 # global
 CURRENT_LAYER = "default"
+CURRENT_LAYER_ID = 0
 LAYER_LOCK = False
 LOCKED_PLAYER = "default"
 DEFAULT_LAYER_TIMEOUT = 1.5
@@ -54,15 +97,254 @@ LAST_KEY_EVENT_TIME = 0
 START_TIMEOUT_ON_KEYPRESS = False
 HOT_LAYER = False
 UI = None
-WAIT_TIME = 0
+UI_LOCK = threading.Lock()
+STATE_LOCK = threading.RLock() # layer state, shared with the i3 thread
+LOOP = None # asyncio loop, in async mode
+LAYER_TIMER = None
+LAYER_DEADLINE = 0 # time.monotonic() when LAYER_TIMER fires
+TIMERS = None # timers.Timers, run by listen()
+FOCUS = None # focus.Focus, replaced by activateConfig()
+HOTPLUG = None # device watcher
+HOTPLUG_CHANGED = None # asyncio.Event, replaced after every hotplug change
+TYPE_DELAY = 0
+
+# macro executor
+#   what to do when a key is pressed while its last macro is still running:
+#   "queue" it behind the running one, "drop" the new press, or "cancel" the
+#   running macro and start over.
+MACRO_POLICIES = ("queue", "drop", "cancel")
+MACRO_POLICY = "queue"
+CONFIG = None
+CACHE_FORMAT = 6 # bump when Config or Action values change shape
+RELOAD_LOCK = threading.Lock()
+CONFIG_WATCHER = None # hotplug.Inotify on the config directories, --watch
+EXECUTORS = {} # device index -> Executor, started by submitMacro()
+RUNNING_MACROS = {}
+RUNNING_MACROS_LOCK = threading.Lock()
+CURRENT_MACRO = threading.local() # .macro, what an executor thread is running
+FIRING_KEY = None # (device index, keycode) whose inline actions are running
+RECORDING = None # recorder.Recording, while `RECORD` is on
+PROFILES = {} # --daemon: name -> (Config, passthrough flag per device)
+PROFILE = None # the active profile
+
+
+class Action:
+    # a single configured action. `inline` actions (layer changes) run on the
+    # listener thread, everything else runs on the macro executor.
+    __slots__ = ("kind", "value", "inline")
+
+    def __init__(self, kind, value, inline=False):
+        self.kind = kind
+        self.value = value
+        self.inline = inline
+
+    def __call__(self):
+        return ACTION_HANDLERS[self.kind](self.value)
+
+    def __reduce__(self):
+        # much faster to pickle than the default for __slots__ classes
+        return (Action, (self.kind, self.value, self.inline))
+
+    def __repr__(self):
+        if isinstance(self.value, bytes):
+            return "%s(%s)" % (self.kind.upper(), output.describe(self.value))
+
+        return "%s(%r)" % (self.kind.upper(), self.value)
+
+
+class Config:
+    # everything parseConfig() reads from a config and its includes. activateConfig()
+    # points the global maps at one of these.
+    def __init__(self, path):
+        self.path = path
+        self.keyCallbackMap = {}
+        self.deviceCallbackMap = {} # binds that only apply to one device
+        self.gestureSources = {} # (`BINDS` device, layer, gesture) -> position
+        self.commentMap = {}
+        self.layerOptions = {}
+        self.eventCallbacks = {}
+        self.eventWindow = .05 # `COALESCE`, in seconds
+        self.devices = [] # one per `DEVICE` block
+        self.layerIds = {"default": 0}
+        self.layerNames = ["default"]
+        self.layers = set() # layers with binds
+        self.dispatch = {}
+        self.slowKeys = {}
+        self.gestures = {} # device index << 18 | layer id -> gestures.Layer
+        self.gestureTimes = dict(gestures.TIMES)
+        self.virtualKeys = {} # `CHORD`/`SEQUENCE` name -> virtual keycode
+        self.focus = focus.Index()
+        self.layout = "us"
+        self.typeDelay = 0
+        self.macroPolicy = "queue"
+        self.directRun = False
+        self.bindCount = 0
+        self.files = ([], []) # configfile.Source.stamps(), INCLUDEs too
+        self.diagnostics = [] # configfile.Diagnostic
+
+    def errors(self):
+        return [diagnostic for diagnostic in self.diagnostics
+                if not diagnostic.warning]
+
+    def __getstate__(self):
+        # the cache only needs what compileDispatch() made of the binds
+        state = dict(self.__dict__)
+        state["keyCallbackMap"] = {}
+        state["deviceCallbackMap"] = {}
+        state["gestureSources"] = {}
+
+        return state
+
+
+class Macro:
+    def __init__(self, key, actions, event=None):
+        self.key = key
+        self.actions = actions
+        self.event = event # the key event that fired it, for metrics
+        self.queued = time.perf_counter()
+        self.cancelled = threading.Event()
+        self.hold = holdPoint(actions)
+
+
+class Executor:
+    # runs one device's macros in order on its own thread, so a WAIT on one
+    # device doesn't hold up the others. passthrough from the device is held
+    # back while a macro still has output to write before its first WAIT or
+    # command, see writePassthrough(). all of it is guarded by
+    # RUNNING_MACROS_LOCK.
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.count = 0 # macros queued or running
+        self.holding = [] # macros passthrough waits for, in order
+        self.held = [] # frames held back, with the macro they wait for
+        self.blocked = False # past a WAIT or command, nothing is held
+        self.thread = threading.Thread(target=runMacros, args=(self,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, macro):
+        if macro.hold >= 0 and not self.blocked:
+            # frames typed before this macro go out before it
+            if self.holding:
+                self.held.append(macro)
+
+            self.holding.append(macro)
+
+        self.count += 1
+        self.queue.put(macro)
+
+    def release(self, macro):
+        # the macro wrote its last frame, let out what was typed after it
+        if not self.holding or not self.holding[0] is macro:
+            return
 
+        del self.holding[0]
 
-def detectDevice():
-    maxEventCount = 0
-    bestDevice = None
-    bestDeviceName = None
-    loops = 5
+        if self.held and self.held[0] is macro:
+            del self.held[0]
+
+        frames = []
+
+        while self.held and not isinstance(self.held[0], Macro):
+            frames.append(self.held.pop(0))
+
+        self.flush(frames)
+
+    def block(self):
+        # a WAIT or command, passthrough doesn't wait for it or anything
+        # queued behind it
+        self.blocked = True
+
+        self.flush([data for data in self.held if not isinstance(data, Macro)])
+
+        self.holding.clear()
+        self.held.clear()
+
+    def flush(self, frames):
+        if frames:
+            output.writeFrames(UI, frames, UI_LOCK)
+
+
+def findStablePaths():
+    # event node -> /dev/input/by-id/ link, for devices that have one
     baseDir = "/dev/input/by-id/"
+    paths = {}
+
+    try:
+        names = sorted(os.listdir(baseDir))
+    except OSError:
+        return paths
+
+    for name in names:
+        path = os.path.join(baseDir, name)
+        paths.setdefault(os.path.realpath(path), path)
+
+    return paths
+
+def scanDevices(seconds=DETECT_TIME):
+    # count key presses and repeats on every input device at once, for
+    # `seconds`. returns [(count, name, path)] with the busiest device first,
+    # leaving out devices that saw no keys.
+    selector = selectors.DefaultSelector()
+    stablePaths = findStablePaths()
+    devices = []
+    counts = [] # [device, key events]
+
+    try:
+        for path in evdev.list_devices():
+            try:
+                device = evdev.InputDevice(path)
+            except OSError as e:
+                print("Could not open device: %s" % e)
+
+                continue
+
+            devices.append(device)
+
+            # no keys, nothing to count
+            if not EV_KEY in device.capabilities():
+                continue
+
+            entry = [device, 0]
+            counts.append(entry)
+            selector.register(device.fd, selectors.EVENT_READ, entry)
+
+        deadline = time.monotonic() + seconds
+
+        while counts:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            for key, _ in selector.select(timeout):
+                entry = key.data
+                device = entry[0]
+
+                try:
+                    for event in device.read():
+                        if event.type == EV_KEY and event.value:
+                            entry[1] += 1
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    # unplugged during the scan
+                    selector.unregister(device.fd)
+    finally:
+        selector.close()
+
+        results = [(count, device.name, stablePaths.get(device.path, device.path))
+                for device, count in counts if count]
+
+        for device in devices:
+            device.close()
+
+    results.sort(key=lambda result: -result[0])
+
+    return results
+
+def detectDevice():
+    import grp
 
     # check if user is part of `input` group
     groups = [grp.getgrgid(g).gr_name for g in os.getgroups()]
@@ -74,23 +356,18 @@ def detectDevice():
 
         return
 
+    if DETECT_LIST:
+        # for scripts: hold a key while this runs
+        for count, name, path in scanDevices():
+            print("%i\t%s\t%s" % (count, name, path))
+
+        return
+
     print("Welcome to MacroPad-detect")
     print("\nMake sure your device is plugged in or turned on, then press ENTER.")
 
     input()
 
-    print("Is your device connected via Bluetooth? y/(n)")
-
-    bluetooth = input().lower() == 'y'
-
-    if bluetooth:
-        print("\nTake note that non-Bluetooth devices can still be detected in this mode.\n")
-
-        devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
-    else:
-        devices = [os.path.join(baseDir, p) for p in os.listdir(baseDir)]
-
-    print("** A total of %i devices were detected. **\n" % len(devices))
     print("MacroPad will now help you select the device you want to config.")
     print("\n1) Press ENTER")
     print("2) Hold down a key on the device you want to select")
@@ -106,41 +383,21 @@ def detectDevice():
 
     print("\nPress and hold a key on your device.")
 
-    while loops:
-        loops -= 1
-
-        for _device in devices:
-            if bluetooth:
-                device = _device
-            else:
-                try:
-                    device = evdev.device.InputDevice(_device)
-                except Exception as e:
-                    print("Could not open device: %s" % e)
-
-                    continue
-
-            try:
-                eventCount = 0
-
-                for event in device.read():
-                    eventCount += 1
-
-                if eventCount > maxEventCount:
-                    maxEventCount = eventCount
-                    bestDevice = device
-                    bestDeviceName = device.name
-            except BlockingIOError:
-                pass
-
-            time.sleep(.01)
+    results = scanDevices()
 
-    if not bestDevice:
+    if not results:
         print("\nNo device found.")
 
         return
 
+    count, bestDeviceName, bestDevicePath = results[0]
+
     print("\nDevice found: %s" % bestDeviceName)
+
+    if len(results) > 1:
+        print("(%i key events, next best: %s with %i)" % (count, results[1][1],
+            results[1][0]))
+
     print("\nMacroPad will now generate a config file for this device.")
 
     fileName = input("Enter file name: ")
@@ -148,10 +405,11 @@ def detectDevice():
     try:
         configFile = open(fileName, 'w')
 
-        if bluetooth:
-            configFile.write("DEVICE {\n\tNAME %s\n}\n\n" % bestDeviceName)
+        # devices without a by-id link (Bluetooth) are opened by name
+        if bestDevicePath.startswith("/dev/input/by-id/"):
+            configFile.write("DEVICE {\n\tPATH %s\n}\n\n" % bestDevicePath)
         else:
-            configFile.write("DEVICE {\n\tPATH %s\n}\n\n" % bestDeviceName)
+            configFile.write("DEVICE {\n\tNAME %s\n}\n\n" % bestDeviceName)
 
         configFile.write("BINDS {\n\n}\n")
 
@@ -162,589 +420,2012 @@ def detectDevice():
     except Exception as e:
         print(e)
 
-def loadConfig(filePath):
-    if not os.path.isfile(filePath):
-        print("Can't find file: %s" % filePath)
+class ConfigBuilder:
+    # turns the tree configfile.load() made into a Config. the scope is a
+    # dict of what the enclosing blocks selected: section, device, binds,
+    # layer, key and block (the innermost block's keyword).
+    def __init__(self, config, source):
+        self.config = config
+        self.source = source
+        self.path = source.path # the file being walked
+        self.devices = [] # (device, path, node), checked at the end
+        self.binds = [] # (`BINDS` device name, path, node), same
+        self.texts = [] # (`TYPE` action, path, node), compiled at the end
+        self.reported = set()
+
+    def error(self, node, message, column=None, warning=False):
+        column = node.column if column is None else column
+
+        # a file included twice only says it once
+        if (self.path, node.line, column, message) in self.reported:
+            return
 
-        return
+        self.reported.add((self.path, node.line, column, message))
+        self.config.diagnostics.append(configfile.Diagnostic(self.path,
+            node.line, column, message, warning))
+
+    def number(self, node, value, scale=1):
+        try:
+            return float(value) * scale
+        except ValueError:
+            self.error(node, "not a number: %s" % value, node.valueColumn)
+
+            return None
+
+    def walk(self, nodes, scope):
+        for node in nodes:
+            if node.kind == configfile.STATEMENT:
+                if scope["section"] is None:
+                    if not self.setting(node, node.name.lower()):
+                        self.error(node, "`%s` outside of a section" % node.name)
+                elif node.value is None:
+                    self.word(node, scope)
+                else:
+                    self.statement(node, scope)
+            elif node.kind == configfile.BLOCK:
+                self.block(node, scope)
+            else:
+                path = self.path
+
+                for included in self.source.included.get(node, ()):
+                    self.path = included.path
+                    self.walk(included.nodes, scope)
+
+                self.path = path
+
+    def block(self, node, scope):
+        keyword = node.name.lower()
+        first = keyword.split(' ')[0]
+        section = scope["section"]
+
+        if section is None:
+            if first == "device":
+                device = addDevice(self.config, node.name.split(' ', 1)[1:])
+                self.devices.append((device, self.path, node))
+                scope = dict(scope, section="device", device=device,
+                        block="device")
+            elif keyword == "events" or keyword == "focus":
+                scope = dict(scope, section=keyword, block=keyword)
+            elif first == "binds":
+                binds = (node.name.split(' ', 1)[1:] or [None])[0]
+
+                if binds:
+                    binds = binds.strip()
+                    self.binds.append((binds, self.path, node))
+
+                scope = dict(scope, section="binds", binds=binds or None,
+                        block="binds")
+            else:
+                self.error(node, "unknown section `%s`" % node.name)
 
-    configFile = open(filePath, 'r')
-    selectedDevice = None
-    selectedKey = None
-    selectedEvent = None
-    selectedLayer = "default"
-    selectedEvent = None
-    mode = "device"
-    parseStack = []
-    lineNum = 0
-    bindCount = 0
-
-    for line in configFile.readlines():
-        lineNum += 1
-        line = line.lstrip().rstrip() # remove newlines
-
-        if not len(line):
-            continue
+                return
+        elif section == "binds":
+            if keyword.startswith("key_"):
+                if not keyword.upper() in evdev.ecodes.ecodes:
+                    self.error(node, "unknown keycode: %s" % node.name)
 
-        if line.startswith('#'):
-            continue
+                    return
 
-        if line.endswith('{'):
-            keyword = line.split('{')[0].rstrip().lower()
+                scope = dict(scope, key=keyword.upper(), block=keyword)
+            elif keyword.upper().startswith(gestures.PREFIXES):
+                name = gestures.keyName(keyword)
 
-            # print("Parsing: %s" % keyword)
+                if not gestures.parseName(name):
+                    self.error(node, "bad gesture: %s" % node.name)
 
-            if keyword == "device":
-                mode = "device"
-            elif keyword == "events":
-                mode = "events"
-            elif keyword == "binds":
-                mode = "binds"
+                    return
 
-            if mode == "binds":
-                if keyword.startswith("key_"):
-                    selectedKey = keyword.upper()
+                # for compileDispatch(), it can run out of virtual keycodes
+                self.config.gestureSources.setdefault((scope["binds"],
+                    scope["layer"], name), (self.path, node.line, node.column))
 
-                    # print("Selected key: %s" % selectedKey)
+                scope = dict(scope, key=name, block=keyword)
+            elif first == "layer":
+                layer = keyword.split(' ')[1:]
 
-                    parseStack.append(keyword)
-                elif keyword.startswith("layer"):
-                    selectedLayer = keyword.split(' ')[1]
+                if not layer or not layer[0]:
+                    self.error(node, "LAYER needs a name")
 
-                    # print("Selected layer: %s" % selectedLayer)
+                    return
 
-                    parseStack.append("layer")
-                else:
-                    parseStack.append(keyword)
-            elif mode == "events":
-                parseStack.append(keyword)
+                scope = dict(scope, layer=layer[0], key=None, block="layer")
+            elif keyword.upper() in KEYEVENT_REMAP:
+                if not scope["key"]:
+                    self.error(node, "`%s` outside of a key" % node.name)
+
+                    return
+
+                scope = dict(scope, block=keyword)
             else:
-                parseStack.append(keyword)
+                self.error(node, "unknown block `%s`" % node.name)
 
-            continue
+                return
+        elif section == "events" and keyword == "layer_changed":
+            scope = dict(scope, block=keyword)
+        else:
+            self.error(node, "unknown block `%s` in section `%s`" % (node.name,
+                section))
+
+            return
+
+        self.walk(node.children, scope)
+
+    def word(self, node, scope):
+        # statements without a value
+        word = node.name.lower()
+        block = scope["block"]
+
+        if block == "device" and word == "passthrough":
+            scope["device"]["passthrough"] = True
+        elif block == "device" and self.setting(node, word):
+            self.shared(node)
+        elif block == "layer" and word == "start_timeout_on_keypress":
+            if not setLayerOption(self.config, scope["layer"], word, True):
+                self.error(node, "already set %s on layer `%s`" % (word,
+                    scope["layer"]), warning=True)
+        elif block in ("device", "layer"):
+            self.error(node, "unknown command in section `%s`: %s" % (block,
+                node.name))
+        else:
+            self.error(node, "ignoring `%s`" % node.name, warning=True)
+
+    def statement(self, node, scope):
+        key = node.name.lower()
+        section = scope["section"]
+
+        if section == "binds":
+            self.bind(node, key, scope)
+        elif section == "device":
+            self.option(node, key, scope["device"])
+        elif section == "focus":
+            if key in focus.FIELDS:
+                error = self.config.focus.addRule(key, node.value)
+
+                if error:
+                    self.error(node, error, node.valueColumn)
+            elif key == "debounce":
+                debounce = self.number(node, node.value, .001)
+
+                if debounce is not None:
+                    self.config.focus.debounce = debounce
+            else:
+                self.error(node, "unknown key in section `focus`: %s" % node.name)
+        elif scope["block"] == "layer_changed":
+            self.event(node, key)
+        elif key == "coalesce":
+            window = self.number(node, node.value, .001)
+
+            if window is not None:
+                self.config.eventWindow = window
+        else:
+            self.error(node, "unknown key in section `events`: %s" % node.name)
+
+    def option(self, node, key, device):
+        value = node.value
+
+        if key == "path":
+            device["path"] = value
+        elif key == "name":
+            device["path"] = value
+            device["byName"] = True
+        elif self.setting(node, key):
+            self.shared(node)
+        else:
+            self.error(node, "unknown key in section `device`: %s" % node.name)
+
+    def shared(self, node):
+        # still honoured, older configs only had the one DEVICE to put it in
+        self.error(node, "`%s` applies to every device, set it outside of "
+                "`DEVICE`" % node.name, warning=True)
+
+    def setting(self, node, key):
+        # options for the whole config, False if `key` isn't one
+        config = self.config
+        value = node.value
+
+        if value is None:
+            if key != "direct_run":
+                return False
 
-        parsing = parseStack[len(parseStack) - 1]
+            config.directRun = True
+        elif key == "layout":
+            value = value.lower()
 
-        if line.endswith('}'):
-            parseStack.pop()
+            if not value in textinput.LAYOUTS:
+                self.error(node, "unknown layout: %s" % value, node.valueColumn)
+            else:
+                config.layout = value
+        elif key == "type_delay" or key in gestures.TIMES:
+            value = self.number(node, value, .001)
 
-            if parsing == "binds":
-                selectedKey = None
-            elif parsing == "device":
+            if value is None:
                 pass
-            elif parsing == "layer":
-                selectedLayer = "default"
+            elif key == "type_delay":
+                config.typeDelay = value
+            else:
+                config.gestureTimes[key] = value
+        elif key == "macro_policy":
+            value = value.lower()
 
-            continue
+            if not value in MACRO_POLICIES:
+                self.error(node, "unknown macro policy: %s" % value,
+                        node.valueColumn)
+            else:
+                config.macroPolicy = value
+        else:
+            return False
 
-        if not parsing:
-            print("Not parsing: %s" % line)
+        return True
 
-            continue
+    def bind(self, node, key, scope):
+        config = self.config
+        value = node.value
+        block = scope["block"].upper()
+        assign = lambda state, action: assignKey(config, scope["binds"],
+                scope["layer"], scope["key"], state, action)
 
-        if not ' ' in line:
-            if parsing == "device":
-                line = line.lower()
+        if block in KEYEVENT_REMAP:
+            state = KEYEVENT_REMAP[block]
 
-                if line == "passthrough":
-                    global PASSTHROUGH
+            # TYPE, KEY and WAIT always fired on press, even in ON_RELEASE
+            # and ON_HOLD
+            pressState = KEY_DOWN if state in (KEY_UP, KEY_HOLD) else state
 
-                    PASSTHROUGH = True
-                else:
-                    print("Unknown command in section `device`: %s" % line)
+            if key == "type":
+                # LAYOUT can still come later in the file
+                action = Action("type", unquote(value))
+                self.texts.append((action, self.path, node))
 
-                    return
-            elif parsing == "layer":
-                line = line.lower()
+                assign(pressState, action)
+            elif key == "key":
+                codes = output.resolve(value)
 
-                if line == "start_timeout_on_keypress":
-                    setLayerOption(selectedLayer, line, True)
-                else:
-                    print("Unknown command in section `%s`: %s" % (parsing, line))
+                if not codes:
+                    self.error(node, "unknown keycode: %s" % value,
+                            node.valueColumn)
 
                     return
 
-            continue
+                # press and release are one action so that cancelling a
+                # macro can never leave a key held down
+                assign(pressState, Action("key", output.chord(codes, KEY_DOWN) +
+                    output.chord(codes, KEY_UP)))
+            elif key in ("layer", "modelayer", "hotlayer"):
+                assign(state, Action(key, value, inline=True))
+            elif key == "run":
+                assign(state, Action("run", value))
+            elif key == "i3":
+                assign(state, Action("i3", (value,)))
+            elif key == "wait":
+                seconds = self.number(node, value)
+
+                if seconds is None:
+                    return
+
+                assign(pressState, Action("wait", seconds))
+            elif key == "record":
+                import recorder
 
-        key, _, value = line.partition(' ')
-        key = key.lower()
+                assign(pressState, Action("record",
+                    recorder.macroPath(value.strip()), inline=True))
+            elif key == "replay":
+                # `REPLAY <name> [speed]`, 0 is as fast as possible
+                import recorder
 
-        if mode == "device":
-            if key == "path":
-                selectedDevice = value
-            elif key == "name":
-                selectedDevice = value
+                name, _, speed = value.partition(' ')
+                speed = self.number(node, speed or 1)
 
-                global USING_DEVICE_NAME
+                if speed is None:
+                    return
 
-                USING_DEVICE_NAME = True
+                assign(pressState, Action("replay", (recorder.macroPath(name),
+                    speed)))
             else:
-                print("Unknown key in section `device`: %s" % key)
+                self.error(node, "unknown action: %s" % node.name)
 
                 return
 
-            continue
-        elif mode == "binds":
-            if parsing.upper() in KEYEVENT_REMAP:
-                if key == "type":
-                    assignKey(selectedLayer, selectedKey, KEY_DOWN,
-                            lambda text=value, state=KEY_DOWN: type(text))
-                elif key == "key":
-                    binds = value.split('+')
-                    assignKey(selectedLayer, selectedKey, KEY_DOWN,
-                            lambda keyCode=binds, state=KEY_DOWN: keyInput("key",
-                                keyCode, state))
-                    assignKey(selectedLayer, selectedKey, KEY_DOWN,
-                            lambda keyCode=binds, state=KEY_UP: keyInput("key",
-                                keyCode, state))
-                elif key == "layer":
-                    assignKey(selectedLayer, selectedKey,
-                            KEYEVENT_REMAP[parsing.upper()],
-                            lambda layer=value: setLayer(layer))
-                elif key == "modelayer":
-                    assignKey(selectedLayer, selectedKey,
-                            KEYEVENT_REMAP[parsing.upper()],
-                            lambda layer=value: setLayer(layer, lock=True))
-                elif key == "hotlayer":
-                    assignKey(selectedLayer, selectedKey,
-                            KEYEVENT_REMAP[parsing.upper()],
-                            lambda layer=value: setLayer(layer, hot=True))
-                elif key == "run":
-                    assignKey(selectedLayer, selectedKey,
-                            KEYEVENT_REMAP[parsing.upper()],
-                            lambda value=value: runCommand(value))
-                elif key == "wait":
-                    assignKey(selectedLayer, selectedKey, KEY_DOWN,
-                            lambda text=value, state=KEY_DOWN: wait(float(text)))
-                else:
-                    print("Unknown: line %i:" % lineNum, key, value)
-                    return
+            config.bindCount += 1
+        elif key == "bind":
+            codes = output.resolve(value)
 
-                bindCount += 1
-            elif key == "bind":
-                binds = value.split('+')
-                assignKey(selectedLayer, selectedKey, KEY_DOWN,
-                        lambda keyCode=binds, state=KEY_DOWN: keyInput("key",
-                            keyCode, state))
-                assignKey(selectedLayer, selectedKey, KEY_HOLD,
-                        lambda keyCode=binds, state=KEY_HOLD: keyInput("key",
-                            keyCode, state))
-                assignKey(selectedLayer, selectedKey, KEY_UP,
-                        lambda keyCode=binds, state=KEY_UP: keyInput("key",
-                            keyCode, state))
-                bindCount += 1
-            elif key == "comment":
-                assignComment(selectedLayer, selectedKey, value)
-            elif key == "timeout":
-                setLayerOption(selectedLayer, "timeout", float(value))
+            if not codes:
+                self.error(node, "unknown keycode: %s" % value, node.valueColumn)
+            elif not scope["key"]:
+                self.error(node, "BIND outside of a key")
             else:
-                print("Unknown key on line %i: %s" % (lineNum, key))
-                return
-        elif mode == "events":
-            if parsing == "layer_changed":
-                if key == "run":
-                    addEventCallback(EVENT_LAYER_CHANGED, "run", value)
-                else:
-                    print("Unknown key on line %i: %s" % (lineNum, key))
-                    return
-            else:
-                print("Unknown parsing layer on line %i: %s" % (lineNum, parsing))
-                return
-        else:
-            print("Unknown parsing layer on line %i: %s - %s" % (lineNum, key, value))
-            return
+                for state in (KEY_DOWN, KEY_HOLD, KEY_UP):
+                    assign(state, Action("bind", output.chord(codes, state)))
+
+                config.bindCount += 1
+        elif key == "comment":
+            if not assignComment(config, scope["layer"], scope["key"], value):
+                self.error(node, "already assigned comment to %s - %s" % (
+                    scope["layer"], scope["key"]), warning=True)
+        elif key == "timeout":
+            timeout = self.number(node, value)
 
-    configFile.close()
+            if timeout is not None and not setLayerOption(config,
+                    scope["layer"], "timeout", timeout):
+                self.error(node, "already set timeout on layer `%s`" %
+                        scope["layer"], warning=True)
+        else:
+            self.error(node, "unknown key: %s" % node.name)
 
-    if not DEBUG:
-        print("Loaded %i bind%s." % (bindCount, 's' * (bindCount != 1)))
+    def event(self, node, key):
+        value = node.value
 
-    main(selectedDevice)
+        if key == "run":
+            addEventCallback(self.config, EVENT_LAYER_CHANGED, "run", value)
+        elif key in ("write", "send"):
+            # `WRITE <path> [text]`, the text defaults to the layer
+            path, _, text = value.partition(' ')
 
-def handleKey(event, debug=False):
-    global START_TIMEOUT_ON_KEYPRESS
-    global LAST_KEY_EVENT_TIME
-    global HOT_LAYER
-    global WAIT_TIME
+            addEventCallback(self.config, EVENT_LAYER_CHANGED, key,
+                    (os.path.expanduser(path), text.strip() or "%LAYER%"))
+        elif key == "signal":
+            target = events.parseSignal(value)
 
-    now = time.time()
-    last_hit = now
+            if not target:
+                self.error(node, "unknown signal: %s" % value, node.valueColumn)
+            else:
+                addEventCallback(self.config, EVENT_LAYER_CHANGED, "signal",
+                        target)
+        else:
+            self.error(node, "unknown key in `LAYER_CHANGED`: %s" % node.name)
 
-    if not event.keycode in KEY_MAP:
-        KEY_MAP[event.keycode] = {"state": event.keystate, "last_hit": now}
-    else:
-        last_hit = KEY_MAP[event.keycode]["last_hit"]
+    def finish(self):
+        config = self.config
+        names = [device["name"] for device in config.devices]
 
-        KEY_MAP[event.keycode]["state"] = event.keystate
-        KEY_MAP[event.keycode]["last_hit"] = now
+        for device, path, node in self.devices:
+            self.path = path
 
-    # if the amount of time since the last pressed key is
-    # greater than some amount, then switch back to the default
-    # layer.
-    # this prevents lingering inputs from affecting future inputs.
-    timeout = getLayerTimeout(CURRENT_LAYER)
+            if not device["path"]:
+                self.error(node, "missing PATH or NAME for device `%s`" %
+                        device["name"])
 
-    if now - LAST_KEY_EVENT_TIME >= timeout:
-        if START_TIMEOUT_ON_KEYPRESS:
-            START_TIMEOUT_ON_KEYPRESS = False
-            # print("debug: waiting until next keypress")
-        else:
-            if debug and HOT_LAYER:
-                print("Hot layer reset!")
+        for name, path, node in self.binds:
+            self.path = path
 
-            HOT_LAYER = False
-            if LAYER_LOCK:
-                if not CURRENT_LAYER == LOCKED_LAYER:
-                    setLayer(LOCKED_LAYER)
+            if not name in names:
+                self.error(node, "unknown device `%s`" % name)
 
-                    if debug:
-                        print("Returning to locked layer: %s" % LOCKED_LAYER)
-            elif not CURRENT_LAYER == "default":
-                setLayer("default")
+        for action, path, node in self.texts:
+            self.path = path
+            missing = textinput.missing(action.value, config.layout)
 
-    # track whether we fired a macro in case the user specified `PASSTHROUGH`
-    fired = False
+            if missing:
+                # fall back to xdotool for anything the layout can't type
+                self.error(node, "can't type %s with layout `%s`, using xdotool"
+                        % (repr("".join(missing)), config.layout),
+                        node.valueColumn, True)
 
-    if debug:
-        if KEY_MAP[event.keycode]["state"] == KEY_DOWN:
-            print("%s - KEY_DOWN" % event.keycode)
-        elif KEY_MAP[event.keycode]["state"] == KEY_HOLD:
-            print("%s - KEY_HOLD" % event.keycode)
-        elif KEY_MAP[event.keycode]["state"] == KEY_UP:
-            print("%s - KEY_UP" % event.keycode)
+                action.kind = "xdotool"
+                action.value = node.value
+            else:
+                action.value = textinput.compile(action.value, config.layout)
 
-        # do this so we don't pass keycodes to the system
-        fired = True
-    else:
-        if event.keycode in KEY_CALLBACK_MAP[CURRENT_LAYER]:
-            if event.keystate in KEY_CALLBACK_MAP[CURRENT_LAYER][event.keycode]:
-                fired = True
-                resetLayer = False
+        if self.source.root and not config.devices:
+            config.diagnostics.append(configfile.Diagnostic(self.source.path,
+                0, 0, "no `DEVICE` section"))
 
-                # pull callbacks out of the dictionary and call them
-                for callback in KEY_CALLBACK_MAP[CURRENT_LAYER][event.keycode][event.keystate]:
-                    if callback():
-                        resetLayer = True
 
-                    if WAIT_TIME:
-                        time.sleep(WAIT_TIME)
+def parseConfig(filePath):
+    # reads a config and everything it includes into a new Config, the
+    # running one is left alone. problems are collected in config.diagnostics
+    # instead of stopping at the first one.
+    config = Config(filePath)
+    source = configfile.load(filePath)
+    builder = ConfigBuilder(config, source)
 
-                        WAIT_TIME = 0
-                    else:
-                        time.sleep(.01)
+    config.files = source.stamps()
+    config.diagnostics.extend(source.diagnostics)
 
-                # record the time at which the event was executed. see above
-                LAST_KEY_EVENT_TIME = now
+    if source.root:
+        builder.walk(source.root.nodes, {"section": None, "device": None,
+            "binds": None, "layer": "default", "key": None, "block": None})
 
-                if resetLayer:
-                    if not (LAYER_LOCK or HOT_LAYER):
-                        setLayer("default")
+    builder.finish()
 
-    return fired
+    if not config.errors():
+        compileDispatch(config)
 
-def assignComment(layer, keycode, value):
-    if not layer in COMMENT_MAP:
-        COMMENT_MAP[layer] = {}
+    return config
 
-    if not keycode in COMMENT_MAP[layer]:
-        COMMENT_MAP[layer][keycode] = value
+def loadConfig(filePath):
+    if not os.path.isfile(filePath):
+        print("Can't find file: %s" % filePath)
 
         return
 
-    print("WARNING: already assigned comment to %s - %s" % (layer, keycode))
+    config = loadCachedConfig(filePath)
 
-def addEventCallback(event, command, value):
-    if not event in EVENT_CALLBACKS:
-        EVENT_CALLBACKS[event] = []
+    if config:
+        # only configs without errors are cached, their warnings still count
+        for diagnostic in config.diagnostics:
+            print(diagnostic)
+    else:
+        config = parseConfig(filePath)
+        errors = config.errors()
 
-    EVENT_CALLBACKS[event].append({"command": command, "value": value})
+        for diagnostic in config.diagnostics:
+            print(diagnostic)
 
-def triggerEventCallback(event):
-    if not event in EVENT_CALLBACKS:
-        return
+        if errors:
+            print("%i error%s, not loading %s" % (len(errors),
+                's' * (len(errors) != 1), filePath))
 
-    for callback in EVENT_CALLBACKS[event]:
-        newValue = callback["value"]
-        newValue = newValue.replace("%LAYER%", CURRENT_LAYER)
+            return
 
-        if callback["command"] == "run":
-            runCommand(newValue)
+        saveCachedConfig(config)
 
-def setLayerOption(layer, key, value):
-    if not layer in LAYER_OPTIONS:
-        LAYER_OPTIONS[layer] = {}
+    if not DEBUG:
+        print("Loaded %i bind%s." % (config.bindCount,
+            's' * (config.bindCount != 1)))
 
-    if not key in LAYER_OPTIONS[layer]:
-        LAYER_OPTIONS[layer][key] = value
+    return config
 
-        return
+def getCachePath(filePath):
+    # the cache lives next to the config: `example.conf` -> `.example.conf.cache`
+    directory, name = os.path.split(os.path.abspath(filePath))
 
-    print("WARNING: already assigned %s to %s - %s" % (key, layer, value))
+    return os.path.join(directory, ".%s.cache" % name)
 
-def applyLayerOptions(layer):
-    if not layer in LAYER_OPTIONS:
-        return
+def getCacheKey(filePath):
+    # the files it was read from are checked separately, see config.files
+    return (VERSION, CACHE_FORMAT, os.path.abspath(filePath))
 
-    for key in LAYER_OPTIONS[layer].keys():
-        if key == "start_timeout_on_keypress":
-            global START_TIMEOUT_ON_KEYPRESS
+def loadCachedConfig(filePath):
+    cachePath = getCachePath(filePath)
 
-            START_TIMEOUT_ON_KEYPRESS = True
-        elif key == "timeout":
-            pass
-        else:
-            print("Warning: Unhandled option: %s" % key)
+    try:
+        cacheFile = open(cachePath, 'rb')
+    except OSError:
+        return None
 
-def getLayerTimeout(layer):
-    if layer in LAYER_OPTIONS and "timeout" in LAYER_OPTIONS[layer]:
-        return LAYER_OPTIONS[layer]["timeout"]
+    try:
+        # only trust caches we wrote ourselves
+        if os.fstat(cacheFile.fileno()).st_uid != os.getuid():
+            return None
 
-    return DEFAULT_LAYER_TIMEOUT
+        import pickle
 
-def assignKey(layer, keycode, state, callback):
-    assert(keycode != None)
+        key, config = pickle.load(cacheFile)
+    except Exception as e:
+        if DEBUG:
+            print("Ignoring config cache: %s" % e)
 
-    if not layer in KEY_CALLBACK_MAP:
-        KEY_CALLBACK_MAP[layer] = {}
+        return None
+    finally:
+        cacheFile.close()
 
-    if not keycode in KEY_CALLBACK_MAP[layer]:
-        KEY_CALLBACK_MAP[layer][keycode] = {}
+    if key != getCacheKey(filePath) or not configfile.unchanged(config.files):
+        return None
 
-    if not state in KEY_CALLBACK_MAP[layer][keycode]:
-        KEY_CALLBACK_MAP[layer][keycode][state] = []
+    return config
 
-    KEY_CALLBACK_MAP[layer][keycode][state].append(callback)
+def saveCachedConfig(config):
+    import pickle
 
-def showLayer():
-    timeout = getLayerTimeout(CURRENT_LAYER)
-    subprocess.Popen("notify-send -t %i \"%s\"" % (timeout * 1000,
-        CURRENT_LAYER), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cachePath = getCachePath(config.path)
+    tempPath = "%s.%i" % (cachePath, os.getpid())
 
-    print('\x1b[2J') # clear terminal
-    print(CURRENT_LAYER + '\n')
+    try:
+        with open(tempPath, 'wb') as cacheFile:
+            pickle.dump((getCacheKey(config.path), config), cacheFile,
+                    pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tempPath, cachePath)
+    except OSError as e:
+        # read-only config directories just don't get a cache
+        if DEBUG:
+            print("Can't write config cache: %s" % e)
+
+        try:
+            os.unlink(tempPath)
+        except OSError:
+            pass
 
-    if not CURRENT_LAYER in COMMENT_MAP:
-        print("No comments for this layer.")
-        return
+def handleKey(event, debug=False, device=0):
+    now = time.time()
 
-    keys = list(COMMENT_MAP[CURRENT_LAYER].keys())
-    keys.sort()
+    checkLayerTimeout(now, debug)
 
-    for key in keys:
-        print("[ %s ] %s" % (key.split("KEY_")[1], COMMENT_MAP[CURRENT_LAYER][key]))
+    if debug:
+        if event.value == KEY_DOWN:
+            print("%s - KEY_DOWN" % getKeyName(event.code))
+        elif event.value == KEY_HOLD:
+            print("%s - KEY_HOLD" % getKeyName(event.code))
+        elif event.value == KEY_UP:
+            print("%s - KEY_UP" % getKeyName(event.code))
 
-def setLayer(layer, lock=False, hot=False):
-    global CURRENT_LAYER
-    global LAYER_LOCK, LOCKED_LAYER, HOT_LAYER
+        # do this so we don't pass keycodes to the system
+        return True
 
-    lastLayer = CURRENT_LAYER
+    # only keys that can start a gesture wait for the engine to decide
+    if GESTURES.active or GESTURES.layers and \
+            GESTURES.wants(device, CURRENT_LAYER_ID, event.code):
+        if GESTURES.handle(event, device, CURRENT_LAYER_ID):
+            return True
 
-    layerChanged = not CURRENT_LAYER == layer
+    return fireKey(device, event.code, event.value, event)
 
-    CURRENT_LAYER = layer
+def fireKey(device, code, value, event=None):
+    # run what's bound to a key state or gesture on the current layer
+    global LAST_KEY_EVENT_TIME, FIRING_KEY
 
-    if layerChanged:
-        triggerEventCallback(EVENT_LAYER_CHANGED)
+    entry = DISPATCH.get(device << 32 | CURRENT_LAYER_ID << 18 | code << 3 | value)
 
-    applyLayerOptions(layer)
+    # track whether we fired a macro in case the user specified `PASSTHROUGH`
+    if entry is None:
+        return False
 
-    if lock:
-        LOCKED_LAYER = layer
-        # print("Locked layer: %s" % LOCKED_LAYER)
-        LAYER_LOCK = lock
-    elif layer == "default":
-        LAYER_LOCK = False
-        LOCKED_LAYER = layer
+    inlineActions, macroActions = entry
+    resetLayer = False
 
-    # or just assign hot_layer to hot value?
-    if hot:
-        HOT_LAYER = True
+    if inlineActions:
+        FIRING_KEY = (device, code)
 
-    # print("debug: layer = %s" % layer)
+    # layer changes happen right away so the next key lands on the
+    # right layer. everything else is handed to the executor as a
+    # single macro and runs off the listener thread.
+    for action in inlineActions:
+        if runAction(action):
+            resetLayer = True
 
-    # experimenting with osd for command readout
-    if ASSIST_MODE:
-        if not lastLayer == CURRENT_LAYER:
-            showLayer()
+    if macroActions:
+        resetLayer = True
 
-    return 0
+        if not writeNow(device, macroActions, event):
+            submitMacro((device, code, value), macroActions, value == KEY_UP,
+                    event)
 
-# the following function wasn't written by me.
-# it can found in full at: https://stackoverflow.com/a/6011298
-def runCommand(command, event=None):
-    # do the UNIX double-fork magic, see Stevens' "Advanced 
-    # Programming in the UNIX Environment" for details (ISBN 0201563177)
-    try: 
-        pid = os.fork() 
-        if pid > 0:
-            # parent process, return and keep running
-            os.waitid(os.P_PID, pid, os.WEXITED)
+    # record the time at which the event was executed. see above
+    LAST_KEY_EVENT_TIME = time.time()
 
-            return 1
-    except Exception as e:
-        print(e)
+    armLayerTimeout()
 
-        sys.exit(1)
+    if resetLayer:
+        if not (LAYER_LOCK or HOT_LAYER):
+            setLayer("default")
 
-    os.setsid()
+    return True
 
-    # do second fork
-    try: 
-        pid = os.fork() 
-        if pid > 0:
-            # exit from second parent
-            sys.exit(0) 
-    except Exception as e:
-        print(e)
+def runAction(action):
+    # an action, timed for --metrics and --profile
+    measure = METRICS_ENABLED
+    profile = PROFILER_ENABLED
 
-        sys.exit(1)
+    if measure:
+        start = time.perf_counter()
 
-    # do stuff
-    subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
+    if profile:
+        started = profiler.start()
 
-    # all done
-    os._exit(os.EX_OK)
+    result = action()
 
-    return 1
+    if profile:
+        profiler.stop(action.kind, started)
 
-def keyInput(event, keycodes, state):
-    for keycode in keycodes:
-        UI.write(evdev.ecodes.EV_KEY, evdev.ecodes.ecodes[keycode], state)
+    if measure:
+        metrics.observe("action.%s" % action.kind, time.perf_counter() - start)
 
-    UI.syn()
+    return result
 
-    return 1
+def writeNow(device, actions, event=None):
+    # macros that write to uinput in a single write go out from the
+    # listener, in order with passthrough
+    for action in actions:
+        if not (action.kind in ("bind", "key") or action.kind == "type" and
+                not TYPE_DELAY and len(action.value) <= output.FRAMES_PER_WRITE):
+            return False
 
-def type(text):
-    subprocess.call("xdotool type %s" % text, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
+    executor = EXECUTORS.get(device)
 
-    return 1
+    # held back with passthrough, they'd overtake it
+    if executor and executor.holding:
+        with RUNNING_MACROS_LOCK:
+            if executor.holding:
+                for action in actions:
+                    if action.kind == "type":
+                        executor.held.extend(action.value)
+                    else:
+                        executor.held.append(action.value)
 
-def wait(seconds):
-    global WAIT_TIME
+                return True
 
-    WAIT_TIME = seconds
+    for action in actions:
+        runAction(action)
 
-def getDeviceViaName(name):
-    devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
+    if METRICS_ENABLED and event:
+        metrics.observe("latency.uinput", time.time() - event.timestamp())
 
-    for device in devices:
-        if device.name == name:
-            return device
+    return True
 
-    print("Device not found: %s" % name)
+def writePassthrough(device, data):
+    # held back while a macro of the device still has output to write, so
+    # output stays in the order the keys were pressed
+    executor = EXECUTORS.get(device)
 
-    return None
+    if executor and executor.holding:
+        with RUNNING_MACROS_LOCK:
+            if executor.holding:
+                executor.held.append(data)
 
-def listen(devicePath):
-    # open the device via evdev
-    if USING_DEVICE_NAME:
-        while True:
-            device = getDeviceViaName(devicePath)
+                return
 
-            if device:
-                break
-            else:
-                print("Waiting")
-                time.sleep(1)
-    else:
-        device = evdev.InputDevice(devicePath)
+    with UI_LOCK:
+        output.write(UI, data)
 
-    if not device:
-        return
+def deliverKey(device, event):
+    # a key a gesture held back, then let go of
+    if not fireKey(device, event.code, event.value, event) and \
+            CONFIG.devices[device]["passthrough"]:
+        writePassthrough(device, output.pack([(event.code, event.value)]))
 
-    # start consuming all inputs from the device
-    try:
-        device.grab()
-    except Exception as e:
-        print(e)
+def gestureLater(delay, callback, *args):
+    # gesture timers change layer state like key events do
+    return callLater(delay, withStateLock, callback, *args)
 
-        return
+def withStateLock(callback, *args):
+    with STATE_LOCK:
+        callback(*args)
+
+def mergeI3Actions(actions):
+    # back-to-back `I3` actions go out as a single `;`-joined command
+    merged = []
+
+    for action in actions:
+        if merged and action.kind == "i3" and merged[-1].kind == "i3":
+            merged[-1] = Action("i3", merged[-1].value + action.value)
+        else:
+            merged.append(action)
+
+    return tuple(merged)
+
+def checkLayerTimeout(now, debug=False):
+    global START_TIMEOUT_ON_KEYPRESS
+    global HOT_LAYER
+
+    # if the amount of time since the last pressed key is
+    # greater than some amount, then switch back to the default
+    # layer.
+    # this prevents lingering inputs from affecting future inputs.
+    timeout = getLayerTimeout(CURRENT_LAYER)
+
+    if now - LAST_KEY_EVENT_TIME >= timeout:
+        if START_TIMEOUT_ON_KEYPRESS:
+            START_TIMEOUT_ON_KEYPRESS = False
+            # print("debug: waiting until next keypress")
+
+            # the timeout starts now
+            armLayerTimeout(timeout)
+        else:
+            if debug and HOT_LAYER:
+                print("Hot layer reset!")
+
+            HOT_LAYER = False
+            publishStatus()
+
+            if LAYER_LOCK:
+                if not CURRENT_LAYER == LOCKED_LAYER:
+                    setLayer(LOCKED_LAYER)
+
+                    if debug:
+                        print("Returning to locked layer: %s" % LOCKED_LAYER)
+            elif not CURRENT_LAYER == "default":
+                setLayer("default")
+
+def callLater(delay, callback, *args):
+    # on the asyncio loop in async mode, on listen()'s timers otherwise.
+    # returns None before either is running.
+    if LOOP:
+        return LOOP.call_later(delay, callback, *args)
+    elif TIMERS:
+        return TIMERS.callLater(delay, callback, *args)
+
+    return None
+
+def armLayerTimeout(delay=None):
+    # expire the layer when its timeout is up instead of waiting for the
+    # next key to notice
+    global LAYER_TIMER, LAYER_DEADLINE
+
+    if delay is None:
+        delay = getLayerTimeout(CURRENT_LAYER)
+
+    deadline = time.monotonic() + delay
+
+    # an earlier timer is left alone, expireLayer() pushes it back if keys
+    # came in since. that keeps typing from touching the timers at all.
+    if LAYER_TIMER and LAYER_DEADLINE <= deadline:
+        return
+
+    if LAYER_TIMER:
+        LAYER_TIMER.cancel()
+
+    LAYER_TIMER = callLater(delay, expireLayer)
+    LAYER_DEADLINE = deadline
+
+def expireLayer():
+    global LAYER_TIMER
+
+    with STATE_LOCK:
+        LAYER_TIMER = None
+
+        # a layer with START_TIMEOUT_ON_KEYPRESS waits for the next key
+        if START_TIMEOUT_ON_KEYPRESS:
+            return
+
+        now = time.time()
+        remaining = LAST_KEY_EVENT_TIME + getLayerTimeout(CURRENT_LAYER) - now
+
+        if remaining > 0:
+            armLayerTimeout(remaining)
+        else:
+            checkLayerTimeout(now, DEBUG)
+
+def getKeyName(code):
+    name = evdev.ecodes.bytype[evdev.ecodes.EV_KEY].get(code, code)
+
+    # some codes have more than one name, e.g. KEY_MUTE/KEY_MIN_INTERESTING
+    if isinstance(name, (list, tuple)):
+        return name[0]
+
+    return name
+
+def internLayer(layer, config=None):
+    if config is None:
+        config = CONFIG
+
+    if not layer in config.layerIds:
+        config.layerIds[layer] = len(config.layerNames)
+        config.layerNames.append(layer)
+
+    return config.layerIds[layer]
+
+def activateConfig(config):
+    # point the globals the listener reads at a loaded config
+    global CONFIG, COMMENT_MAP, LAYER_OPTIONS, EVENT_CALLBACKS
+    global DISPATCH, SLOW_KEYS, TYPE_DELAY, MACRO_POLICY
+    global CURRENT_LAYER_ID, GESTURES, FOCUS
+
+    CONFIG = config
+    COMMENT_MAP = config.commentMap
+    LAYER_OPTIONS = config.layerOptions
+    EVENT_CALLBACKS = config.eventCallbacks
+    EVENT_BUS.window = config.eventWindow
+    DISPATCH = config.dispatch
+    TYPE_DELAY = config.typeDelay
+    MACRO_POLICY = config.macroPolicy
+    CURRENT_LAYER_ID = internLayer(CURRENT_LAYER, config)
+    SLOW_KEYS = (config.slowKeys, CURRENT_LAYER_ID)
+    GESTURES.close()
+    GESTURES = gestures.Engine(config.gestures, config.gestureTimes, fireKey,
+            deliverKey, gestureLater)
+    FOCUS = focus.Focus(config.focus, config.layers, focusLayer, callLater,
+            METRICS_ENABLED and metrics.count or None)
+
+    launcher.DIRECT = config.directRun
+
+def addDevice(config, name):
+    # `DEVICE {` or `DEVICE <name> {`
+    if name and name[0].strip():
+        name = name[0].strip()
+    else:
+        name = "device%i" % len(config.devices)
+
+    device = {"name": name, "index": len(config.devices), "path": None,
+            "byName": False, "passthrough": False, "device": None,
+            "waiting": False, "pending": []}
+
+    config.devices.append(device)
+
+    return device
+
+def compileDispatch(config):
+    # flatten config.keyCallbackMap into one dict keyed by device, layer id, raw
+    # keycode and key state so the listener never has to look at names.
+    # binds in `BINDS <device>` replace shared ones for that device. only
+    # called once ConfigBuilder found no errors.
+    config.dispatch.clear()
+    config.slowKeys.clear()
+    config.gestures.clear()
+    config.virtualKeys.clear()
+
+    for device in config.devices:
+        for binds, callbackMap in ((None, config.keyCallbackMap),
+                (device["name"], config.deviceCallbackMap.get(device["name"], {}))):
+            for layer, keys in callbackMap.items():
+                layerId = internLayer(layer, config)
+                config.layers.add(layer)
+
+                for keycode, states in keys.items():
+                    layerKey = device["index"] << 18 | layerId
+
+                    if keycode.startswith(gestures.PREFIXES):
+                        code = gestures.compileGesture(config, layerKey, keycode)
+
+                        if code is None:
+                            path, line, column = config.gestureSources[(binds,
+                                layer, keycode)]
+                            config.diagnostics.append(configfile.Diagnostic(
+                                path, line, column,
+                                "too many chords and sequences, can't add %s "
+                                "in layer `%s`" % (keycode, layer)))
+
+                            return False
+                    else:
+                        code = evdev.ecodes.ecodes[keycode]
+
+                        gestures.addTapKey(config, layerKey, code, states)
+
+                    bound, held = config.slowKeys.setdefault(layerKey, (set(), set()))
+
+                    bound.add(code)
+
+                    if KEY_HOLD in states:
+                        held.add(code)
+
+                    for state, actions in states.items():
+                        config.dispatch[device["index"] << 32 | layerId << 18 |
+                                code << 3 | state] = (
+                                tuple(action for action in actions if action.inline),
+                                mergeI3Actions([action for action in actions
+                                    if not action.inline]))
+
+    # every event of a gesture key has to reach the engine, repeats included
+    for layerKey, layer in config.gestures.items():
+        bound, held = config.slowKeys.setdefault(layerKey, (set(), set()))
+
+        bound.update(layer.keys)
+        held.update(layer.keys)
+
+    return True
+
+def submitMacro(key, actions, force=False, event=None):
+    # `force` is used for key releases, which always have to go through or
+    # we'd risk leaving a bound key held down
+    with RUNNING_MACROS_LOCK:
+        running = RUNNING_MACROS.get(key)
+
+        if running and not force:
+            if MACRO_POLICY == "drop":
+                if METRICS_ENABLED:
+                    metrics.count("macros.dropped")
+
+                return False
+            elif MACRO_POLICY == "cancel":
+                running.cancelled.set()
+
+                if METRICS_ENABLED:
+                    metrics.count("macros.cancelled")
+
+        macro = Macro(key, actions, event)
+        RUNNING_MACROS[key] = macro
+
+        if not key[0] in EXECUTORS:
+            EXECUTORS[key[0]] = Executor()
+
+        EXECUTORS[key[0]].submit(macro)
+
+    if METRICS_ENABLED:
+        metrics.count("macros.queued")
+
+        if running:
+            metrics.count("macros.queued_behind")
+
+    return True
+
+def holdPoint(actions):
+    # index of the last action that writes to uinput before the first WAIT
+    # or command, -1 if there's none. passthrough waits until it has run.
+    hold = -1
+
+    for i, action in enumerate(actions):
+        if action.kind in ("key", "bind", "type") or \
+                action.kind == "replay" and not action.value[1]:
+            hold = i
+        elif not action.kind in ("layer", "modelayer", "hotlayer"):
+            break
+
+    return hold
+
+def macrosIdle():
+    with RUNNING_MACROS_LOCK:
+        return not any(executor.count for executor in EXECUTORS.values())
+
+def runMacros(executor):
+    while True:
+        macro = executor.queue.get()
+        CURRENT_MACRO.macro = macro
+        measure = METRICS_ENABLED
+        wrote = False
+
+        if measure:
+            metrics.observe("stage.queue", time.perf_counter() - macro.queued)
+
+        last = len(macro.actions) - 1
+
+        for i, action in enumerate(macro.actions):
+            if macro.cancelled.is_set():
+                break
+
+            if i > macro.hold and not executor.blocked and \
+                    not action.kind in ("layer", "modelayer", "hotlayer"):
+                with RUNNING_MACROS_LOCK:
+                    executor.block()
+
+            if action.kind == "wait":
+                # waiting on the event lets `cancel` cut a long WAIT short
+                if macro.cancelled.wait(action.value):
+                    break
+
+                continue
+
+            try:
+                runAction(action)
+            except Exception as e:
+                print(e)
+
+            if i == macro.hold:
+                with RUNNING_MACROS_LOCK:
+                    executor.release(macro)
+
+            # kernel timestamp to the first thing we wrote to uinput
+            if measure and not wrote and action.kind in OUTPUT_ACTIONS and \
+                    macro.event:
+                metrics.observe("latency.uinput",
+                        time.time() - macro.event.timestamp())
+
+                wrote = True
+
+            if i == last:
+                # nothing to space out, the next macro can start
+                break
+
+            if measure:
+                start = time.perf_counter()
+
+            if macro.cancelled.wait(.01):
+                break
+
+            if measure:
+                metrics.observe("stage.delay", time.perf_counter() - start)
+
+        with RUNNING_MACROS_LOCK:
+            if RUNNING_MACROS.get(macro.key) is macro:
+                del RUNNING_MACROS[macro.key]
+
+            # cancelled before its last frame
+            executor.release(macro)
+            executor.blocked = False
+            executor.count -= 1
+
+def assignComment(config, layer, keycode, value):
+    commentMap = config.commentMap
+
+    if not layer in commentMap:
+        commentMap[layer] = {}
+
+    if keycode in commentMap[layer]:
+        return False
+
+    commentMap[layer][keycode] = value
+
+    return True
+
+def addEventCallback(config, event, command, value):
+    eventCallbacks = config.eventCallbacks
+
+    if not event in eventCallbacks:
+        eventCallbacks[event] = []
+
+    eventCallbacks[event].append({"command": command, "value": value})
+
+def triggerEventCallback(event):
+    # the callbacks run on the bus' thread, see events.py
+    if not event in EVENT_CALLBACKS:
+        return
+
+    EVENT_BUS.publish(event, EVENT_CALLBACKS[event], {"LAYER": CURRENT_LAYER})
+
+def setLayerOption(config, layer, key, value):
+    layerOptions = config.layerOptions
+
+    if not layer in layerOptions:
+        layerOptions[layer] = {}
+
+    if key in layerOptions[layer]:
+        return False
+
+    layerOptions[layer][key] = value
+
+    return True
+
+def applyLayerOptions(layer):
+    if not layer in LAYER_OPTIONS:
+        return
+
+    for key in LAYER_OPTIONS[layer].keys():
+        if key == "start_timeout_on_keypress":
+            global START_TIMEOUT_ON_KEYPRESS
+
+            START_TIMEOUT_ON_KEYPRESS = True
+        elif key == "timeout":
+            pass
+        else:
+            print("Warning: Unhandled option: %s" % key)
+
+def getLayerTimeout(layer):
+    if layer in LAYER_OPTIONS and "timeout" in LAYER_OPTIONS[layer]:
+        return LAYER_OPTIONS[layer]["timeout"]
+
+    return DEFAULT_LAYER_TIMEOUT
+
+def assignKey(config, device, layer, keycode, state, action):
+    assert(keycode != None)
+
+    if device:
+        if not device in config.deviceCallbackMap:
+            config.deviceCallbackMap[device] = {}
+
+        callbackMap = config.deviceCallbackMap[device]
+    else:
+        callbackMap = config.keyCallbackMap
+
+    if not layer in callbackMap:
+        callbackMap[layer] = {}
+
+    if not keycode in callbackMap[layer]:
+        callbackMap[layer][keycode] = {}
+
+    if not state in callbackMap[layer][keycode]:
+        callbackMap[layer][keycode][state] = []
+
+    callbackMap[layer][keycode][state].append(action)
+
+def showLayer():
+    timeout = getLayerTimeout(CURRENT_LAYER)
+    launcher.spawn(["notify-send", "-t", "%i" % (timeout * 1000), CURRENT_LAYER])
+
+    print('\x1b[2J') # clear terminal
+    print(CURRENT_LAYER + '\n')
+
+    if not CURRENT_LAYER in COMMENT_MAP:
+        print("No comments for this layer.")
+        return
+
+    keys = list(COMMENT_MAP[CURRENT_LAYER].keys())
+    keys.sort()
+
+    for key in keys:
+        print("[ %s ] %s" % (key.split("KEY_")[1], COMMENT_MAP[CURRENT_LAYER][key]))
+
+def setLayer(layer, lock=False, hot=False):
+    global CURRENT_LAYER, CURRENT_LAYER_ID, SLOW_KEYS
+    global LAYER_LOCK, LOCKED_LAYER, HOT_LAYER
+
+    lastLayer = CURRENT_LAYER
+
+    layerChanged = not CURRENT_LAYER == layer
+
+    CURRENT_LAYER = layer
+    CURRENT_LAYER_ID = internLayer(layer)
+    SLOW_KEYS = (CONFIG.slowKeys, CURRENT_LAYER_ID)
+
+    if layerChanged:
+        triggerEventCallback(EVENT_LAYER_CHANGED)
+
+    applyLayerOptions(layer)
+
+    if lock:
+        LOCKED_LAYER = layer
+        # print("Locked layer: %s" % LOCKED_LAYER)
+        LAYER_LOCK = lock
+    elif layer == "default":
+        LAYER_LOCK = False
+        LOCKED_LAYER = layer
+
+    # or just assign hot_layer to hot value?
+    if hot:
+        HOT_LAYER = True
+
+    # print("debug: layer = %s" % layer)
+
+    publishStatus()
+
+    # experimenting with osd for command readout
+    if ASSIST_MODE:
+        if not lastLayer == CURRENT_LAYER:
+            showLayer()
+
+    return 0
+
+def publishStatus():
+    if STATUS_ENABLED:
+        status.publish(CURRENT_LAYER, LAYER_LOCK and LOCKED_LAYER or None,
+                HOT_LAYER)
+
+def runCommand(command, event=None):
+    return launcher.spawn(command)
+
+def i3Command(commands):
+    if not I3_ENABLED:
+        return runCommand("i3-msg '%s'" % "; ".join(commands).replace("'", "'\\''"))
 
-    # main loop
-    #   listen to inputs and react to them.
-    #   try..except safely closes the device and exits
     try:
-        for event in device.read_loop():
-            if event.type == evdev.ecodes.EV_KEY:
-                keyEvent = evdev.categorize(event)
+        replies = i3.batch(commands)
+    except Exception as e:
+        print("i3: %s" % e)
 
-                # print(keyEvent.keycode)
+        return 0
 
-                fired = handleKey(keyEvent, debug=DEBUG)
+    for reply in replies:
+        if not reply.get("success"):
+            print("i3: %s" % reply.get("error", reply))
 
-                if not fired and PASSTHROUGH:
-                    UI.write_event(event)
-                    UI.syn()
-            elif event.type == evdev.ecodes.EV_REL:
-                mouseEvent = evdev.categorize(event)
+    return 1
 
-                print(mouseEvent)
-            elif event.type == evdev.ecodes.EV_MSC:
-                mouseEvent = evdev.categorize(event)
+def keyInput(data):
+    # `data` is packed by output.chord() when the config is loaded
+    with UI_LOCK:
+        output.write(UI, data)
+
+    return 1
+
+def typeText(chunks):
+    if not TYPE_DELAY:
+        output.writeFrames(UI, chunks, UI_LOCK)
+
+        return 1
+
+    for chunk in chunks:
+        with UI_LOCK:
+            output.write(UI, chunk)
+
+        time.sleep(TYPE_DELAY)
+
+    return 1
+
+def unquote(text):
+    # `TYPE` used to go through the shell, so strip quoting the same way.
+    # shlex is slow enough to show on big configs and most text has no quotes.
+    if not any(char in text for char in "'\"\\\t\r"):
+        return " ".join(word for word in text.split(' ') if word)
+
+    try:
+        return " ".join(shlex.split(text))
+    except ValueError:
+        return text
+
+def type(text):
+    subprocess.call("xdotool type %s" % text, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    return 1
+
+def recordMacro(path):
+    # start recording the device the key is on, or stop and save
+    global RECORDING
+
+    import recorder
+
+    recording = RECORDING
+    device, code = FIRING_KEY
+
+    if recording:
+        RECORDING = None
+
+        # another RECORD key, its press went in before it fired
+        if recording.device == device:
+            recording.drop(code)
+
+        try:
+            recording.save(recording.name)
+        except OSError as e:
+            print("Can't save %s: %s" % (recording.name, e))
+
+            return 1
+
+        print("Recorded %i key events to %s" % (len(recording.codes),
+            recording.name))
+
+        # the same key stops it, another one starts the next recording
+        if recording.name == path:
+            return 1
+
+    RECORDING = recorder.Recording(path, device, code)
+
+    print("Recording to %s" % path)
+
+    return 1
+
+def replayMacro(value):
+    # runs on the executor, `cancel` stops it between two frames
+    import recorder
+
+    path, speed = value
+
+    try:
+        frames, release = recorder.get(path)
+    except (OSError, ValueError) as e:
+        print("Can't replay %s: %s" % (path, e))
+
+        return 0
+
+    if not speed:
+        # frames are already merged up to FRAMES_PER_WRITE, see
+        # recorder.compile(). the lock is only held for each write.
+        for i, (_, data) in enumerate(frames):
+            if i:
+                time.sleep(output.WRITE_DELAY)
+
+            with UI_LOCK:
+                output.write(UI, data)
 
-                print(event)
-            elif DEBUG:
-                print(evdev.ecodes.EV[event.type])
-    except KeyboardInterrupt:
-        print("Interrupt.")
-    except OSError:
         return 1
+
+    for delay, data in frames:
+        if delay and CURRENT_MACRO.macro.cancelled.wait(delay / speed):
+            with UI_LOCK:
+                output.write(UI, release)
+
+            return 1
+
+        with UI_LOCK:
+            output.write(UI, data)
+
+    return 1
+
+# actions that write to the uinput device
+OUTPUT_ACTIONS = ("key", "type", "bind", "xdotool", "replay")
+
+ACTION_HANDLERS = {
+    "run": runCommand,
+    "i3": i3Command,
+    "type": typeText,
+    "xdotool": type,
+    "key": keyInput,
+    "bind": keyInput,
+    "layer": lambda layer: setLayer(layer),
+    "modelayer": lambda layer: setLayer(layer, lock=True),
+    "hotlayer": lambda layer: setLayer(layer, hot=True),
+    "record": recordMacro,
+    "replay": replayMacro
+}
+
+def getDeviceViaName(name):
+    # without a hotplug watcher the index can be stale, so rebuild it. probe
+    # handles are always closed.
+    if not HOTPLUG:
+        hotplug.scan()
+
+    path = hotplug.findPath(name)
+
+    if not path:
+        return None
+
+    try:
+        return evdev.InputDevice(path)
+    except OSError:
+        return None
+
+def openDevice(device):
+    if device["byName"]:
+        return getDeviceViaName(device["path"])
+
+    try:
+        return evdev.InputDevice(device["path"])
+    except OSError:
+        return None
+
+def grabDevice(device):
+    # start consuming all inputs from the device
+    try:
+        device.grab()
     except Exception as e:
         print(e)
 
+        return False
+
+    return True
+
+def ungrabDevice(device):
     try:
         device.ungrab()
     except Exception as e:
         print("Warning: Nothing to ungrab.")
 
-    return 0
+def processEvent(event, device):
+    if event.type == evdev.ecodes.EV_KEY:
+        recording = RECORDING
+
+        if recording and recording.device == device["index"] and \
+                event.code != recording.skip:
+            recording.add(event.sec, event.usec, event.code, event.value)
+
+        if DEBUG and len(CONFIG.devices) > 1:
+            print("[%s] " % device["name"], end="")
+
+        if METRICS_ENABLED:
+            start = time.perf_counter()
+
+        with STATE_LOCK:
+            fired = handleKey(event, debug=DEBUG, device=device["index"])
+
+        if METRICS_ENABLED:
+            metrics.observe("stage.dispatch", time.perf_counter() - start)
+            metrics.count("events.bound" if fired else "events.unbound")
+
+        # unbound keys are held until the device's own SYN_REPORT, so a
+        # frame goes out whole, in one write
+        if not fired and device["passthrough"]:
+            device["pending"].append(output.packKey(event.code, event.value))
+    elif event.type == evdev.ecodes.EV_SYN and device["pending"]:
+        flushPassthrough(device, event.code, event.timestamp())
+    elif DEBUG:
+        # scan codes and mouse movement are only interesting with --show,
+        # printing them on every key press was slowing down passthrough
+        if event.type == evdev.ecodes.EV_REL:
+            mouseEvent = evdev.categorize(event)
+
+            print(mouseEvent)
+        elif event.type == evdev.ecodes.EV_MSC:
+            print(event)
+        else:
+            print(evdev.ecodes.EV[event.type])
 
-    logging.info("Thread %s: starting", name)
-    time.sleep(2)
-    logging.info("Thread %s: finishing", name)
+def flushPassthrough(device, code, timestamp):
+    pending = device["pending"]
 
-def focusHandler(event, data):
-    if not "container" in data or not "window_properties" in data["container"]:
-        return
+    if code == evdev.ecodes.SYN_REPORT:
+        pending.append(output.SYN)
 
-    if not "class" in data["container"]["window_properties"]:
-        return
+        writePassthrough(device["index"], b"".join(pending))
+
+        if METRICS_ENABLED:
+            metrics.observe("latency.passthrough", time.time() - timestamp)
+
+    # SYN_DROPPED means the frame is incomplete, drop it
+    pending.clear()
+
+def readRaw(inputDevice):
+    return os.read(inputDevice.fd, READ_SIZE)
+
+def readPassthrough(device):
+    # passthrough devices are read as raw input_events. keys that can't fire
+    # anything on the current layer are copied to the uinput buffer as they
+    # are, only the rest become InputEvents for handleKey().
+    data = readRaw(device["device"])
+
+    # what handleKey() would do first, once for the whole read
+    with STATE_LOCK:
+        checkLayerTimeout(time.time())
+
+    size = output.EVENT.size
+    pending = device["pending"]
+    index = device["index"] << 18
+    fast = 0
+
+    for offset in range(0, len(data), size):
+        sec, usec, type, code, value = output.EVENT.unpack_from(data, offset)
+
+        if type == EV_KEY:
+            # looked up every time, a bound key earlier in the read may have
+            # changed the layer or the config may have been reloaded
+            slowKeys, layerId = SLOW_KEYS
+            bound, held = slowKeys.get(index | layerId, NO_KEYS)
+
+            if not (GESTURES.active or RECORDING) and (not code in bound or
+                    (value == KEY_HOLD and not code in held)):
+                pending.append(data[offset:offset + size])
+                fast += 1
+            else:
+                processEvent(evdev.InputEvent(sec, usec, type, code, value),
+                        device)
+        elif type == EV_SYN:
+            if pending:
+                flushPassthrough(device, code, sec + usec / 1000000)
+
+    if fast and METRICS_ENABLED:
+        metrics.count("events.fast", fast)
+
+def connectDevice(device, selector):
+    inputDevice = openDevice(device)
+
+    if not inputDevice or not grabDevice(inputDevice):
+        if not device.get("waiting"):
+            print("Waiting for device: %s" % device["path"])
+
+            device["waiting"] = True
+
+        return False
+
+    device["device"] = inputDevice
+    device["waiting"] = False
+
+    selector.register(inputDevice.fd, selectors.EVENT_READ, device)
+
+    if DEBUG:
+        print("Listening to %s" % inputDevice.name)
+
+    return True
+
+def disconnectDevice(device, selector, ungrab=True):
+    inputDevice = device["device"]
+    device["device"] = None
+    device["pending"].clear()
+
+    selector.unregister(inputDevice.fd)
+
+    if ungrab:
+        ungrabDevice(inputDevice)
+
+    inputDevice.close()
+
+def readDevice(device, selector):
+    try:
+        if device["passthrough"] and not DEBUG:
+            readPassthrough(device)
+        else:
+            for event in device["device"].read():
+                processEvent(event, device)
+    except BlockingIOError:
+        pass
+    except OSError:
+        # unplugged
+        disconnectDevice(device, selector, ungrab=False)
+
+        print("Reconnecting...")
+
+def listen(devices):
+    # every device is read from this one thread through a single epoll set,
+    # and they all share the same uinput device
+    global TIMERS, LAYER_TIMER
+
+    selector = selectors.DefaultSelector()
+    TIMERS = timers.Timers()
+
+    selector.register(TIMERS.fileno(), selectors.EVENT_READ, TIMERS)
+
+    if startHotplug(devices):
+        selector.register(HOTPLUG.fileno(), selectors.EVENT_READ, None)
+
+    # main loop
+    #   listen to inputs and react to them.
+    #   try..except safely closes the devices and exits
+    try:
+        retry = True
+
+        while True:
+            if retry:
+                for device in devices:
+                    if not device["device"]:
+                        connectDevice(device, selector)
 
-    window = data["container"]["window_properties"]["class"].lower()
+            missing = not all(device["device"] for device in devices)
 
-    if window in KEY_CALLBACK_MAP:
-        setLayer(window, lock=True)
+            # missing devices are retried when a node shows up in /dev/input,
+            # or every second if inotify isn't available
+            timeout = TIMERS.timeout()
+
+            if missing and not HOTPLUG and (timeout is None or timeout > 1):
+                timeout = 1
+
+            ready = selector.select(timeout)
+            retry = not ready
+
+            for key, _ in ready:
+                if key.data is None:
+                    retry = HOTPLUG.update() or retry
+                elif key.data is TIMERS:
+                    TIMERS.drain()
+                else:
+                    readDevice(key.data, selector)
+
+            TIMERS.run()
+    except KeyboardInterrupt:
+        print("Interrupt.")
+    except Exception as e:
+        print(e)
+    finally:
+        for device in devices:
+            if device["device"]:
+                disconnectDevice(device, selector)
+
+        selector.close()
+        stopHotplug()
+
+        TIMERS.close()
+        TIMERS = None
+        LAYER_TIMER = None
+
+async def listenAsync(device):
+    waiting = False
+
+    while True:
+        inputDevice = openDevice(device)
+
+        if not inputDevice:
+            if not waiting:
+                print("Waiting for device: %s" % device["path"])
+
+                waiting = True
+
+            await waitForHotplug()
+
+            continue
+
+        if not grabDevice(inputDevice):
+            return
+
+        waiting = False
+
+        try:
+            async for event in inputDevice.async_read_loop():
+                processEvent(event, device)
+        except OSError:
+            print("Reconnecting...")
+
+            continue
+        except Exception as e:
+            print(e)
+
+            return
+        finally:
+            device["pending"].clear()
+
+            ungrabDevice(inputDevice)
+            inputDevice.close()
+
+def startHotplug(devices):
+    global HOTPLUG
+
+    try:
+        HOTPLUG = hotplug.Watcher([device["path"] for device in devices
+            if not device["byName"]])
+    except OSError as e:
+        print("Warning: hotplug disabled, polling for devices instead (%s)" % e)
+
+        HOTPLUG = None
+
+    return HOTPLUG
+
+def stopHotplug():
+    global HOTPLUG
+
+    if HOTPLUG:
+        HOTPLUG.close()
+
+        HOTPLUG = None
+
+def onHotplugAsync():
+    global HOTPLUG_CHANGED
+
+    if HOTPLUG.update():
+        HOTPLUG_CHANGED.set()
+        HOTPLUG_CHANGED = asyncio.Event()
+
+async def waitForHotplug():
+    if HOTPLUG:
+        await HOTPLUG_CHANGED.wait()
     else:
-        setLayer("default", lock=True)
+        await asyncio.sleep(1)
+
+def reloadConfig(profile=None):
+    # parse on this thread, then swap the tables in between two key events.
+    # devices stay grabbed and UI stays up, a broken config changes nothing.
+    # with --daemon, `profile` is reloaded and only activated if it's the
+    # active one.
+    with RELOAD_LOCK:
+        if profile is None:
+            profile = PROFILE
+
+        if profile:
+            path = PROFILES[profile][0].path
+        else:
+            path = CONFIG.path
 
-def main(devicePath):
-    global UI
+        print("Reloading %s" % path)
 
-    if I3_ENABLED:
-        i3.subscribe(['window'], focusHandler)
+        try:
+            config = loadConfig(path)
+        except Exception as e:
+            print("Error in config: %s" % e)
+
+            config = None
+
+        if not config:
+            print("Reload failed, keeping the running config.")
+
+            return False
+
+        liveDevices = CONFIG.devices
+
+        if [(device["name"], device["path"]) for device in config.devices] != \
+                [(device["name"], device["path"]) for device in liveDevices]:
+            print("Reload failed, `DEVICE` changes need a restart.")
+
+            return False
+
+        passthrough = [device["passthrough"] for device in config.devices]
+        config.devices = liveDevices
+
+        # however the reload came, it can include new files
+        if CONFIG_WATCHER:
+            watchConfigDirs(CONFIG_WATCHER, config)
+
+        if profile:
+            PROFILES[profile] = (config, passthrough)
+
+            if profile != PROFILE:
+                return True
+
+        with STATE_LOCK:
+            activateProfile(config, passthrough)
+
+        return True
+
+def activateProfile(config, passthrough):
+    # with STATE_LOCK held. the devices are shared, only their options change.
+    for device, flag in zip(config.devices, passthrough):
+        device["passthrough"] = flag
+
+    activateConfig(config)
+
+    if CURRENT_LAYER != "default" and not CURRENT_LAYER in config.layers:
+        setLayer("default")
+
+def loadProfiles(paths):
+    # --daemon: every config is loaded up front, named after its file. they
+    # have to agree on the devices, the first one is active.
+    global PROFILE
+
+    devices = None
+
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        config = loadConfig(path)
+
+        if not config:
+            return None
+
+        if name in PROFILES:
+            print("Two profiles named `%s`" % name)
+
+            return None
+
+        passthrough = [device["passthrough"] for device in config.devices]
+
+        if devices is None:
+            devices = config.devices
+            PROFILE = name
+        elif [(device["name"], device["path"]) for device in config.devices] != \
+                [(device["name"], device["path"]) for device in devices]:
+            print("Profile `%s` has different `DEVICE` sections" % name)
+
+            return None
+
+        config.devices = devices
+        PROFILES[name] = (config, passthrough)
+
+    return PROFILES[PROFILE]
+
+def switchProfile(name):
+    global PROFILE
+
+    config, passthrough = PROFILES[name]
+
+    with STATE_LOCK:
+        PROFILE = name
+
+        activateProfile(config, passthrough)
+
+def forceLayer(layer, lock=False):
+    # like a key switched to it, so it times out from now. only layers the
+    # config has binds on, they're interned already and the config isn't
+    # changed from this thread.
+    global LAST_KEY_EVENT_TIME
+
+    with STATE_LOCK:
+        if layer != "default" and not layer in CONFIG.layers:
+            return False
+
+        LAST_KEY_EVENT_TIME = time.time()
+
+        setLayer(layer, lock=lock)
+
+        # this is the control socket's thread. asyncio timers have to be
+        # armed (and cancelled) on the loop, listen()'s timers are thread safe.
+        if LOOP:
+            LOOP.call_soon_threadsafe(withStateLock, armLayerTimeout)
+        else:
+            armLayerTimeout()
+
+    return True
+
+def controlCommand(line):
+    words = line.split()
+
+    if not words:
+        return {"ok": False, "error": "no command"}
+
+    command, args = words[0].lower(), words[1:]
+
+    if command == "state":
+        with STATE_LOCK:
+            return {"ok": True, "profile": PROFILE, "profiles": sorted(PROFILES),
+                    "layer": CURRENT_LAYER, "mode": LAYER_LOCK and LOCKED_LAYER or None,
+                    "hot": HOT_LAYER}
+    elif command == "profile" and len(args) == 1:
+        if not args[0] in PROFILES:
+            return {"ok": False, "error": "no profile `%s`" % args[0]}
+
+        start = time.perf_counter()
+
+        switchProfile(args[0])
+
+        return {"ok": True, "profile": PROFILE,
+                "seconds": time.perf_counter() - start}
+    elif command in ("layer", "lock") and len(args) == 1:
+        if not forceLayer(args[0], lock=command == "lock"):
+            return {"ok": False, "error": "no layer `%s`" % args[0]}
+
+        return {"ok": True, "layer": args[0]}
+    elif command == "unlock" and not args:
+        forceLayer("default")
+
+        return {"ok": True, "layer": "default"}
+    elif command == "reload" and len(args) <= 1:
+        if args and not args[0] in PROFILES:
+            return {"ok": False, "error": "no profile `%s`" % args[0]}
+
+        if not reloadConfig(*args):
+            return {"ok": False, "error": "reload failed, see MacroPad's output"}
+
+        return {"ok": True}
+
+    return {"ok": False, "error": "unknown command: %s" % line.strip()}
+
+def startReload():
+    thread = threading.Thread(target=reloadConfig)
+    thread.daemon = True
+    thread.start()
+
+def printMetrics():
+    print(metrics.report(), end="")
+
+def dumpProfile():
+    path = profiler.dump()
+
+    if path:
+        print("Profile written to %s" % path)
+
+def onSigusr2(signum, frame):
+    thread = threading.Thread(target=dumpProfile)
+    thread.daemon = True
+    thread.start()
+
+def onSigusr1(signum, frame):
+    # printing from the handler could interrupt another print
+    thread = threading.Thread(target=printMetrics)
+    thread.daemon = True
+    thread.start()
+
+def onSighup(signum, frame):
+    # the handler can interrupt handleKey() on the main thread, so never
+    # touch layer state from here
+    startReload()
+
+def watchConfigDirs(inotify, config):
+    # the directories of the config, its includes and INCLUDE globs. a reload
+    # can include new ones.
+    files, globs = config.files
+    watched = set(inotify.watches.values())
+
+    for path in [path for path, _, _ in files] + [pattern for pattern, _ in globs]:
+        directory = os.path.dirname(path)
+
+        if not directory in watched:
+            try:
+                inotify.watch(directory, hotplug.IN_CLOSE_WRITE |
+                        hotplug.IN_MOVED_TO | hotplug.IN_DELETE)
+            except OSError as e:
+                print("Warning: can't watch %s (%s)" % (directory, e))
+
+            watched.add(directory)
+
+def configUses(config, path, eventName):
+    files, globs = config.files
+
+    # glob skips hidden files, so do we
+    return any(path == file for file, _, _ in files) or \
+            not eventName.startswith('.') and any(
+            fnmatch.fnmatch(path, pattern) for pattern, _ in globs)
+
+def watchConfig(inotify):
+    while True:
+        select.select([inotify], [], [])
+
+        changed = set() # profiles, None without --daemon
+
+        # editors save in a few steps, wait for them to settle
+        while True:
+            for directory, mask, eventName in inotify.read():
+                path = os.path.join(directory, eventName)
+
+                if PROFILES:
+                    changed.update(name for name, (config, _) in
+                            list(PROFILES.items()) if configUses(config, path, eventName))
+                elif configUses(CONFIG, path, eventName):
+                    changed.add(None)
+
+            if not select.select([inotify], [], [], 0.1)[0]:
+                break
+
+        # reloadConfig() watches what the new configs include
+        for profile in changed:
+            reloadConfig(profile)
+
+def startConfigWatcher():
+    # watch directories, editors often replace files instead of writing to
+    # them. with --daemon, those of every profile.
+    global CONFIG_WATCHER
+
+    try:
+        inotify = hotplug.Inotify()
+    except OSError as e:
+        print("Warning: can't watch config, reload with SIGHUP instead (%s)" % e)
+
+        return
+
+    for config in [config for config, _ in PROFILES.values()] or [CONFIG]:
+        watchConfigDirs(inotify, config)
+
+    CONFIG_WATCHER = inotify
+
+    thread = threading.Thread(target=watchConfig, args=(inotify,))
+    thread.daemon = True
+    thread.start()
+
+def focusHandler(event, data):
+    FOCUS.handle(data)
+
+def focusFilter(payload):
+    return FOCUS.accept(payload)
+
+def focusLayer(layer):
+    with STATE_LOCK:
+        # already there, don't fire LAYER_CHANGED or reapply the options
+        if layer == CURRENT_LAYER and LAYER_LOCK and layer == LOCKED_LAYER:
+            return
+
+        setLayer(layer, lock=True)
+
+def main(devices):
+    global UI
 
     UI = evdev.uinput.UInput()
 
-    while listen(devicePath):
-        print("Reconnecting...")
+    # opened in C without O_CLOEXEC, `RUN` children mustn't get a handle on it
+    os.set_inheritable(UI.fd, False)
+
+    signal.signal(signal.SIGHUP, onSighup)
+
+    if METRICS_ENABLED:
+        signal.signal(signal.SIGUSR1, onSigusr1)
+
+        path = metrics.startServer()
+
+        if path:
+            print("Serving metrics on %s" % path)
+
+    if PROFILER_ENABLED:
+        signal.signal(signal.SIGUSR2, onSigusr2)
+
+        print("Profiling to %s (SIGUSR2 to write it now)" %
+                profiler.startSampler(PROFILE_PATH))
+
+    if STATUS_ENABLED:
+        path = status.startServer()
+
+        if path:
+            print("Serving layer status on %s" % path)
+
+            publishStatus()
+
+    if DAEMON_MODE:
+        path = control.startServer(controlCommand)
+
+        if path:
+            print("Listening for commands on %s" % path)
+
+    if WATCH_CONFIG:
+        startConfigWatcher()
+
+    if ASYNC_MODE:
+        try:
+            asyncio.run(mainAsync(devices))
+        except KeyboardInterrupt:
+            print("Interrupt.")
+    else:
+        if I3_ENABLED:
+            i3.subscribe(['window'], focusHandler, focusFilter)
+
+        listen(devices)
+
+    if DEBUG and launcher.STATS:
+        launcher.printStats()
+
+    if METRICS_ENABLED:
+        metrics.stopServer()
+
+    if STATUS_ENABLED:
+        status.stopServer()
+
+    if DAEMON_MODE:
+        control.stopServer()
+
+    if PROFILER_ENABLED:
+        path = profiler.stopSampler()
+
+        if path:
+            print("Profile written to %s" % path)
+
+        print(profiler.report(), end="")
 
     print("Done")
 
+async def mainAsync(devices):
+    # everything (keys, i3 focus events and layer timeouts) runs on this one
+    # loop, so layer state is only ever touched from one thread
+    global LOOP, HOTPLUG_CHANGED
+
+    LOOP = asyncio.get_running_loop()
+
+    if I3_ENABLED:
+        LOOP.create_task(watchFocusAsync())
+
+    if startHotplug(devices):
+        HOTPLUG_CHANGED = asyncio.Event()
+
+        LOOP.add_reader(HOTPLUG.fileno(), onHotplugAsync)
+
+    await asyncio.gather(*[listenAsync(device) for device in devices])
+
+async def watchFocusAsync():
+    try:
+        await i3.subscribe_async(['window'], focusHandler, focusFilter)
+    except Exception as e:
+        print("i3: %s" % e)
+
 def usage():
     print("MacroPad.py - flags (2020) - ver. %.1f" % VERSION)
     print("Usage:")
     print("\t<file>\t\t - run MacroPad with configuration file")
     print("\t--detect\t - select device and output default config file")
+    print("\t--detect --list\t - print devices by key activity, while a key is held")
     print("\t--show <file>\t - print all key inputs to the terminal (will not fire binds)")
+    print("\t--daemon <file> [file ...]\t - run with each config as a profile")
+    print("\t--ctl <command>\t - control a running daemon (see control.py)")
     print("\nExtras:")
     print("\t--assist\t - print out keybinds in the terminal")
     print("\t--nogroup\t - ignore group requirement")
+    print("\t--async\t\t - run on a single asyncio event loop")
+    print("\t--watch\t\t - reload the config when it changes (or on SIGHUP)")
+    print("\t--metrics\t - collect latency metrics (socket, or SIGUSR1)")
+    print("\t--status\t - stream layer changes to status bars (socket)")
+    print("\t--profile[=<file>] - sample the listener, for flamegraphs (SIGUSR2)")
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--ctl"]:
+        import control
+
+        sys.exit(control.client(sys.argv[2:]))
+
     if "--assist" in sys.argv:
         ASSIST_MODE = True
 
@@ -755,7 +2436,62 @@ if __name__ == "__main__":
 
         sys.argv.remove("--nogroup")
 
-    if len(sys.argv) == 2:
+    if "--async" in sys.argv:
+        ASYNC_MODE = True
+
+        sys.argv.remove("--async")
+
+    if "--watch" in sys.argv:
+        WATCH_CONFIG = True
+
+        sys.argv.remove("--watch")
+
+    if "--metrics" in sys.argv:
+        import metrics
+
+        METRICS_ENABLED = True
+
+        sys.argv.remove("--metrics")
+
+    if "--list" in sys.argv:
+        DETECT_LIST = True
+
+        sys.argv.remove("--list")
+
+    if "--status" in sys.argv:
+        import status
+
+        STATUS_ENABLED = True
+
+        sys.argv.remove("--status")
+
+    if "--daemon" in sys.argv:
+        import control
+
+        DAEMON_MODE = True
+
+        sys.argv.remove("--daemon")
+
+    for arg in sys.argv[1:]:
+        if arg == "--profile" or arg.startswith("--profile="):
+            import profiler
+
+            PROFILER_ENABLED = True
+            PROFILE_PATH = arg.partition('=')[2] or None
+
+            sys.argv.remove(arg)
+
+            break
+
+    if DAEMON_MODE:
+        profile = len(sys.argv) > 1 and loadProfiles(sys.argv[1:])
+
+        if profile:
+            activateConfig(profile[0])
+            main(profile[0].devices)
+        else:
+            usage()
+    elif len(sys.argv) == 2:
         arg = sys.argv[1]
 
         if arg == "--help":
@@ -763,14 +2499,22 @@ if __name__ == "__main__":
         elif arg == "--detect":
             detectDevice()
         else:
-            loadConfig(arg)
+            config = loadConfig(arg)
+
+            if config:
+                activateConfig(config)
+                main(config.devices)
     elif len(sys.argv) == 3:
         command, file = sys.argv[1:]
 
         if command == "--show":
             DEBUG = True
 
-            loadConfig(file)
+            config = loadConfig(file)
+
+            if config:
+                activateConfig(config)
+                main(config.devices)
         else:
             print("Unknown command.")
 
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# latency metrics for MacroPad.
+#   timings are kept as log2 histograms (under 1us, then doubling buckets up
+#   to ~16s) next to plain counters. a report can be read from a unix socket
+#   or printed on SIGUSR1.
+
+import threading
+
+import unixserver
+
+BUCKETS = 25
+
+HISTOGRAMS = {} # name -> [count, total, max, buckets]
+COUNTERS = {}
+LOCK = threading.Lock()
+
+SERVER = None
+
+
+def observe(name, seconds):
+    # the kernel clock and ours can disagree by a hair
+    if seconds < 0:
+        seconds = 0
+
+    bucket = min(int(seconds * 1000000).bit_length(), BUCKETS - 1)
+
+    with LOCK:
+        histogram = HISTOGRAMS.get(name)
+
+        if histogram is None:
+            histogram = HISTOGRAMS[name] = [0, 0.0, 0.0, [0] * BUCKETS]
+
+        histogram[0] += 1
+        histogram[1] += seconds
+        histogram[3][bucket] += 1
+
+        if seconds > histogram[2]:
+            histogram[2] = seconds
+
+def count(name, value=1):
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+def percentile(buckets, total, fraction):
+    # upper bound of the bucket the percentile falls in, in seconds
+    seen = 0
+
+    for bucket, hits in enumerate(buckets):
+        seen += hits
+
+        if seen >= total * fraction:
+            return (1 << bucket) / 1000000
+
+    return (1 << (len(buckets) - 1)) / 1000000
+
+def formatTime(seconds):
+    if seconds < .001:
+        return "%.0fus" % (seconds * 1000000)
+
+    return "%.2fms" % (seconds * 1000)
+
+def report():
+    with LOCK:
+        counters = dict(COUNTERS)
+        histograms = {name: (histogram[0], histogram[1], histogram[2],
+            list(histogram[3])) for name, histogram in HISTOGRAMS.items()}
+
+    lines = []
+
+    for name, value in sorted(counters.items()):
+        lines.append("%-24s %i" % (name, value))
+
+    for name, (total, seconds, worst, buckets) in sorted(histograms.items()):
+        lines.append("%-24s n=%i avg=%s p50<=%s p99<=%s max=%s" % (name, total,
+            formatTime(seconds / total), formatTime(percentile(buckets, total, .5)),
+            formatTime(percentile(buckets, total, .99)), formatTime(worst)))
+
+    return "\n".join(lines) + "\n"
+
+def reset():
+    with LOCK:
+        HISTOGRAMS.clear()
+        COUNTERS.clear()
+
+def sendReport(connection):
+    try:
+        connection.sendall(report().encode())
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+def startServer(path=None):
+    # `socat - UNIX-CONNECT:<path>` prints a report
+    global SERVER
+
+    if path is None:
+        path = unixserver.defaultPath("macropad-metrics")
+
+    SERVER = unixserver.start(path, sendReport, "serve metrics")
+
+    return SERVER and path
+
+def stopServer():
+    global SERVER
+
+    if SERVER:
+        unixserver.stop(SERVER)
+
+        SERVER = None
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# batched uinput output for MacroPad.
+#   events are packed into `struct input_event` buffers ahead of time, so a
+#   whole chord (or a whole frame of passthrough events) goes to the uinput
+#   device in one write() with one SYN_REPORT at the end.
+
+import struct
+import evdev
+import time
+import os
+
+ec = evdev.ecodes
+
+# struct input_event: struct timeval, __u16 type, __u16 code, __s32 value.
+# uinput ignores the time, the kernel stamps events itself.
+EVENT = struct.Struct("llHHi")
+
+SYN = EVENT.pack(0, 0, ec.EV_SYN, ec.SYN_REPORT, 0)
+
+# the kernel gives every reader of a device without axes a 64 event buffer,
+# anything written faster than they read it is lost (SYN_DROPPED). long output
+# goes out FRAMES_PER_WRITE frames at a time with WRITE_DELAY seconds in
+# between, about 8 characters a millisecond.
+FRAMES_PER_WRITE = 8
+WRITE_DELAY = .001
+
+
+def resolve(names):
+    # "KEY_LEFTCTRL+KEY_C" -> (29, 46), None if a name is unknown
+    codes = []
+
+    for name in names.split('+'):
+        code = ec.ecodes.get(name.strip())
+
+        if code is None:
+            return None
+
+        codes.append(code)
+
+    return tuple(codes)
+
+def packKey(code, value):
+    return EVENT.pack(0, 0, ec.EV_KEY, code, value)
+
+def pack(events):
+    # (code, value) pairs as one frame
+    return b"".join([packKey(code, value) for code, value in events]) + SYN
+
+def chord(codes, value):
+    return pack([(code, value) for code in codes])
+
+def describe(data):
+    # for debug output, "KEY_C 1 SYN KEY_C 0 SYN"
+    names = []
+
+    for _, _, type, code, value in EVENT.iter_unpack(data):
+        if type == ec.EV_SYN:
+            names.append("SYN")
+        else:
+            name = ec.KEY.get(code, code)
+
+            if isinstance(name, (list, tuple)):
+                name = name[0]
+
+            names.append("%s %i" % (name, value))
+
+    return " ".join(names)
+
+def write(ui, data):
+    os.write(ui.fd, data)
+
+def writeFrames(ui, frames, lock):
+    # long output (TYPE, REPLAY) a few frames at a time, giving readers time
+    # to catch up in between. `lock` is only held for each write.
+    for i in range(0, len(frames), FRAMES_PER_WRITE):
+        if i:
+            time.sleep(WRITE_DELAY)
+
+        with lock:
+            write(ui, b"".join(frames[i:i + FRAMES_PER_WRITE]))
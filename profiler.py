@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# sampling profiler for MacroPad, for `--profile`.
+#   a thread samples every other thread's stack INTERVAL times a second and
+#   counts them in the collapsed format flamegraph.pl and speedscope read
+#   ("thread;outer;...;inner count"). actions are timed separately, wall and
+#   CPU time, by the code that runs them. samples are wall clock, so idle
+#   threads show up waiting in select() or on the macro queue.
+
+import threading
+import time
+import sys
+import os
+
+INTERVAL = .005
+DUMP_EVERY = 60 # seconds between dumps to the file
+
+LOCK = threading.Lock()
+STACKS = {} # (thread name, code objects) -> samples
+ACTIONS = {} # action kind -> [calls, wall, cpu]
+NAMES = {} # code object -> "file:function"
+
+PATH = None
+RUNNING = False
+
+
+def defaultPath():
+    return os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp",
+            "macropad-profile.txt")
+
+def start():
+    return time.perf_counter(), time.thread_time()
+
+def stop(kind, started):
+    wall = time.perf_counter() - started[0]
+    cpu = time.thread_time() - started[1]
+
+    with LOCK:
+        action = ACTIONS.get(kind)
+
+        if action is None:
+            action = ACTIONS[kind] = [0, 0.0, 0.0]
+
+        action[0] += 1
+        action[1] += wall
+        action[2] += cpu
+
+def codeName(code):
+    name = NAMES.get(code)
+
+    if name is None:
+        name = NAMES[code] = "%s:%s" % (os.path.basename(code.co_filename),
+                code.co_name)
+
+    return name
+
+def sample():
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = []
+
+    for ident, frame in sys._current_frames().items():
+        if ident == me:
+            continue
+
+        codes = []
+
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+
+        if not ident in names:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        stacks.append((names.get(ident, "thread-%i" % ident), tuple(codes)))
+
+    with LOCK:
+        for stack in stacks:
+            STACKS[stack] = STACKS.get(stack, 0) + 1
+
+def collapse():
+    with LOCK:
+        stacks = list(STACKS.items())
+
+    lines = []
+
+    for (thread, codes), count in stacks:
+        lines.append("%s;%s %i" % (thread.replace(' ', '_'), ";".join(
+            codeName(code) for code in reversed(codes)), count))
+
+    lines.sort()
+
+    return "\n".join(lines) + "\n"
+
+def report():
+    with LOCK:
+        actions = {kind: list(action) for kind, action in ACTIONS.items()}
+
+    lines = ["%-12s %8s %12s %12s %12s" % ("action", "calls", "wall ms",
+        "cpu ms", "avg wall us")]
+
+    for kind, (calls, wall, cpu) in sorted(actions.items(),
+            key=lambda item: -item[1][1]):
+        lines.append("%-12s %8i %12.2f %12.2f %12.1f" % (kind, calls,
+            wall * 1000, cpu * 1000, wall / calls * 1000000))
+
+    return "\n".join(lines) + "\n"
+
+def dump(path=None):
+    # stacks to `path`, the action table next to it
+    path = path or PATH or defaultPath()
+
+    for target, text in ((path, collapse()), (path + ".actions", report())):
+        temp = "%s.%i.tmp" % (target, os.getpid())
+
+        try:
+            with open(temp, 'w') as dumpFile:
+                dumpFile.write(text)
+
+            os.replace(temp, target)
+        except OSError as e:
+            print("Can't write profile to %s: %s" % (target, e))
+
+            return None
+
+    return path
+
+def run():
+    nextDump = time.monotonic() + DUMP_EVERY
+
+    while RUNNING:
+        time.sleep(INTERVAL)
+
+        sample()
+
+        if time.monotonic() >= nextDump:
+            dump()
+
+            nextDump = time.monotonic() + DUMP_EVERY
+
+def startSampler(path=None):
+    global PATH, RUNNING
+
+    PATH = path or defaultPath()
+    RUNNING = True
+
+    thread = threading.Thread(target=run, name="profiler")
+    thread.daemon = True
+    thread.start()
+
+    return PATH
+
+def stopSampler():
+    global RUNNING
+
+    if RUNNING:
+        RUNNING = False
+
+        return dump()
+
+    return None
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# recorded macros for MacroPad.
+#   `RECORD` keeps a device's key events as three flat arrays (microseconds
+#   since the last event, keycode, value), saved as they are after a small
+#   header. `REPLAY` turns a recording into frames ready for uinput once and
+#   keeps them until the file changes.
+
+from array import array
+
+import struct
+import sys
+import os
+
+import output
+
+MAGIC = b"MPMAC1"
+HEADER = struct.Struct("<6sI") # magic, event count
+
+MAX_DELTA = 0xffffffff
+
+CACHE = {} # path -> (mtime, size, frames, release)
+
+
+def macroDir():
+    return os.path.join(os.environ.get("XDG_DATA_HOME") or
+            os.path.expanduser("~/.local/share"), "macropad")
+
+def macroPath(name):
+    # a bare name lives in macroDir(), anything with a slash is a path
+    if '/' in name:
+        return os.path.expanduser(name)
+
+    return os.path.join(macroDir(), "%s.macro" % name)
+
+
+class Recording:
+    def __init__(self, name, device, skip):
+        self.name = name
+        self.device = device # device index
+        self.skip = skip # the key that started recording, left out
+        self.deltas = array('I')
+        self.codes = array('H')
+        self.values = array('b')
+        self.last = None
+
+    def add(self, sec, usec, code, value):
+        now = sec * 1000000 + usec
+
+        if self.last is None:
+            delta = 0
+        else:
+            delta = min(max(now - self.last, 0), MAX_DELTA)
+
+        self.last = now
+
+        self.deltas.append(delta)
+        self.codes.append(code)
+        self.values.append(value)
+
+    def drop(self, code):
+        # take back the last event if it's a press of `code`
+        if self.codes and self.codes[-1] == code and self.values[-1] == 1:
+            self.deltas.pop()
+            self.codes.pop()
+            self.values.pop()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        arrays = [array(a.typecode, a) for a in (self.deltas, self.codes,
+            self.values)]
+
+        if sys.byteorder == "big":
+            for a in arrays:
+                a.byteswap()
+
+        temp = "%s.%i.tmp" % (path, os.getpid())
+
+        with open(temp, 'wb') as macroFile:
+            macroFile.write(HEADER.pack(MAGIC, len(self.codes)))
+
+            for a in arrays:
+                a.tofile(macroFile)
+
+        os.replace(temp, path)
+
+def load(path):
+    with open(path, 'rb') as macroFile:
+        magic, count = HEADER.unpack(macroFile.read(HEADER.size))
+
+        if magic != MAGIC:
+            raise ValueError("%s is not a recorded macro" % path)
+
+        arrays = []
+
+        for typecode in "IHb":
+            a = array(typecode)
+            a.fromfile(macroFile, count)
+
+            if sys.byteorder == "big":
+                a.byteswap()
+
+            arrays.append(a)
+
+    return arrays
+
+def compile(deltas, codes, values):
+    # -> [(seconds to wait first, packed frames)], events that came in
+    # together are one frame and up to FRAMES_PER_WRITE frames with no wait
+    # between them are one write. plus a frame releasing every key, for cut
+    # short replays.
+    frames = []
+    events = []
+    delay = 0
+    down = set()
+
+    for delta, code, value in zip(deltas, codes, values):
+        if delta and events:
+            frames.append([delay, output.pack(events)])
+            events = []
+            delay = 0
+
+        delay += delta / 1000000
+        events.append((code, value))
+
+        if value:
+            down.add(code)
+        else:
+            down.discard(code)
+
+    # keys still held when recording stopped
+    events.extend((code, 0) for code in sorted(down))
+
+    if events:
+        frames.append([delay, output.pack(events)])
+
+    merged = []
+
+    for delay, data in frames:
+        if merged and not delay and merged[-1][2] < output.FRAMES_PER_WRITE:
+            merged[-1][1] += data
+            merged[-1][2] += 1
+        else:
+            merged.append([delay, data, 1])
+
+    release = output.pack([(code, 0) for code in sorted(set(codes))])
+
+    return [(delay, data) for delay, data, _ in merged], release
+
+def get(path):
+    # compiled frames, loaded again only when the file changes
+    info = os.stat(path)
+    cached = CACHE.get(path)
+
+    if cached and cached[:2] == (info.st_mtime_ns, info.st_size):
+        return cached[2:]
+
+    frames, release = compile(*load(path))
+    CACHE[path] = (info.st_mtime_ns, info.st_size, frames, release)
+
+    return frames, release
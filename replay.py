@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+# record and replay evdev event streams for MacroPad.
+#   ./replay.py record <device>... <file>      record devices until ^C
+#   ./replay.py <config> <file>                replay a recording
+#
+# options:
+#   --realtime      keep the recorded pace instead of replaying flat out
+#   --focus=<n>     send an i3 focus change every n frames
+#   --save=<file>   write what MacroPad emitted, as a recording
+#   --expect=<file> compare what MacroPad emitted against a saved recording
+#
+# replays go through macropad.listen() with fake devices and a fake uinput
+# sink, commands and i3 are stubbed, so no input hardware is needed. the nth
+# device of a recording is fed to the nth `DEVICE` of the config. events keep
+# their recorded timestamps (moved up to now), so gestures come out the same
+# either way.
+
+import contextlib
+import threading
+import selectors
+import struct
+import time
+import sys
+import os
+
+if not "--no-i3" in sys.argv:
+    sys.argv.append("--no-i3")
+
+import macropad
+import metrics
+import output
+import evdev
+
+from evdev.events import InputEvent
+
+MAGIC = b"MPREC2"
+HEADER = struct.Struct("=6sqI") # magic, start sec, start usec
+EVENT = struct.Struct("=IBHHi") # usec since the last event, device, type, code, value
+
+# a single device, without the device number
+OLD_MAGIC = b"MPREC1"
+OLD_EVENT = struct.Struct("=IHHi")
+
+MAX_DELTA = 0xffffffff
+
+MISSING = object()
+
+
+def timestamp(event):
+    return event.sec * 1000000 + event.usec
+
+def save(path, streams):
+    # one list of events per device
+    merged = sorted(((timestamp(event), device, i, event) for device, events in
+        enumerate(streams) for i, event in enumerate(events)),
+        key=lambda entry: entry[:3])
+
+    with open(path, 'wb') as recording:
+        if merged:
+            last = merged[0][0]
+        else:
+            last = 0
+
+        recording.write(HEADER.pack(MAGIC, last // 1000000, last % 1000000))
+
+        for now, device, _, event in merged:
+            recording.write(EVENT.pack(min(max(now - last, 0), MAX_DELTA),
+                device, event.type, event.code, event.value))
+
+            last = now
+
+def load(path):
+    # -> one list of events per device
+    with open(path, 'rb') as recording:
+        data = recording.read()
+
+    magic, sec, usec = HEADER.unpack_from(data)
+    now = sec * 1000000 + usec
+    streams = []
+
+    if magic == MAGIC:
+        entries = EVENT.iter_unpack(data[HEADER.size:])
+    elif magic == OLD_MAGIC:
+        entries = ((delta, 0, type, code, value) for delta, type, code, value
+            in OLD_EVENT.iter_unpack(data[HEADER.size:]))
+    else:
+        raise ValueError("%s is not a recording" % path)
+
+    for delta, device, type, code, value in entries:
+        now += delta
+
+        while len(streams) <= device:
+            streams.append([])
+
+        streams[device].append(InputEvent(now // 1000000, now % 1000000, type,
+            code, value))
+
+    return streams
+
+def record(devicePaths, path):
+    devices = [evdev.InputDevice(devicePath) for devicePath in devicePaths]
+    streams = [[] for _ in devices]
+    selector = selectors.DefaultSelector()
+
+    for i, device in enumerate(devices):
+        selector.register(device.fd, selectors.EVENT_READ, i)
+
+        print("Recording %s" % device.name)
+
+    print("^C to stop.")
+
+    try:
+        while True:
+            for key, _ in selector.select():
+                try:
+                    streams[key.data].extend(devices[key.data].read())
+                except BlockingIOError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        selector.close()
+
+        for device in devices:
+            device.close()
+
+    save(path, streams)
+
+    print("Saved %i events to %s" % (sum(len(events) for events in streams),
+        path))
+
+def frames(events):
+    # split into what one read() would return, up to and including SYN_REPORT
+    frame = []
+
+    for event in events:
+        frame.append(event)
+
+        if event.type == evdev.ecodes.EV_SYN:
+            yield frame
+
+            frame = []
+
+    if frame:
+        yield frame
+
+
+class ReplayDone(BaseException):
+    # not an Exception, so listen() lets it through after cleaning up
+    pass
+
+
+class FakeDevice:
+    # stands in for evdev.InputDevice. feed() writes one byte per frame to a
+    # pipe, so the selector in listen() wakes up like it would for a real
+    # device.
+    def __init__(self, events, onFrame=None, name="replay"):
+        self.name = name
+        self.path = "replay"
+        # copies, they're stamped as they're read
+        self.frames = list(frames([InputEvent(event.sec, event.usec, event.type,
+            event.code, event.value) for event in events]))
+        self.onFrame = onFrame
+        self.position = 0
+        self.offset = 0 # usec added to the recorded timestamps
+        self.taken = None # released for every frame read, see feed()
+        self.fd, self.writeFd = os.pipe()
+
+    def nextFrame(self):
+        os.read(self.fd, 1)
+
+        if self.position == len(self.frames):
+            raise ReplayDone()
+
+        # called here rather than from the feeder so it always lands
+        # between the same two frames
+        if self.onFrame:
+            self.onFrame()
+
+        frame = self.frames[self.position]
+        self.position += 1
+
+        for event in frame:
+            now = timestamp(event) + self.offset
+            event.sec = now // 1000000
+            event.usec = now % 1000000
+
+        if self.taken:
+            self.taken.release()
+
+        return frame
+
+    def read(self):
+        return self.nextFrame()
+
+    def readRaw(self):
+        # what os.read() on a real device fd would return
+        return b"".join([output.EVENT.pack(event.sec, event.usec, event.type,
+            event.code, event.value) for event in self.nextFrame()])
+
+    def grab(self):
+        pass
+
+    def ungrab(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.writeFd)
+
+
+def feed(devices, realtime=False):
+    # wake the devices up frame by frame in recorded order. with several
+    # devices and no `realtime`, every frame is read before the next one is
+    # sent, so which device goes first doesn't depend on the selector.
+    order = sorted((timestamp(frame[0]), i, n) for i, device in
+        enumerate(devices) for n, frame in enumerate(device.frames))
+    lockstep = len(devices) > 1 and not realtime
+    first = order[0][0] if order else 0
+    start = time.time()
+
+    # recorded timestamps, moved up to start now
+    for device in devices:
+        device.offset = int(start * 1000000) - first
+
+        if lockstep:
+            device.taken = threading.Semaphore(0)
+
+    for now, i, _ in order:
+        if realtime:
+            delay = (now - first) / 1000000 - (time.time() - start)
+
+            if delay > 0:
+                time.sleep(delay)
+
+        os.write(devices[i].writeFd, b'\0')
+
+        if lockstep:
+            devices[i].taken.acquire()
+
+    while any(device.position < len(device.frames) for device in devices):
+        time.sleep(.001)
+
+    # one more wakeup to say we're done
+    os.write(devices[0].writeFd, b'\0')
+
+def startFeeding(devices, realtime=False):
+    thread = threading.Thread(target=feed, args=(devices, realtime))
+    thread.daemon = True
+    thread.start()
+
+@contextlib.contextmanager
+def patch(module, **values):
+    # replace module globals for the length of a replay
+    saved = {name: getattr(module, name, MISSING) for name in values}
+
+    for name, value in values.items():
+        setattr(module, name, value)
+
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is MISSING:
+                delattr(module, name)
+            else:
+                setattr(module, name, value)
+
+
+class FakeUInput:
+    # `fd` is the write end of a pipe instead of /dev/uinput, and a thread
+    # decodes whatever is written to it
+    def __init__(self):
+        self.events = []
+        self.writes = 0
+        self.readFd, self.fd = os.pipe()
+
+        self.thread = threading.Thread(target=self.collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def collect(self):
+        data = b""
+
+        while True:
+            chunk = os.read(self.readFd, 65536)
+
+            if not chunk:
+                break
+
+            data += chunk
+            size = len(data) - len(data) % output.EVENT.size
+            now = time.time()
+            sec = int(now)
+            usec = int((now - sec) * 1000000)
+
+            for _, _, type, code, value in output.EVENT.iter_unpack(data[:size]):
+                self.events.append(InputEvent(sec, usec, type, code, value))
+
+            data = data[size:]
+
+        os.close(self.readFd)
+
+    def close(self):
+        os.close(self.fd)
+
+        self.thread.join()
+
+
+class FakeI3:
+    def __init__(self):
+        self.commands = []
+        self.handler = None
+
+    def batch(self, commands):
+        self.commands.extend(commands)
+
+        return [{"success": True} for _ in commands]
+
+    def subscribe(self, events, handler, accept=None):
+        self.handler = handler
+
+
+def stuckKeys(events):
+    down = set()
+
+    for event in events:
+        if event.type == evdev.ecodes.EV_KEY:
+            if event.value:
+                down.add(event.code)
+            else:
+                down.discard(event.code)
+
+    return down
+
+def compare(emitted, expected):
+    # -> None if they're the same events in the same order, otherwise the
+    # index of the first difference. output keeps the order keys came in,
+    # passthrough and macros alike (see macropad.writePassthrough()), so a
+    # run is repeatable.
+    for i, (a, b) in enumerate(zip(emitted, expected)):
+        if (a.type, a.code, a.value) != (b.type, b.code, b.value):
+            return i
+
+    if len(emitted) != len(expected):
+        return min(len(emitted), len(expected))
+
+    return None
+
+def describe(events, i):
+    # a few events either side of `i`, for a failed compare()
+    names = []
+
+    for event in events[max(i - 4, 0):i + 4]:
+        if event.type == evdev.ecodes.EV_SYN:
+            names.append("SYN")
+        else:
+            names.append("%s %i" % (macropad.getKeyName(event.code), event.value))
+
+    return " ".join(names)
+
+def focusEvent(windowClass):
+    return {"change": "focus", "container": {"window_properties":
+        {"class": windowClass}}}
+
+def run(configPath, streams, realtime=False, focusEvery=0, timeout=60):
+    # replay `streams`, one list of events per device, through
+    # macropad.listen() and return the results. with `focusEvery`, an i3
+    # focus change cycling through the config's layers comes in every that
+    # many frames. everything replaced for the replay is put back after it.
+    commands = []
+
+    def fakeRun(command, event=None):
+        commands.append(command)
+
+        return 1
+
+    def fakeType(text):
+        commands.append("xdotool type %s" % text)
+
+        return 1
+
+    config = macropad.loadConfig(configPath)
+
+    if not config:
+        raise ValueError("Can't load %s" % configPath)
+
+    if len(streams) > len(config.devices):
+        raise ValueError("%s has %i devices, the recording has %i" % (
+            configPath, len(config.devices), len(streams)))
+
+    # focus changes land between two given frames, nothing may hold them back
+    config.focus.debounce = 0
+
+    previous = macropad.CONFIG
+    macropad.activateConfig(config)
+
+    # whatever an earlier replay left behind, so runs repeat
+    macropad.HOT_LAYER = False
+    macropad.setLayer("default")
+
+    windows = sorted(config.layers) + ["unbound-window"]
+    frameCount = [0]
+
+    def onFrame():
+        i = frameCount[0]
+        frameCount[0] += 1
+
+        if focusEvery and i % focusEvery == 0:
+            macropad.focusHandler(None, focusEvent(windows[i // focusEvery %
+                len(windows)]))
+
+    devices = [FakeDevice(events, onFrame) for events in streams]
+    devices += [FakeDevice([], onFrame) for _ in config.devices[len(devices):]]
+    i3 = FakeI3()
+    ui = FakeUInput()
+
+    for configDevice in config.devices:
+        configDevice["device"] = None
+
+    # count writes to the uinput device
+    write = output.write
+    writes = [0]
+
+    def countingWrite(ui, data):
+        writes[0] += 1
+
+        write(ui, data)
+
+    metrics.reset()
+
+    with patch(macropad, UI=ui, i3=i3, I3_ENABLED=True, runCommand=fakeRun,
+            ACTION_HANDLERS=dict(macropad.ACTION_HANDLERS, run=fakeRun,
+                xdotool=fakeType),
+            openDevice=lambda configDevice: devices[configDevice["index"]],
+            readRaw=lambda inputDevice: inputDevice.readRaw(),
+            startHotplug=lambda devices: None, METRICS_ENABLED=True,
+            metrics=metrics), \
+            patch(output, write=countingWrite):
+        startFeeding(devices, realtime)
+        start = time.perf_counter()
+
+        try:
+            macropad.listen(config.devices)
+        except ReplayDone:
+            pass
+
+        listenTime = time.perf_counter() - start
+
+        # let the executors finish whatever is still queued
+        deadline = time.time() + timeout
+
+        while not macropad.macrosIdle() and time.time() < deadline:
+            time.sleep(.01)
+
+        totalTime = time.perf_counter() - start
+
+    ui.close()
+
+    if previous:
+        macropad.activateConfig(previous)
+
+    with metrics.LOCK:
+        histograms = {name: list(histogram) for name, histogram in
+            metrics.HISTOGRAMS.items()}
+        counters = dict(metrics.COUNTERS)
+
+    return {"events": sum(len(events) for events in streams),
+        "listen": listenTime, "total": totalTime, "realtime": realtime,
+        "emitted": ui.events, "writes": writes[0], "commands": commands,
+        "i3": i3.commands, "histograms": histograms, "counters": counters}
+
+def printResults(results):
+    events = results["events"]
+
+    print("replayed %i events in %.2f ms (%.0f events/s), drained after %.2f ms"
+        % (events, results["listen"] * 1000, events / results["listen"],
+        results["total"] * 1000))
+    print("emitted %i events in %i writes, ran %i commands, sent %i i3 commands"
+        % (len(results["emitted"]), results["writes"], len(results["commands"]),
+        len(results["i3"])))
+
+    # latencies start at the recorded timestamps, they only mean something
+    # when the events come in at the recorded pace
+    for name in ("stage.dispatch", "latency.passthrough", "latency.uinput"):
+        if not name in results["histograms"] or \
+                name.startswith("latency.") and not results["realtime"]:
+            continue
+
+        total, seconds, worst, buckets = results["histograms"][name]
+
+        print("%-24s p50<=%s p90<=%s p99<=%s max=%s" % (name,
+            metrics.formatTime(metrics.percentile(buckets, total, .5)),
+            metrics.formatTime(metrics.percentile(buckets, total, .9)),
+            metrics.formatTime(metrics.percentile(buckets, total, .99)),
+            metrics.formatTime(worst)))
+
+    stuck = stuckKeys(results["emitted"])
+
+    if stuck:
+        print("stuck keys: %s" % ", ".join(sorted(macropad.getKeyName(code)
+            for code in stuck)))
+
+def getOption(name, default=None):
+    for arg in sys.argv:
+        if arg.startswith("--%s=" % name):
+            return arg.split('=', 1)[1]
+
+    return default
+
+def usage():
+    print("Usage:")
+    print("\trecord <device>... <file> - record devices until ^C")
+    print("\t<config> <file>\t\t - replay a recording through MacroPad")
+    print("\nOptions:")
+    print("\t--realtime\t\t - keep the recorded pace")
+    print("\t--focus=<n>\t\t - send an i3 focus change every n frames")
+    print("\t--save=<file>\t\t - save what MacroPad emitted")
+    print("\t--expect=<file>\t\t - compare what MacroPad emitted")
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    if len(args) >= 3 and args[0] == "record":
+        record(args[1:-1], args[-1])
+    elif len(args) == 2:
+        results = run(args[0], load(args[1]), "--realtime" in sys.argv,
+                int(getOption("focus", 0)))
+
+        printResults(results)
+
+        if getOption("save"):
+            save(getOption("save"), [results["emitted"]])
+
+        if getOption("expect"):
+            expected = (load(getOption("expect")) or [[]])[0]
+            i = compare(results["emitted"], expected)
+
+            if i is None:
+                print("emitted events match %s" % getOption("expect"))
+            else:
+                print("emitted events DIFFER from %s at event %i:" % (
+                    getOption("expect"), i))
+                print("\temitted:  %s" % describe(results["emitted"], i))
+                print("\texpected: %s" % describe(expected, i))
+
+                sys.exit(1)
+
+        if stuckKeys(results["emitted"]):
+            sys.exit(1)
+    else:
+        usage()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# layer state for status bars and OSDs.
+#   clients connect to a unix socket and get the current state right away,
+#   then a line for every change. `macropad-status` streams JSON lines,
+#   `macropad-status.i3bar` streams the i3bar protocol so it can be used as a
+#   `status_command` as it is:
+#     status_command socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/macropad-status.i3bar
+
+import threading
+import json
+
+import unixserver
+
+LOCK = threading.Lock()
+SERVERS = []
+CLIENTS = [] # (socket, format)
+STATE = None
+
+I3BAR_HEADER = b'{"version": 1}\n[\n'
+
+
+def encode(format, state):
+    if format == "i3bar":
+        text = state["layer"]
+
+        if state["mode"] and state["mode"] != state["layer"]:
+            text = "%s [%s]" % (text, state["mode"])
+
+        if state["hot"]:
+            text += " (hot)"
+
+        return (json.dumps([{"name": "macropad", "full_text": text,
+            "urgent": state["hot"]}]) + ",\n").encode()
+
+    return (json.dumps(state) + "\n").encode()
+
+def publish(layer, mode, hot):
+    # called on every layer change, sends nothing unless the state changed.
+    # clients that can't keep up are dropped rather than waited for.
+    global STATE
+
+    state = {"layer": layer, "mode": mode, "hot": hot}
+
+    with LOCK:
+        if state == STATE:
+            return
+
+        STATE = state
+        lines = {}
+
+        for client in list(CLIENTS):
+            connection, format = client
+
+            if not format in lines:
+                lines[format] = encode(format, state)
+
+            try:
+                if connection.send(lines[format]) == len(lines[format]):
+                    continue
+            except OSError:
+                pass
+
+            CLIENTS.remove(client)
+            connection.close()
+
+def addClient(connection, format):
+    # clients never block publish(), the first lines fit in any socket buffer
+    connection.setblocking(False)
+
+    with LOCK:
+        data = I3BAR_HEADER if format == "i3bar" else b""
+
+        if STATE:
+            data += encode(format, STATE)
+
+        try:
+            if connection.send(data) == len(data):
+                CLIENTS.append((connection, format))
+
+                return
+        except OSError:
+            pass
+
+    connection.close()
+
+def startServer(path=None):
+    if path is None:
+        path = unixserver.defaultPath("macropad-status")
+
+    for serverPath, format in ((path, "json"), (path + ".i3bar", "i3bar")):
+        server = unixserver.start(serverPath,
+                lambda connection, format=format: addClient(connection, format),
+                "serve status")
+
+        if not server:
+            stopServer()
+
+            return None
+
+        SERVERS.append(server)
+
+    return path
+
+def stopServer():
+    for server in SERVERS:
+        unixserver.stop(server)
+
+    del SERVERS[:]
+
+    with LOCK:
+        for connection, _ in CLIENTS:
+            connection.close()
+
+        del CLIENTS[:]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# native text typing for MacroPad.
+#   strings are turned into key down/up events through a per-layout table of
+#   character -> (keycode, modifiers), then written to the uinput device.
+
+import output
+import evdev
+
+ec = evdev.ecodes
+
+SHIFT = ("KEY_LEFTSHIFT",)
+ALTGR = ("KEY_RIGHTALT",)
+
+COMMON = {
+    ' ': ("KEY_SPACE", ()),
+    '\n': ("KEY_ENTER", ()),
+    '\t': ("KEY_TAB", ())
+}
+
+US = {
+    '1': ("KEY_1", ()), '!': ("KEY_1", SHIFT),
+    '2': ("KEY_2", ()), '@': ("KEY_2", SHIFT),
+    '3': ("KEY_3", ()), '#': ("KEY_3", SHIFT),
+    '4': ("KEY_4", ()), '$': ("KEY_4", SHIFT),
+    '5': ("KEY_5", ()), '%': ("KEY_5", SHIFT),
+    '6': ("KEY_6", ()), '^': ("KEY_6", SHIFT),
+    '7': ("KEY_7", ()), '&': ("KEY_7", SHIFT),
+    '8': ("KEY_8", ()), '*': ("KEY_8", SHIFT),
+    '9': ("KEY_9", ()), '(': ("KEY_9", SHIFT),
+    '0': ("KEY_0", ()), ')': ("KEY_0", SHIFT),
+    '-': ("KEY_MINUS", ()), '_': ("KEY_MINUS", SHIFT),
+    '=': ("KEY_EQUAL", ()), '+': ("KEY_EQUAL", SHIFT),
+    '[': ("KEY_LEFTBRACE", ()), '{': ("KEY_LEFTBRACE", SHIFT),
+    ']': ("KEY_RIGHTBRACE", ()), '}': ("KEY_RIGHTBRACE", SHIFT),
+    '\\': ("KEY_BACKSLASH", ()), '|': ("KEY_BACKSLASH", SHIFT),
+    ';': ("KEY_SEMICOLON", ()), ':': ("KEY_SEMICOLON", SHIFT),
+    '\'': ("KEY_APOSTROPHE", ()), '"': ("KEY_APOSTROPHE", SHIFT),
+    '`': ("KEY_GRAVE", ()), '~': ("KEY_GRAVE", SHIFT),
+    ',': ("KEY_COMMA", ()), '<': ("KEY_COMMA", SHIFT),
+    '.': ("KEY_DOT", ()), '>': ("KEY_DOT", SHIFT),
+    '/': ("KEY_SLASH", ()), '?': ("KEY_SLASH", SHIFT)
+}
+
+GB = dict(US)
+GB.update({
+    '"': ("KEY_2", SHIFT),
+    '£': ("KEY_3", SHIFT),
+    '@': ("KEY_APOSTROPHE", SHIFT),
+    '#': ("KEY_BACKSLASH", ()), '~': ("KEY_BACKSLASH", SHIFT),
+    '\\': ("KEY_102ND", ()), '|': ("KEY_102ND", SHIFT),
+    '¬': ("KEY_GRAVE", SHIFT)
+})
+
+# dead keys (^ ` ´) are left out since they don't produce a character alone
+DE = {
+    '1': ("KEY_1", ()), '!': ("KEY_1", SHIFT),
+    '2': ("KEY_2", ()), '"': ("KEY_2", SHIFT), '²': ("KEY_2", ALTGR),
+    '3': ("KEY_3", ()), '§': ("KEY_3", SHIFT), '³': ("KEY_3", ALTGR),
+    '4': ("KEY_4", ()), '$': ("KEY_4", SHIFT),
+    '5': ("KEY_5", ()), '%': ("KEY_5", SHIFT),
+    '6': ("KEY_6", ()), '&': ("KEY_6", SHIFT),
+    '7': ("KEY_7", ()), '/': ("KEY_7", SHIFT), '{': ("KEY_7", ALTGR),
+    '8': ("KEY_8", ()), '(': ("KEY_8", SHIFT), '[': ("KEY_8", ALTGR),
+    '9': ("KEY_9", ()), ')': ("KEY_9", SHIFT), ']': ("KEY_9", ALTGR),
+    '0': ("KEY_0", ()), '=': ("KEY_0", SHIFT), '}': ("KEY_0", ALTGR),
+    'ß': ("KEY_MINUS", ()), '?': ("KEY_MINUS", SHIFT), '\\': ("KEY_MINUS", ALTGR),
+    'ü': ("KEY_LEFTBRACE", ()), 'Ü': ("KEY_LEFTBRACE", SHIFT),
+    '+': ("KEY_RIGHTBRACE", ()), '*': ("KEY_RIGHTBRACE", SHIFT),
+    '~': ("KEY_RIGHTBRACE", ALTGR),
+    'ö': ("KEY_SEMICOLON", ()), 'Ö': ("KEY_SEMICOLON", SHIFT),
+    'ä': ("KEY_APOSTROPHE", ()), 'Ä': ("KEY_APOSTROPHE", SHIFT),
+    '#': ("KEY_BACKSLASH", ()), '\'': ("KEY_BACKSLASH", SHIFT),
+    '<': ("KEY_102ND", ()), '>': ("KEY_102ND", SHIFT), '|': ("KEY_102ND", ALTGR),
+    ',': ("KEY_COMMA", ()), ';': ("KEY_COMMA", SHIFT),
+    '.': ("KEY_DOT", ()), ':': ("KEY_DOT", SHIFT),
+    '-': ("KEY_SLASH", ()), '_': ("KEY_SLASH", SHIFT),
+    '@': ("KEY_Q", ALTGR), '€': ("KEY_E", ALTGR), 'µ': ("KEY_M", ALTGR)
+}
+
+LAYOUTS = {"us": US, "gb": GB, "de": DE}
+
+# letters that are somewhere else on a layout
+SWAPPED_LETTERS = {"de": {'y': "KEY_Z", 'z': "KEY_Y"}}
+
+TABLES = {}
+CHUNKS = {} # (layout, char) -> chunk, shared between compiled strings
+
+
+def getTable(layout):
+    # build the character -> (keycode, modifier keycodes) table once per layout
+    if layout in TABLES:
+        return TABLES[layout]
+
+    names = dict(COMMON)
+    names.update(LAYOUTS[layout])
+
+    for letter in "abcdefghijklmnopqrstuvwxyz":
+        keyName = SWAPPED_LETTERS.get(layout, {}).get(letter,
+                "KEY_%s" % letter.upper())
+
+        names[letter] = (keyName, ())
+        names[letter.upper()] = (keyName, SHIFT)
+
+    table = {}
+
+    for char, (keyName, modifiers) in names.items():
+        table[char] = (ec.ecodes[keyName],
+                tuple(ec.ecodes[modifier] for modifier in modifiers))
+
+    TABLES[layout] = table
+
+    return table
+
+def missing(text, layout):
+    table = getTable(layout)
+
+    return [char for char in text if not char in table]
+
+def compile(text, layout):
+    # each character becomes one packed chunk of key events that ends in a
+    # single syn
+    table = getTable(layout)
+    chunks = []
+
+    for char in text:
+        chunk = CHUNKS.get((layout, char))
+
+        if chunk is None:
+            code, modifiers = table[char]
+            chunk = []
+
+            for modifier in modifiers:
+                chunk.append((modifier, 1))
+
+            chunk.append((code, 1))
+            chunk.append((code, 0))
+
+            for modifier in reversed(modifiers):
+                chunk.append((modifier, 0))
+
+            chunk = CHUNKS[(layout, char)] = output.pack(chunk)
+
+        chunks.append(chunk)
+
+    return tuple(chunks)
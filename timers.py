@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# timers for MacroPad's selector loop.
+#   a heap of deadlines that listen() turns into its select() timeout, so
+#   nothing runs while no timer is armed. cancelling only marks the timer,
+#   it's dropped when it reaches the top of the heap.
+
+import threading
+import heapq
+import time
+import os
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "timers")
+
+    def __init__(self, deadline, callback, args, timers):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.timers = timers
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        with self.timers.lock:
+            if not self.cancelled:
+                self.cancelled = True
+                self.timers.cancelled += 1
+
+
+class Timers:
+    def __init__(self):
+        self.heap = []
+        self.cancelled = 0
+        self.lock = threading.Lock()
+        self.thread = threading.get_ident()
+        self.wakeFds = os.pipe()
+
+        for fd in self.wakeFds:
+            os.set_blocking(fd, False)
+
+    def fileno(self):
+        # readable when another thread armed a timer the loop has to
+        # wake up earlier for
+        return self.wakeFds[0]
+
+    def callLater(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args, self)
+
+        with self.lock:
+            wake = not self.heap or timer.deadline < self.heap[0].deadline
+
+            heapq.heappush(self.heap, timer)
+
+            # lots of cancelled timers, rebuild instead of letting them pile up
+            if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if not entry.cancelled]
+                self.cancelled = 0
+
+                heapq.heapify(self.heap)
+
+        if wake and threading.get_ident() != self.thread:
+            try:
+                os.write(self.wakeFds[1], b'\0')
+            except BlockingIOError:
+                pass
+
+        return timer
+
+    def timeout(self):
+        # seconds until the next timer is due, None when there's nothing armed
+        with self.lock:
+            while self.heap and self.heap[0].cancelled:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
+
+            if not self.heap:
+                return None
+
+            return max(self.heap[0].deadline - time.monotonic(), 0)
+
+    def drain(self):
+        try:
+            os.read(self.wakeFds[0], 512)
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        # call every timer that's due
+        now = time.monotonic()
+
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0].deadline > now:
+                    return
+
+                timer = heapq.heappop(self.heap)
+
+                if timer.cancelled:
+                    self.cancelled -= 1
+
+                    continue
+
+                # done, cancelling it now must not count it again
+                timer.cancelled = True
+
+            timer.callback(*timer.args)
+
+    def close(self):
+        for fd in self.wakeFds:
+            os.close(fd)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# unix socket servers for MacroPad's metrics, status and control sockets.
+#   every server accepts on a thread of its own and hands each connection to
+#   a callback. sockets are only open to the user running MacroPad.
+
+import threading
+import socket
+import os
+
+
+def defaultPath(name):
+    return os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", name)
+
+def serve(server, onConnect):
+    while True:
+        try:
+            connection, _ = server.accept()
+        except OSError:
+            # closed by stop()
+            return
+
+        onConnect(connection)
+
+def start(path, onConnect, what):
+    # listen on `path` and call `onConnect(connection)` for every client.
+    # returns the server socket, None if it can't listen, saying so as
+    # "can't <what> on <path>".
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        if os.path.exists(path):
+            os.unlink(path)
+
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen(8)
+    except OSError as e:
+        print("Warning: can't %s on %s (%s)" % (what, path, e))
+
+        server.close()
+
+        return None
+
+    thread = threading.Thread(target=serve, args=(server, onConnect))
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+def stop(server):
+    path = server.getsockname()
+
+    # shutdown() wakes the accept() in serve()
+    try:
+        server.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+    server.close()
+
+    try:
+        os.unlink(path)
+    except OSError:
+        pass